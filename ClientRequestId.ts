@@ -0,0 +1,7 @@
+// Shared by the checkout components (StripeCheckout, Upsell_Checkout, EmailAndCheckout)
+
+// One id per checkout attempt: double clicks share the server's session, other visitors don't
+export const newClientRequestId = () =>
+    typeof crypto !== "undefined" && crypto.randomUUID
+        ? crypto.randomUUID()
+        : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`
@@ -1,5 +1,6 @@
 import React, { useState, useEffect, useRef } from "react"
 import { addPropertyControls, ControlType } from "framer"
+import { newClientRequestId } from "./ClientRequestId.ts"
 
 // Constants
 const API_ENDPOINT = "https://ce-stripe-form-3iw4kbqopa-uc.a.run.app"
@@ -111,6 +112,8 @@ const EmailStep = React.memo(
                     body: JSON.stringify({
                         action: "create_lead",
                         email,
+                        // Lets the backend prewarm the option_a checkout that follows
+                        funnel_type: "option_a",
                         current_locale: helpers.getLocale(),
                         metadata: {
                             fbclid: helpers.getFbClid() || "",
@@ -136,7 +139,7 @@ const EmailStep = React.memo(
                             funnel_type: "option_a",
                         },
                     })
-                    onSubmit(email)
+                    onSubmit(email, data.funnel_token || null)
                 } else {
                     throw new Error(data.error || "Failed")
                 }
@@ -211,10 +214,11 @@ const EmailStep = React.memo(
 )
 
 // Stripe Checkout Component
-const StripeCheckout = React.memo(({ email, isFromFunnelB }) => {
+const StripeCheckout = React.memo(({ email, funnelToken, isFromFunnelB }) => {
     const [state, setState] = useState({ loading: true, error: null })
     const mounted = useRef(false)
     const checkout = useRef(null)
+    const clientRequestId = useRef(newClientRequestId())
 
     useEffect(() => {
         if (!email || mounted.current) return
@@ -230,6 +234,9 @@ const StripeCheckout = React.memo(({ email, isFromFunnelB }) => {
                     headers: { "Content-Type": "application/json" },
                     body: JSON.stringify({
                         email,
+                        // Signed by the lead step; saves the customer lookup
+                        funnel_token: funnelToken || null,
+                        client_request_id: clientRequestId.current,
                         funnel_type: isFromFunnelB ? "option_b" : "option_a",
                         current_locale: helpers.getLocale(),
                         combined_flow: !isFromFunnelB,
@@ -268,7 +275,7 @@ const StripeCheckout = React.memo(({ email, isFromFunnelB }) => {
                 mounted.current = false
             }
         }
-    }, [email, isFromFunnelB])
+    }, [email, funnelToken, isFromFunnelB])
 
     if (state.error) {
         return (
@@ -296,14 +303,21 @@ const StripeCheckout = React.memo(({ email, isFromFunnelB }) => {
 export default function EmailAndCheckout(props) {
     const [state, setState] = useState({
         email: "",
+        funnelToken: null,
         showCheckout: false,
         isFromFunnelB: false,
     })
 
     useEffect(() => {
-        const email = new URLSearchParams(window.location.search).get("email")
+        const params = new URLSearchParams(window.location.search)
+        const email = params.get("email")
         if (email) {
-            setState({ email, showCheckout: true, isFromFunnelB: true })
+            setState({
+                email,
+                funnelToken: params.get("funnel_token"),
+                showCheckout: true,
+                isFromFunnelB: true,
+            })
 
             window.dataLayer?.push({
                 event: "begin_checkout",
@@ -329,8 +343,8 @@ export default function EmailAndCheckout(props) {
         }
     }, [])
 
-    const handleEmailSubmit = (email) => {
-        setState({ email, showCheckout: true, isFromFunnelB: false })
+    const handleEmailSubmit = (email, funnelToken) => {
+        setState({ email, funnelToken, showCheckout: true, isFromFunnelB: false })
 
         window.dataLayer?.push({
             event: "begin_checkout",
@@ -358,6 +372,7 @@ export default function EmailAndCheckout(props) {
     return state.showCheckout ? (
         <StripeCheckout
             email={state.email}
+            funnelToken={state.funnelToken}
             isFromFunnelB={state.isFromFunnelB}
         />
     ) : (
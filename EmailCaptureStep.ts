@@ -232,6 +232,13 @@ export default function EmailCaptureStep(props) {
                         redirectUrl += "&fbclid=" + encodeURIComponent(fbclid)
                     }
 
+                    // Signed funnel token: lets the checkout skip the Stripe customer lookup
+                    if (result.funnel_token) {
+                        redirectUrl +=
+                            "&funnel_token=" +
+                            encodeURIComponent(result.funnel_token)
+                    }
+
                     if (window.Sentry && window.Sentry.addBreadcrumb) {
                         window.Sentry.addBreadcrumb({
                             category: "navigation",
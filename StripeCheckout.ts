@@ -1,4 +1,5 @@
 import React, { useState, useEffect, useRef } from "react"
+import { newClientRequestId } from "./ClientRequestId.ts"
 
 // --- Configuration ---
 const STRIPE_PUBLISHABLE_KEY =
@@ -141,6 +142,7 @@ export default function StripeCheckout(props) {
     const [storedCustomerId, setStoredCustomerId] = useState(null)
     const checkoutRef = useRef(null)
     const containerRef = useRef(null)
+    const clientRequestId = useRef(newClientRequestId())
 
     useEffect(() => {
         setHasMounted(true)
@@ -260,6 +262,11 @@ export default function StripeCheckout(props) {
         // Get Facebook tracking data
         const { fbc, fbp } = getFacebookData()
 
+        // Signed by the email step; lets the backend skip the customer lookup
+        const funnelToken = new URLSearchParams(window.location.search).get(
+            "funnel_token"
+        )
+
         // Set context to Sentry
         window.Sentry?.setContext?.("checkout", {
             funnel_type: funnelType,
@@ -277,6 +284,8 @@ export default function StripeCheckout(props) {
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({
                 email: effectiveEmail || null,
+                funnel_token: funnelToken || null,
+                client_request_id: clientRequestId.current,
                 funnel_type: funnelType,
                 current_locale: getCurrentLocale(),
                 metadata: {
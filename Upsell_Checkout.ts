@@ -1,4 +1,5 @@
 import React, { useState, useEffect, useRef } from "react"
+import { newClientRequestId } from "./ClientRequestId.ts"
 
 // --- Configuration ---
 const STRIPE_PUBLISHABLE_KEY =
@@ -128,12 +129,14 @@ export default function UpsellStripeCheckout({ email = "", isEnabled = true }) {
     const [effectiveEmail, setEffectiveEmail] = useState(email)
     const [sessionId, setSessionId] = useState(null)
     const [customerId, setCustomerId] = useState(null)
+    const [funnelToken, setFunnelToken] = useState(null)
     const [clientSecret, setClientSecret] = useState(null)
     const [errorMessage, setErrorMessage] = useState(null)
     const [hasMounted, setHasMounted] = useState(false)
     const [checkoutStartTracked, setCheckoutStartTracked] = useState(false)
     const checkoutRef = useRef(null)
     const containerRef = useRef(null)
+    const clientRequestId = useRef(newClientRequestId())
 
     useEffect(() => {
         setHasMounted(true)
@@ -145,10 +148,15 @@ export default function UpsellStripeCheckout({ email = "", isEnabled = true }) {
                 urlParams.get("email") || urlParams.get("customer_email")
             const sessionFromUrl = urlParams.get("session_id")
             const customerFromUrl = urlParams.get("customer_id")
+            // Signed by the first checkout; lets the backend skip Stripe lookups
+            // (customer_token is the parameter name older return URLs carry)
+            const funnelTokenFromUrl =
+                urlParams.get("funnel_token") || urlParams.get("customer_token")
 
             setEffectiveEmail(email || emailFromUrl || "")
             setSessionId(sessionFromUrl)
             setCustomerId(customerFromUrl)
+            setFunnelToken(funnelTokenFromUrl)
 
             // Set user context in Sentry
             if ((emailFromUrl || customerFromUrl) && window.Sentry?.setUser) {
@@ -296,7 +304,9 @@ export default function UpsellStripeCheckout({ email = "", isEnabled = true }) {
             body: JSON.stringify({
                 email: effectiveEmail || null,
                 customer_id: customerId || null,
+                funnel_token: funnelToken || null,
                 session_id: sessionId || null,
+                client_request_id: clientRequestId.current,
                 funnel_type: "upsell",
                 current_locale: getCurrentLocale(),
                 // Add Facebook tracking metadata
@@ -367,7 +377,7 @@ export default function UpsellStripeCheckout({ email = "", isEnabled = true }) {
             clearTimeout(timeoutId)
             abortController.abort()
         }
-    }, [effectiveEmail, sessionId, customerId, isEnabled, hasMounted])
+    }, [effectiveEmail, sessionId, customerId, funnelToken, isEnabled, hasMounted])
 
     useEffect(() => {
         if (!clientSecret || typeof window === "undefined") return
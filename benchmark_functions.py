@@ -0,0 +1,845 @@
+"""
+Benchmark / load-test harness for the Cloud Functions in this repo.
+
+Drives create_checkout_session, the upsell create_checkout_session and
+handle_stripe_webhook through the functions_framework Flask test client while
+local stand-ins play Stripe and the Meta Graph API. Reports p50/p95/p99
+latency, throughput and outbound calls per request for every endpoint, and
+exits non-zero when a scenario fails or makes more outbound calls than its
+budget (checked only when no errors are injected).
+
+    python benchmark_functions.py --requests 200 --concurrency 8 \
+        --stripe-latency-ms 40 --meta-latency-ms 120 --meta-error-rate 0.05
+
+--verify-bench times webhook signature verification and parsing on large invoice
+and charge payloads (--payload-items lines/refunds, --requests iterations):
+
+    python benchmark_functions.py --verify-bench --payload-items 500
+
+--compare-asgi runs the same scenarios against one sync instance (fixed worker
+threads) and one async instance (the *_async entry points on one event loop):
+
+    python benchmark_functions.py --compare-asgi --requests 400 --concurrency 100 \
+        --stripe-latency-ms 80 --meta-latency-ms 150
+
+--cold-start imports each entry point in a fresh interpreter and reports its first
+preflight and first request against warm latency; compare runs with FAST_COLD_START
+unset and FAST_COLD_START=true:
+
+    FAST_COLD_START=true python benchmark_functions.py --cold-start --cold-start-request-gap-ms 100
+"""
+import os
+import re
+import sys
+import json
+import time
+import hmac
+import random
+import hashlib
+import logging
+import argparse
+import itertools
+import tempfile
+import threading
+import asyncio
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WEBHOOK_SECRET = 'whsec_benchmark'
+
+# Outbound calls allowed per request; a higher count is a round-trip regression
+CALL_BUDGETS = {
+    'lead': 3,               # Customer.list + Customer.create + Meta Lead
+    'checkout': 3,           # Customer.list + Customer.create + Session.create
+    'funnel': 4,             # lead step (3) + checkout step reusing the cached customer (1)
+    'funnel_prewarmed': 4,   # lead step (3) + prewarmed Session.create (1); checkout step makes none
+    'upsell': 2,             # Session.retrieve (customer expanded) + Session.create
+    'funnel_token': 4,       # lead step (3) + Session.create; the funnel token names the customer
+    'double_click': 4,       # two racing checkout clicks: one Customer.list + Customer.create, two Session.create
+    'upsell_token': 4,       # checkout (3) + upsell trusting the signed funnel token (1)
+    'webhook_completed': 2,  # Customer.modify + one Meta request for StartTrial and Purchase
+    'webhook_invoice': 2,    # Customer.retrieve + Meta Subscribe
+}
+
+
+# --- Local Stripe and Meta stand-ins ---
+
+class FakeBackend:
+    """In-memory Stripe + Meta Graph API with injected latency and errors"""
+
+    ID_SEGMENT = re.compile(r'^([a-z]+_[A-Za-z0-9]+|\d+)$')
+
+    def __init__(self, stripe_latency=0.0, meta_latency=0.0, stripe_error_rate=0.0, meta_error_rate=0.0,
+                 stripe_429_rate=0.0):
+        self.stripe_latency = stripe_latency
+        self.meta_latency = meta_latency
+        self.stripe_error_rate = stripe_error_rate
+        self.meta_error_rate = meta_error_rate
+        self.stripe_429_rate = stripe_429_rate
+        self.calls = Counter()
+        self.customers = {}
+        self.sessions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_id(self, prefix):
+        return f"{prefix}_bench{next(self._ids)}"
+
+    def endpoint(self, method, path):
+        """Normalized endpoint name, e.g. 'GET /v1/customers/:id'"""
+        segments = [':id' if self.ID_SEGMENT.match(segment) and segment != 'v1' else segment
+                    for segment in path.split('/')]
+        return f"{method} {'/'.join(segments)}"
+
+    def record(self, method, path):
+        with self._lock:
+            self.calls[self.endpoint(method, path)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+    def handle(self, method, path, query, form, body):
+        """Return (status, response dict)"""
+        is_meta = path.endswith('/events')
+        latency, error_rate = (self.meta_latency, self.meta_error_rate) if is_meta else (self.stripe_latency, self.stripe_error_rate)
+        if latency:
+            time.sleep(latency * random.uniform(0.8, 1.2))
+        if random.random() < error_rate:
+            return 500, {'error': {'type': 'api_error', 'message': 'Injected error'}}
+        if not is_meta and random.random() < self.stripe_429_rate:
+            code = random.choice(('rate_limit', 'lock_timeout'))
+            return 429, {'error': {'type': 'invalid_request_error', 'code': code, 'message': 'Injected 429'}}
+
+        if is_meta:
+            return 200, {'events_received': len(json.loads(body or '{}').get('data', [])), 'fbtrace_id': 'bench'}
+
+        metadata = {key[9:-1]: value for key, value in form.items() if key.startswith('metadata[')}
+        parts = path.strip('/').split('/')
+
+        if parts[:2] == ['v1', 'customers']:
+            if len(parts) == 2 and method == 'GET':
+                email = query.get('email')
+                with self._lock:
+                    data = [c for c in self.customers.values() if c['email'] == email][:1]
+                return 200, {'object': 'list', 'data': data, 'has_more': False, 'url': '/v1/customers'}
+            if len(parts) == 2:
+                customer = {'id': self.new_id('cus'), 'object': 'customer', 'email': form.get('email'),
+                            'name': None, 'metadata': metadata}
+                with self._lock:
+                    self.customers[customer['id']] = customer
+                return 200, customer
+            customer = self.customers.get(parts[2])
+            if customer is None:
+                return 404, {'error': {'type': 'invalid_request_error', 'message': 'No such customer'}}
+            if method == 'POST':
+                with self._lock:
+                    customer['metadata'].update(metadata)
+                    if 'name' in form:
+                        customer['name'] = form['name']
+            return 200, customer
+
+        if parts[:3] == ['v1', 'checkout', 'sessions']:
+            if len(parts) == 3:
+                session_id = self.new_id('cs')
+                session = {'id': session_id, 'object': 'checkout.session', 'client_secret': f"{session_id}_secret",
+                           'customer': form.get('customer'), 'customer_details': {'email': form.get('customer_email')},
+                           'metadata': metadata, 'status': 'open'}
+                with self._lock:
+                    self.sessions[session_id] = session
+                return 200, session
+            session = self.sessions.get(parts[3])
+            if session is None:
+                return 404, {'error': {'type': 'invalid_request_error', 'message': 'No such checkout session'}}
+            if method == 'POST':
+                with self._lock:
+                    session['metadata'].update(metadata)
+                    if parts[4:] == ['expire']:
+                        session['status'] = 'expired'
+            if 'customer' in (value for key, value in query.items() if key.startswith('expand[')):
+                session = dict(session, customer=self.customers.get(session['customer']))
+            return 200, session
+
+        return 404, {'error': {'type': 'invalid_request_error', 'message': f"Unrecognized request URL ({path})"}}
+
+
+def start_fake_server(backend):
+    """Serve the fake backend on a random local port. Returns (server, base_url)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1  # Send headers and body in one segment (avoids Nagle/delayed-ACK stalls)
+
+        def _dispatch(self, method):
+            url = urllib.parse.urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode() if length else ''
+            query = dict(urllib.parse.parse_qsl(url.query))
+            form = dict(urllib.parse.parse_qsl(body)) if 'form-urlencoded' in (self.headers.get('Content-Type') or '') else {}
+            backend.record(method, url.path)
+            status, response = backend.handle(method, url.path, query, form, body)
+            payload = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 256  # Bursts of new connections would overflow the default backlog of 5
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# --- Function loading ---
+
+def configure_environment(base_url, workdir):
+    """Point the functions at the stand-ins. Must run before the function modules load"""
+    os.environ.update({
+        'STRIPE_SECRET_KEY': 'sk_test_benchmark',
+        'STRIPE_WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'STRIPE_UPSELL_PRICE_ID': 'price_benchmark_upsell',
+        'META_PIXEL_ID': '1234567890',
+        'META_ACCESS_TOKEN': 'benchmark',
+        'META_GRAPH_API_BASE': f"{base_url}/v18.0",
+        'META_OUTBOX_PATH': os.path.join(workdir, 'meta_outbox.sqlite3'),
+        'CUSTOMER_TOKEN_SECRET': 'benchmark-token-secret',
+    })
+
+
+# client name -> (entry point, source file)
+FUNCTIONS = {
+    'checkout': ('create_checkout_session', 'create_checkout_session.py'),
+    'upsell': ('create_checkout_session', 'create_checkout_session_2_upsell.py'),
+    'webhook': ('handle_stripe_webhook', 'handle-stripe-webhook.py'),
+}
+
+
+def load_clients(base_url, names=None):
+    """Load each function with functions_framework and return Flask test clients"""
+    clients = create_clients(names)
+    point_stripe_at(base_url)
+    return clients
+
+
+def create_clients(names=None):
+    import functions_framework
+
+    clients = {}
+    for name in names or FUNCTIONS:
+        target, source = FUNCTIONS[name]
+        clients[name] = functions_framework.create_app(target, os.path.join(REPO_DIR, source)).test_client()
+    return clients
+
+
+def point_stripe_at(base_url):
+    import stripe
+    stripe.api_base = base_url
+    stripe.enable_telemetry = False
+
+
+def stripe_signature(payload, secret=WEBHOOK_SECRET):
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+# --- Scenarios (each returns the list of HTTP status codes it produced) ---
+
+def scenario_lead(clients, backend, i):
+    response = clients['checkout'].post('/', json={
+        'action': 'create_lead', 'email': f"lead{i}-{random.random()}@bench.test", 'current_locale': 'en',
+        'metadata': {'fbclid': f"fbclid{i}", 'user_agent': 'benchmark', 'source': 'lead_capture_step_1'}
+    })
+    return [response.status_code]
+
+
+def scenario_checkout(clients, backend, i):
+    response = clients['checkout'].post('/', json={
+        'email': f"checkout{i}-{random.random()}@bench.test", 'current_locale': 'en',
+        'metadata': {'fbc': f"fb.1.{i}.abc", 'fbp': f"fb.1.{i}.def"}
+    })
+    return [response.status_code]
+
+
+def scenario_funnel(clients, backend, i):
+    email = f"funnel{i}-{random.random()}@bench.test"
+    lead = clients['checkout'].post('/', json={
+        'action': 'create_lead', 'email': email, 'current_locale': 'en', 'metadata': {'fbclid': f"fbclid{i}"}
+    })
+    checkout = clients['checkout'].post('/', json={'email': email, 'current_locale': 'en', 'metadata': {}})
+    return [lead.status_code, checkout.status_code]
+
+
+def scenario_funnel_prewarmed(clients, backend, i):
+    # Same requests as the funnel scenario; SCENARIO_ENVIRONMENT turns the prewarm on
+    return scenario_funnel(clients, backend, i)
+
+
+def scenario_funnel_token(clients, backend, i):
+    # The checkout step sends only the token from the lead step: email, locale and fbclid come from it
+    lead = clients['checkout'].post('/', json={
+        'action': 'create_lead', 'email': f"ftoken{i}-{random.random()}@bench.test", 'current_locale': 'en',
+        'metadata': {'fbclid': f"fbclid{i}"}
+    })
+    checkout = clients['checkout'].post('/', json={'funnel_token': lead.get_json().get('funnel_token'), 'metadata': {}})
+    return [lead.status_code, checkout.status_code]
+
+
+def scenario_double_click(clients, backend, i):
+    # Both clicks for the same new email are in flight together and must share one customer
+    body = {'email': f"double{i}-{random.random()}@bench.test", 'current_locale': 'en', 'metadata': {}}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        responses = list(executor.map(lambda _: clients['checkout'].post('/', json=body), range(2)))
+    return [response.status_code for response in responses]
+
+
+def scenario_upsell(clients, backend, i):
+    customer_id = backend.new_id('cus')
+    session_id = backend.new_id('cs')
+    with backend._lock:
+        backend.customers[customer_id] = {'id': customer_id, 'object': 'customer', 'email': f"upsell{i}@bench.test",
+                                          'name': None, 'metadata': {}}
+        backend.sessions[session_id] = {'id': session_id, 'object': 'checkout.session', 'customer': customer_id,
+                                        'customer_details': {'email': f"upsell{i}@bench.test"}, 'metadata': {}}
+    response = clients['upsell'].post('/', json={
+        'session_id': session_id, 'customer_id': customer_id, 'current_locale': 'en', 'metadata': {}
+    })
+    return [response.status_code]
+
+
+def scenario_upsell_token(clients, backend, i):
+    email = f"token{i}-{random.random()}@bench.test"
+    checkout = clients['checkout'].post('/', json={'email': email, 'current_locale': 'en', 'metadata': {}})
+    upsell = clients['upsell'].post('/', json={
+        'funnel_token': checkout.get_json().get('funnel_token'), 'current_locale': 'en', 'metadata': {}
+    })
+    return [checkout.status_code, upsell.status_code]
+
+
+def post_webhook(clients, event):
+    # Stripe sends "type" as the last key; keep that order so the function's id/type peek applies
+    event = {**{key: value for key, value in event.items() if key != 'type'}, 'type': event['type']}
+    payload = json.dumps(event)
+    response = clients['webhook'].post('/', data=payload, headers={
+        'Content-Type': 'application/json', 'stripe-signature': stripe_signature(payload)
+    })
+    return [response.status_code]
+
+
+def scenario_webhook_completed(clients, backend, i):
+    customer_id = backend.new_id('cus')
+    with backend._lock:
+        backend.customers[customer_id] = {'id': customer_id, 'object': 'customer', 'email': f"paid{i}@bench.test",
+                                          'name': None, 'metadata': {}}
+    return post_webhook(clients, {
+        'id': backend.new_id('evt'), 'object': 'event', 'type': 'checkout.session.completed',
+        'data': {'object': {
+            'id': backend.new_id('cs'), 'object': 'checkout.session', 'customer': customer_id,
+            'amount_total': 0, 'currency': 'usd',
+            'customer_details': {'email': f"paid{i}@bench.test", 'name': 'Bench Mark',
+                                 'address': {'country': 'US', 'state': 'CA', 'city': 'Oakland', 'postal_code': '94607'}},
+            'metadata': {'fbc': 'fb.1.1.abc', 'fbp': 'fb.1.1.def', 'client_ip': '203.0.113.7', 'locale': 'en'}
+        }}
+    })
+
+
+def scenario_webhook_invoice(clients, backend, i):
+    customer_id = backend.new_id('cus')
+    with backend._lock:
+        backend.customers[customer_id] = {'id': customer_id, 'object': 'customer', 'email': f"renewal{i}@bench.test",
+                                          'name': None, 'metadata': {'fbclid': 'abc'}}
+    return post_webhook(clients, {
+        'id': backend.new_id('evt'), 'object': 'event', 'type': 'invoice.payment_succeeded',
+        'data': {'object': {
+            'id': backend.new_id('in'), 'object': 'invoice', 'customer': customer_id, 'customer_email': None,
+            'amount_paid': 1999, 'currency': 'usd', 'subscription': backend.new_id('sub'),
+            'billing_reason': 'subscription_cycle'
+        }}
+    })
+
+
+SCENARIOS = {
+    'lead': scenario_lead,
+    'checkout': scenario_checkout,
+    'funnel': scenario_funnel,
+    'funnel_prewarmed': scenario_funnel_prewarmed,
+    'funnel_token': scenario_funnel_token,
+    'double_click': scenario_double_click,
+    'upsell': scenario_upsell,
+    'upsell_token': scenario_upsell_token,
+    'webhook_completed': scenario_webhook_completed,
+    'webhook_invoice': scenario_webhook_invoice,
+}
+
+
+# Environment overrides applied while a scenario runs. The prewarm runs synchronously so
+# the outbound call count is deterministic
+SCENARIO_ENVIRONMENT = {
+    'funnel_prewarmed': {'CHECKOUT_PREWARM': 'sync'},
+}
+
+
+# --- Runner ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_scenario(name, clients, backend, requests_count, concurrency):
+    """Run one scenario and return its latency, throughput and outbound call report"""
+    scenario = SCENARIOS[name]
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def one(i):
+        start = time.perf_counter()
+        codes = scenario(clients, backend, i)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses.update(codes)
+
+    overrides = SCENARIO_ENVIRONMENT.get(name, {})
+    saved = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    try:
+        calls_before = backend.snapshot()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, range(requests_count)))
+        wall = time.perf_counter() - started
+        calls = backend.snapshot() - calls_before
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    latencies.sort()
+    total_calls = sum(calls.values())
+    return {
+        'scenario': name,
+        'requests': requests_count,
+        'concurrency': concurrency,
+        'statuses': dict(statuses),
+        'throughput_rps': requests_count / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'outbound_calls_per_request': total_calls / requests_count,
+        'outbound_calls_by_endpoint': {endpoint: count / requests_count for endpoint, count in sorted(calls.items())},
+        'call_budget': CALL_BUDGETS.get(name),
+    }
+
+
+# --- Cold start ---
+# Each entry point is loaded in a fresh interpreter: the import (what the platform does
+# before the first request), the first request, then warm requests on the same instance.
+
+# entry point -> (client, scenario used for its requests)
+COLD_START_ENTRY_POINTS = {
+    'create_lead': ('checkout', 'lead'),
+    'create_checkout_session': ('checkout', 'checkout'),
+    'upsell_checkout_session': ('upsell', 'upsell'),
+    'handle_stripe_webhook': ('webhook', 'webhook_completed'),
+}
+
+
+def cold_start_child(entry_point, warm_requests, request_gap_ms):
+    """Runs in the child interpreter: measure one cold start and print it as JSON.
+
+    Like a browser, the client sends the CORS preflight first and the request itself
+    request_gap_ms later (the round trip between them).
+    """
+    client_name, scenario = COLD_START_ENTRY_POINTS[entry_point]
+    backend = FakeBackend()
+    server, base_url = start_fake_server(backend)
+    configure_environment(base_url, tempfile.mkdtemp(prefix='stripe-framer-cold-'))
+
+    started = time.perf_counter()
+    clients = create_clients([client_name])
+    loaded = time.perf_counter()
+    preflight = clients[client_name].options('/')
+    preflight_done = time.perf_counter()
+    time.sleep(request_gap_ms / 1000)
+    request_sent = time.perf_counter()
+    point_stripe_at(base_url)  # Waits for the Stripe SDK if the module deferred it
+    SCENARIOS[scenario](clients, backend, 0)
+    first_done = time.perf_counter()
+
+    warm = []
+    for i in range(1, warm_requests + 1):
+        start = time.perf_counter()
+        SCENARIOS[scenario](clients, backend, i)
+        warm.append(time.perf_counter() - start)
+    warm.sort()
+    server.shutdown()
+
+    module = sys.modules.get(os.path.splitext(FUNCTIONS[client_name][1])[0])
+    print(json.dumps({
+        'entry_point': entry_point,
+        'load_ms': (loaded - started) * 1000,
+        'module_import_ms': getattr(module, 'MODULE_IMPORT_SECONDS', 0.0) * 1000,
+        'preflight_status': preflight.status_code,
+        'first_preflight_ms': (preflight_done - loaded) * 1000,
+        'first_response_ms': (preflight_done - started) * 1000,
+        'first_request_ms': (first_done - request_sent) * 1000,
+        'cold_total_ms': (first_done - started) * 1000,
+        'warm_p50_ms': percentile(warm, 0.50) * 1000,
+    }))
+
+
+def run_cold_start(entry_point, runs, warm_requests, request_gap_ms):
+    """Median cold-start figures for an entry point over several fresh interpreters"""
+    import subprocess
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--cold-start-child', entry_point,
+             '--requests', str(warm_requests), '--cold-start-request-gap-ms', str(request_gap_ms),
+             '--log-level', 'ERROR'],
+            check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    def median(key):
+        return sorted(sample[key] for sample in samples)[len(samples) // 2]
+
+    report = {'entry_point': entry_point, 'runs': runs, 'request_gap_ms': request_gap_ms}
+    for key in ('load_ms', 'module_import_ms', 'first_preflight_ms', 'first_response_ms', 'first_request_ms',
+                'cold_total_ms', 'warm_p50_ms'):
+        report[key] = median(key)
+    return report
+
+
+def print_cold_start_report(report):
+    print(f"== cold start: {report['entry_point']} (median of {report['runs']}) ==")
+    print(f"  import:        {report['load_ms']:.1f} ms (module body {report['module_import_ms']:.1f} ms)")
+    print(f"  1st preflight: {report['first_preflight_ms']:.1f} ms ({report['first_response_ms']:.1f} ms after the import started)")
+    print(f"  1st request:   {report['first_request_ms']:.1f} ms (sent {report['request_gap_ms']:.0f} ms after the preflight)")
+    print(f"  cold total:    {report['cold_total_ms']:.1f} ms (import to the request's response) vs warm p50 {report['warm_p50_ms']:.1f} ms")
+    print()
+
+
+# --- Webhook verification on large payloads ---
+# Times stripe.Webhook.construct_event (verify, then parse the whole event into StripeObjects)
+# against the function's raw-bytes path: a delivery it acknowledges without a handler
+# (unhandled type or duplicate) stops after the id/type peek, a handled one is parsed once
+# into plain dicts.
+
+def stripe_event(event_type, data_object):
+    """An event in the key order Stripe sends (id first, type last)"""
+    return {
+        'id': f"evt_bench{random.randrange(10 ** 12)}", 'object': 'event', 'api_version': '2024-06-20',
+        'created': int(time.time()), 'data': {'object': data_object}, 'livemode': False,
+        'pending_webhooks': 1, 'request': {'id': None, 'idempotency_key': None}, 'type': event_type,
+    }
+
+
+def large_invoice_event(items):
+    lines = [{
+        'id': f"il_bench{n}", 'object': 'line_item', 'amount': 1999, 'currency': 'usd',
+        'description': f"1 x Captain English Forever (at $19.99 / month) #{n}",
+        'discountable': True, 'discounts': [], 'livemode': False, 'metadata': {'seat': str(n)},
+        'period': {'end': 1735689600, 'start': 1733011200},
+        'price': {'id': 'price_bench', 'object': 'price', 'active': True, 'currency': 'usd',
+                  'product': 'prod_bench', 'recurring': {'interval': 'month', 'interval_count': 1,
+                                                         'usage_type': 'licensed'},
+                  'type': 'recurring', 'unit_amount': 1999, 'unit_amount_decimal': '1999'},
+        'proration': False, 'quantity': 1, 'subscription': 'sub_bench', 'tax_amounts': [],
+        'type': 'subscription',
+    } for n in range(items)]
+    return stripe_event('invoice.payment_succeeded', {
+        'id': 'in_bench', 'object': 'invoice', 'amount_paid': 1999 * items, 'currency': 'usd',
+        'customer': 'cus_bench', 'customer_email': 'large@bench.test', 'billing_reason': 'subscription_cycle',
+        'lines': {'object': 'list', 'data': lines, 'has_more': False, 'total_count': items},
+        'subscription': 'sub_bench', 'status': 'paid',
+    })
+
+
+def large_charge_event(items):
+    refunds = [{
+        'id': f"re_bench{n}", 'object': 'refund', 'amount': 100, 'charge': 'ch_bench', 'currency': 'usd',
+        'created': 1733011200 + n, 'metadata': {'reason_detail': 'partial refund ' * 4},
+        'reason': 'requested_by_customer', 'status': 'succeeded',
+    } for n in range(items)]
+    return stripe_event('charge.refunded', {
+        'id': 'ch_bench', 'object': 'charge', 'amount': 100 * items, 'amount_refunded': 100 * items,
+        'currency': 'usd', 'customer': 'cus_bench', 'refunded': True,
+        'billing_details': {'email': 'large@bench.test', 'name': 'Bench Mark',
+                            'address': {'country': 'US', 'postal_code': '94607'}},
+        'metadata': {f"key_{n}": 'v' * 40 for n in range(50)},
+        'outcome': {'network_status': 'approved_by_network', 'risk_level': 'normal', 'type': 'authorized'},
+        'payment_method_details': {'card': {'brand': 'visa', 'last4': '4242', 'exp_month': 12, 'exp_year': 2030},
+                                   'type': 'card'},
+        'refunds': {'object': 'list', 'data': refunds, 'has_more': False, 'total_count': items},
+    })
+
+
+VERIFY_PAYLOADS = {
+    'invoice': large_invoice_event,
+    'charge': large_charge_event,
+}
+
+
+def time_per_call(func, iterations):
+    """Median seconds per call over five rounds"""
+    rounds = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        rounds.append((time.perf_counter() - start) / iterations)
+    return sorted(rounds)[2]
+
+
+def run_verify_benchmark(items, iterations):
+    import importlib.util
+    import stripe
+
+    configure_environment('http://127.0.0.1:9', tempfile.mkdtemp(prefix='stripe-framer-verify-'))
+    spec = importlib.util.spec_from_file_location('handle_stripe_webhook', os.path.join(REPO_DIR, FUNCTIONS['webhook'][1]))
+    webhook = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(webhook)
+
+    reports = []
+    for name, build in VERIFY_PAYLOADS.items():
+        payload = json.dumps(build(items)).encode()
+        sig_header = stripe_signature(payload.decode())
+        timings = {
+            'construct_event': time_per_call(
+                lambda: stripe.Webhook.construct_event(payload, sig_header, WEBHOOK_SECRET), iterations),
+            'verify_peek': time_per_call(
+                lambda: webhook.verify_webhook_delivery(payload, sig_header, WEBHOOK_SECRET), iterations),
+            'verify_parse': time_per_call(
+                lambda: webhook.verify_webhook_delivery(payload, sig_header, WEBHOOK_SECRET).event, iterations),
+        }
+        reports.append({'payload': name, 'items': items, 'payload_kb': len(payload) / 1024,
+                        **{f"{key}_us": seconds * 1e6 for key, seconds in timings.items()}})
+    return reports
+
+
+def print_verify_report(report):
+    baseline = report['construct_event_us']
+    print(f"== {report['payload']} ({report['items']} items, {report['payload_kb']:.0f} KB) ==")
+    print(f"  construct_event:         {baseline:9.1f} us")
+    for label, key in (('verify + id/type peek', 'verify_peek_us'), ('verify + parse on demand', 'verify_parse_us')):
+        print(f"  {label + ':':24} {report[key]:9.1f} us ({baseline / report[key]:.1f}x)")
+    print()
+
+
+# --- Sync vs. async (ASGI) at a fixed instance size ---
+# Each mode gets one "instance": the Flask entry point behind --instance-threads worker
+# threads, or its *_async counterpart on a single event loop with at most
+# --asgi-concurrency requests in flight (Cloud Run's per-instance concurrency). The same
+# burst of --concurrency clients hits both; latency includes time spent queued.
+
+ASGI_SCENARIOS = ('lead', 'checkout', 'upsell', 'webhook_completed')
+
+
+class ThreadedInstance:
+    """Flask test client that serves at most `threads` requests at a time"""
+
+    def __init__(self, client, threads):
+        self.client = client
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def post(self, *args, **kwargs):
+        with self.slots:
+            return self.client.post(*args, **kwargs)
+
+
+class AsgiResponse:
+    """The parts of the Flask test response the scenarios use, over an httpx response"""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self._response = response
+
+    def get_json(self):
+        return self._response.json()
+
+
+class AsgiInstance:
+    """ASGI app on its own event loop thread, called through httpx's in-process transport"""
+
+    def __init__(self, app, max_in_flight):
+        import httpx
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='asgi-instance', daemon=True).start()
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://instance')
+        self.slots = asyncio.Semaphore(max_in_flight)
+
+    async def _post(self, path, json=None, data=None, headers=None):
+        async with self.slots:
+            return await self.client.post(path, json=json, content=data, headers=headers)
+
+    def post(self, path, **kwargs):
+        return AsgiResponse(asyncio.run_coroutine_threadsafe(self._post(path, **kwargs), self.loop).result())
+
+
+def create_instances(threads, max_in_flight):
+    """(sync instances, async instances), one per function"""
+    import functions_framework.aio
+
+    sync_clients = create_clients()
+    async_instances = {}
+    for name, (target, source) in FUNCTIONS.items():
+        app = functions_framework.aio.create_asgi_app(f"{target}_async", os.path.join(REPO_DIR, source))
+        async_instances[name] = AsgiInstance(app, max_in_flight)
+    return {name: ThreadedInstance(client, threads) for name, client in sync_clients.items()}, async_instances
+
+
+def print_comparison(sync_report, async_report, threads, max_in_flight):
+    print(f"\n== {sync_report['scenario']}: sync ({threads} threads) vs. async (<= {max_in_flight} in flight), "
+          f"{sync_report['requests']} requests from {sync_report['concurrency']} clients ==")
+    for label, report in (('sync', sync_report), ('async', async_report)):
+        print(f"  {label:6} {report['throughput_rps']:8.1f} req/s | p50 {report['p50_ms']:7.1f} ms | "
+              f"p95 {report['p95_ms']:7.1f} ms | {report['outbound_calls_per_request']:.2f} calls/request | "
+              f"statuses {report['statuses']}")
+    if sync_report['throughput_rps']:
+        print(f"  async/sync throughput: {async_report['throughput_rps'] / sync_report['throughput_rps']:.2f}x")
+
+
+def print_report(report):
+    print(f"\n== {report['scenario']} ({report['requests']} requests, concurrency {report['concurrency']}) ==")
+    print(f"  statuses:    {report['statuses']}")
+    print(f"  throughput:  {report['throughput_rps']:.1f} req/s")
+    print(f"  latency:     p50 {report['p50_ms']:.1f} ms | p95 {report['p95_ms']:.1f} ms | p99 {report['p99_ms']:.1f} ms")
+    print(f"  outbound:    {report['outbound_calls_per_request']:.2f} calls/request (budget {report['call_budget']})")
+    for endpoint, per_request in report['outbound_calls_by_endpoint'].items():
+        print(f"    {per_request:6.2f}  {endpoint}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the checkout and webhook Cloud Functions against local stand-ins")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="Scenario to run (repeatable, default: all)")
+    parser.add_argument('--requests', type=int, default=100, help="Requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--stripe-latency-ms', type=float, default=0.0)
+    parser.add_argument('--meta-latency-ms', type=float, default=0.0)
+    parser.add_argument('--stripe-error-rate', type=float, default=0.0)
+    parser.add_argument('--meta-error-rate', type=float, default=0.0)
+    parser.add_argument('--stripe-429-rate', type=float, default=0.0, help="Share of Stripe calls answered 429 (rate_limit/lock_timeout)")
+    parser.add_argument('--json', action='store_true', help="Print reports as JSON")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--cold-start', action='store_true', help="Report cold vs. warm latency per entry point instead")
+    parser.add_argument('--cold-start-runs', type=int, default=3)
+    parser.add_argument('--cold-start-request-gap-ms', type=float, default=100.0,
+                        help="Round trip between the preflight and the request it precedes")
+    parser.add_argument('--import-budget-ms', type=float, help="Fail when an entry point takes longer to import")
+    parser.add_argument('--cold-start-child', choices=sorted(COLD_START_ENTRY_POINTS), help=argparse.SUPPRESS)
+    parser.add_argument('--compare-asgi', action='store_true', help="Compare the sync and async entry points at a fixed instance size")
+    parser.add_argument('--instance-threads', type=int, default=8, help="Worker threads of the sync instance")
+    parser.add_argument('--asgi-concurrency', type=int, default=80, help="Max requests in flight on the async instance")
+    parser.add_argument('--verify-bench', action='store_true', help="Time webhook signature verification on large payloads instead")
+    parser.add_argument('--payload-items', type=int, default=500, help="Invoice lines / charge refunds in the --verify-bench payloads")
+    args = parser.parse_args(argv)
+
+    # common.py calls basicConfig(INFO) on import; configure first so ours wins
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    os.environ.setdefault('LOG_LEVEL', args.log_level.upper())  # Their configure_logging reads this
+
+    if args.cold_start_child:
+        cold_start_child(args.cold_start_child, args.requests, args.cold_start_request_gap_ms)
+        return 0
+
+    if args.cold_start:
+        reports = [run_cold_start(entry_point, args.cold_start_runs, min(args.requests, 20), args.cold_start_request_gap_ms)
+                   for entry_point in COLD_START_ENTRY_POINTS]
+        if args.json:
+            print(json.dumps(reports, indent=2))
+        else:
+            for report in reports:
+                print_cold_start_report(report)
+        over_budget = [report for report in reports
+                       if args.import_budget_ms is not None and report['load_ms'] > args.import_budget_ms]
+        for report in over_budget:
+            print(f"REGRESSION: {report['entry_point']} took {report['load_ms']:.0f} ms to import "
+                  f"(budget {args.import_budget_ms:.0f} ms)", file=sys.stderr)
+        return 1 if over_budget else 0
+
+    if args.verify_bench:
+        reports = run_verify_benchmark(args.payload_items, args.requests)
+        if args.json:
+            print(json.dumps(reports, indent=2))
+        else:
+            for report in reports:
+                print_verify_report(report)
+        return 0
+
+    backend = FakeBackend(
+        stripe_latency=args.stripe_latency_ms / 1000.0,
+        meta_latency=args.meta_latency_ms / 1000.0,
+        stripe_error_rate=args.stripe_error_rate,
+        meta_error_rate=args.meta_error_rate,
+        stripe_429_rate=args.stripe_429_rate,
+    )
+    server, base_url = start_fake_server(backend)
+    workdir = tempfile.mkdtemp(prefix='stripe-framer-bench-')
+    configure_environment(base_url, workdir)
+
+    reports = []
+    if args.compare_asgi:
+        os.environ.setdefault('HTTP_POOL_SIZE', '32')  # Room for the async webhook's dispatch threads
+        sync_instances, async_instances = create_instances(args.instance_threads, args.asgi_concurrency)
+        point_stripe_at(base_url)
+        for name in args.scenario or ASGI_SCENARIOS:
+            sync_report = run_scenario(name, sync_instances, backend, args.requests, args.concurrency)
+            async_report = run_scenario(name, async_instances, backend, args.requests, args.concurrency)
+            sync_report['mode'], async_report['mode'] = 'sync', 'async'
+            reports.extend([sync_report, async_report])
+            if not args.json:
+                print_comparison(sync_report, async_report, args.instance_threads, args.asgi_concurrency)
+    else:
+        clients = load_clients(base_url)
+        for name in args.scenario or list(SCENARIOS):
+            reports.append(run_scenario(name, clients, backend, args.requests, args.concurrency))
+            if not args.json:
+                print_report(reports[-1])
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+    # Injected errors legitimately change call counts and statuses, so only enforce on clean runs
+    if args.stripe_error_rate or args.meta_error_rate or args.stripe_429_rate:
+        return 0
+    failed = False
+    for report in reports:
+        if report['call_budget'] is not None and report['outbound_calls_per_request'] > report['call_budget']:
+            print(f"REGRESSION: {report['scenario']}{' (' + report['mode'] + ')' if 'mode' in report else ''} made {report['outbound_calls_per_request']:.2f} outbound calls "
+                  f"per request (budget {report['call_budget']})", file=sys.stderr)
+            failed = True
+        if any(status >= 400 for status in report['statuses']):
+            print(f"FAILURE: {report['scenario']} returned statuses {report['statuses']}", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1873 @@
+"""
+Infrastructure shared by the Cloud Functions in this directory (create_checkout_session,
+the upsell create_checkout_session and handle_stripe_webhook): logging, request
+summaries, tracing and metrics, settings, pooled HTTP clients, Stripe rate limiting,
+the Meta circuit breaker and batcher, and the Stripe customer cache.
+
+functions_framework puts the function's directory on sys.path, so each function file
+imports it as a sibling module; deploy it alongside them.
+"""
+import os
+import re
+import asyncio
+import importlib
+import hmac
+import base64
+import hashlib
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import closing, contextmanager, nullcontext
+from functools import wraps
+from types import MappingProxyType
+
+logging.basicConfig(level=logging.INFO)
+
+
+# --- Structured Logging ---
+# LOG_FORMAT: "text" (default) or "json" - one JSON object per line with severity and
+#   structured fields, which Cloud Logging indexes without parsing the message
+# LOG_LEVEL: root log level (default INFO)
+# LOG_SAMPLE_RATES: comma-separated logger=rate pairs, e.g. "checkout.detail=0.05",
+#   keeping that fraction of a logger's records below WARNING
+# LOG_REDACT_PII: "false" to log emails, IPs, user agents and click IDs unmasked
+# Each function logs on its own "<prefix>.request" (one summary record per request) and
+# "<prefix>.detail" (per-field tracking lines, DEBUG) loggers: "checkout",
+# "upsell_checkout" and "stripe_webhook". Shared Meta delivery details go to "meta.detail".
+
+PII_LOG_FIELDS = frozenset({
+    'email', 'customer_email', 'name', 'phone', 'client_ip', 'client_ip_address',
+    'user_agent', 'client_user_agent', 'fbc', 'fbp', 'fbclid'
+})
+EMAIL_PATTERN = re.compile(r'([\w.+-])[\w.+-]*@([\w-]+\.[\w.-]+)')
+IPV4_PATTERN = re.compile(r'\b(\d{1,3})\.\d{1,3}\.\d{1,3}\.\d{1,3}\b')
+
+meta_log = logging.getLogger('meta.detail')
+
+_current_request_summary = contextvars.ContextVar('request_summary', default=None)
+
+
+@contextmanager
+def use_request_summary(summary):
+    """Make summary the one summarize_request and outbound calls report to inside the block"""
+    token = _current_request_summary.set(summary)
+    try:
+        yield summary
+    finally:
+        _current_request_summary.reset(token)
+
+
+def redact_text(text):
+    """Mask emails (keeping the first character and domain) and IPv4 addresses"""
+    text = EMAIL_PATTERN.sub(r'\1***@\2', text)
+    return IPV4_PATTERN.sub(r'\1.x.x.x', text)
+
+
+def redact_fields(fields):
+    return {key: '[redacted]' if key in PII_LOG_FIELDS and value else value
+            for key, value in fields.items()}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record; structured fields come from extra={'fields': {...}}"""
+
+    def __init__(self, redact=True):
+        super().__init__()
+        self.redact = redact
+
+    def format(self, record):
+        message = record.getMessage()
+        fields = getattr(record, 'fields', None) or {}
+        if self.redact:
+            message = redact_text(message)
+            fields = redact_fields(fields)
+        entry = {
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': message,
+            'time': self.formatTime(record)
+        }
+        entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """Plain-text formatter that appends structured fields as key=value and masks PII"""
+
+    def __init__(self, redact=True):
+        super().__init__(logging.BASIC_FORMAT)
+        self.redact = redact
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' | ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return redact_text(text) if self.redact else text
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of a logger's records below WARNING"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def configure_logging():
+    """Apply LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATES and LOG_REDACT_PII to the root handlers"""
+    root = logging.getLogger()
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    redact = os.environ.get('LOG_REDACT_PII', 'true').lower() != 'false'
+    if os.environ.get('LOG_FORMAT', 'text').lower() == 'json':
+        formatter = JsonLogFormatter(redact=redact)
+    else:
+        formatter = TextLogFormatter(redact=redact)
+    for handler in root.handlers:
+        handler.setFormatter(formatter)
+    
+    for pair in filter(None, os.environ.get('LOG_SAMPLE_RATES', '').split(',')):
+        logger_name, _, rate = pair.partition('=')
+        logging.getLogger(logger_name.strip()).addFilter(SamplingFilter(float(rate)))
+
+
+configure_logging()
+
+
+class RequestSummary:
+    """Fields, outbound calls and timings collected while handling one request"""
+
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.started = time.perf_counter()
+        self.fields = {}
+        self.outbound = {}
+        self._lock = threading.Lock()
+
+    def set(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def add(self, **amounts):
+        with self._lock:
+            for field, amount in amounts.items():
+                self.fields[field] = self.fields.get(field, 0) + amount
+
+    def record_call(self, service, elapsed_ms):
+        with self._lock:
+            calls, total_ms = self.outbound.get(service, (0, 0.0))
+            self.outbound[service] = (calls + 1, total_ms + elapsed_ms)
+
+    def emit(self, status):
+        with self._lock:
+            fields = dict(self.fields)
+            fields['function'] = self.name
+            fields['status'] = status
+            fields['duration_ms'] = round((time.perf_counter() - self.started) * 1000, 1)
+            fields['outbound_calls'] = sum(calls for calls, _ in self.outbound.values())
+            for service, (calls, total_ms) in self.outbound.items():
+                fields[f'{service}_calls'] = calls
+                fields[f'{service}_ms'] = round(total_ms, 1)
+        self.log.info("%s %s in %.1f ms (%d outbound calls)", self.name, status,
+                      fields['duration_ms'], fields['outbound_calls'], extra={'fields': fields})
+
+
+def summarize_request(**fields):
+    """Add fields to the current request's summary record (no-op outside a request)"""
+    summary = _current_request_summary.get()
+    if summary is not None:
+        summary.set(**fields)
+
+
+def response_status(response):
+    if isinstance(response, tuple) and len(response) > 1 and isinstance(response[1], int):
+        return response[1]
+    return getattr(response, 'status_code', 200)
+
+
+def record_outbound_call(service, response):
+    """requests response hook: attribute the call to the current request's summary"""
+    summary = _current_request_summary.get()
+    if summary is not None:
+        summary.record_call(service, response.elapsed.total_seconds() * 1000)
+
+
+def summarized_request(request_log):
+    """Decorator for an HTTP entry point: one summary record on request_log and one request
+    span per call"""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(request):
+            if is_metrics_request(request):
+                return metrics_response(request)
+            summary = RequestSummary(func.__name__, request_log)
+            status = 500
+            try:
+                with use_request_summary(summary), \
+                        trace_span(func.__name__, kind='server', **{'http.status_code': status}) as span:
+                    summary.set(trace_id=span.trace_id)
+                    response = func(request)
+                    status = span.attributes['http.status_code'] = response_status(response)
+                return response
+            finally:
+                summary.emit(status)
+        return wrapper
+    return decorate
+
+
+# --- Tracing and Metrics ---
+# Every request and every outbound Stripe/Meta call is timed as a span. Finished spans
+# also feed Prometheus-style counters and histograms. Spans and metrics are tagged with
+# the request's action, funnel_type and event_type.
+# TRACE_EXPORTER: "none" (default), "memory" (kept on SPAN_EXPORTER.spans, for local
+#   tests), "log" (one record per span on the "functions.trace" logger) or "otel"
+#   (mirror spans into the process's OpenTelemetry tracer; needs opentelemetry-api)
+# METRICS_ENDPOINT_ENABLED: "true" to serve the Prometheus text format on GET .../metrics;
+#   METRICS_TOKEN, if set, must be sent as "Authorization: Bearer <token>"
+
+TRACE_TAG_FIELDS = ('action', 'funnel_type', 'event_type')
+# Values a tag may take as a metric label. Anything else (e.g. a funnel_type a client
+# made up) is counted as "other", so requests cannot create new time series
+TRACE_TAG_VALUES = {
+    'action': ('create_lead', 'create_checkout_session', 'create_upsell_session'),
+    'funnel_type': ('option_a', 'option_b', 'upsell'),
+    'event_type': (),  # The webhook registers its handled event types (register_trace_tag_values)
+}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+trace_log = logging.getLogger('functions.trace')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """A timed operation, shaped after the OpenTelemetry span data model"""
+
+    def __init__(self, name, kind, parent, attributes):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.status = 'OK'
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano = None
+
+    @property
+    def duration_seconds(self):
+        return (self.end_time_unix_nano - self.start_time_unix_nano) / 1e9
+
+    def to_dict(self):
+        """OTLP/JSON representation"""
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_span_id or '',
+            'name': self.name,
+            'kind': f"SPAN_KIND_{self.kind.upper()}",
+            'startTimeUnixNano': str(self.start_time_unix_nano),
+            'endTimeUnixNano': str(self.end_time_unix_nano),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in self.attributes.items()],
+            'status': {'code': f"STATUS_CODE_{self.status}"}
+        }
+
+
+class InMemorySpanExporter:
+    """Keeps finished spans in memory (TRACE_EXPORTER=memory)"""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class LogSpanExporter:
+    """Writes each finished span as a structured log record (TRACE_EXPORTER=log)"""
+
+    def export(self, span):
+        trace_log.info("span %s %.1f ms %s", span.name, span.duration_seconds * 1000, span.status,
+                       extra={'fields': {'span': span.to_dict()}})
+
+
+SPAN_EXPORTER = InMemorySpanExporter()
+
+_span_exporter = None
+_otel_tracer = None
+_tracing_configured = False
+_tracing_lock = threading.Lock()
+
+
+def configure_tracing():
+    """Pick the span exporter from TRACE_EXPORTER once per process"""
+    global _span_exporter, _otel_tracer, _tracing_configured
+    if _tracing_configured:
+        return
+    with _tracing_lock:
+        if _tracing_configured:
+            return
+        exporter = os.environ.get('TRACE_EXPORTER', 'none').lower()
+        if exporter == 'memory':
+            _span_exporter = SPAN_EXPORTER
+        elif exporter == 'log':
+            _span_exporter = LogSpanExporter()
+        elif exporter == 'otel':
+            try:
+                from opentelemetry import trace
+                _otel_tracer = trace.get_tracer(__name__)
+            except ImportError:
+                logging.warning("TRACE_EXPORTER=otel but opentelemetry-api is not installed, spans are not exported")
+        _tracing_configured = True
+
+
+@contextmanager
+def trace_span(name, kind='client', **attributes):
+    """Time a block as a child of the current span and record it in the metrics"""
+    configure_tracing()
+    span = Span(name, kind, _current_span.get(), attributes)
+    token = _current_span.set(span)
+    otel_context = _otel_tracer.start_as_current_span(name, attributes=attributes) if _otel_tracer else nullcontext()
+    try:
+        with otel_context as otel_span:
+            try:
+                yield span
+            except BaseException as e:
+                span.status = 'ERROR'
+                span.attributes['error.type'] = type(e).__name__
+                raise
+            finally:
+                span.end_time_unix_nano = time.time_ns()
+                # Request tags are usually known only after the request span has started
+                summary = _current_request_summary.get()
+                if summary is not None:
+                    for field in TRACE_TAG_FIELDS:
+                        if field in summary.fields:
+                            span.attributes.setdefault(field, summary.fields[field])
+                if otel_span is not None:
+                    otel_span.set_attributes({key: str(value) for key, value in span.attributes.items()})
+    finally:
+        _current_span.reset(token)
+        record_span_metrics(span)
+        if _span_exporter is not None:
+            _span_exporter.export(span)
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in the Prometheus text format"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self.buckets, histogram['buckets']):
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+METRICS = MetricsRegistry()
+
+
+_trace_tag_values_lock = threading.Lock()
+
+
+def register_trace_tag_values(field, values):
+    """Accept more values of a tag as metric labels (e.g. the event types a function handles)"""
+    with _trace_tag_values_lock:
+        known = TRACE_TAG_VALUES[field]
+        TRACE_TAG_VALUES[field] = known + tuple(value for value in values if value not in known)
+
+
+def metric_label(field, value):
+    return value if not value or value in TRACE_TAG_VALUES[field] else 'other'
+
+
+def record_span_metrics(span):
+    """Outbound calls feed outbound_calls_*, request spans feed requests_*"""
+    labels = {field: metric_label(field, span.attributes.get(field, '')) for field in TRACE_TAG_FIELDS}
+    if span.kind == 'client':
+        labels['operation'] = span.name
+        METRICS.observe('outbound_call_duration_seconds', labels, span.duration_seconds)
+        METRICS.inc('outbound_calls_total', dict(labels, status=span.status))
+    elif span.kind == 'server':
+        labels['function'] = span.name
+        METRICS.observe('request_duration_seconds', labels, span.duration_seconds)
+        METRICS.inc('requests_total', dict(labels, status=str(span.attributes.get('http.status_code', ''))))
+
+
+def is_metrics_request(request):
+    path = request.path if hasattr(request, 'path') else request.url.path  # Flask or Starlette
+    return (request.method == 'GET'
+            and path.rstrip('/').endswith('/metrics')
+            and os.environ.get('METRICS_ENDPOINT_ENABLED', 'false').lower() == 'true')
+
+
+def metrics_response(request):
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return 'Unauthorized', 401
+    return METRICS.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+# --- Settings and Catalog ---
+# Deploy-specific values (site URL, prices, Graph API version, Meta content names) live in
+# one read-only catalog built once per process and shared by every function, so one JSON
+# file configures all of them. DEFAULT_SETTINGS is the production catalog.
+# SETTINGS_FILE: optional JSON file with the same shape (partial is fine), merged over the
+#   defaults; the env vars in SETTINGS_ENV_OVERRIDES are applied last.
+
+DEFAULT_SETTINGS = {
+    'site_url': "https://captainenglish.com",
+    'meta_graph_api_version': "v18.0",
+    'subscription': {
+        'price_id': "price_1RihNELm9s3Kr237MPqAlg9l",
+        'trial_period_days': 3,
+        'return_path': "/captain-forever?session_id={CHECKOUT_SESSION_ID}&customer_id={CHECKOUT_SESSION_CUSTOMER}&customer_email={CHECKOUT_SESSION_CUSTOMER_EMAIL}",
+    },
+    'upsell': {
+        'price_id': None,  # Set per deploy (STRIPE_UPSELL_PRICE_ID)
+        'return_path': "/thank-you-lifetime?session_id={CHECKOUT_SESSION_ID}",
+    },
+    # Static part of each Meta event; handlers only add the per-event fields
+    'meta_events': {
+        'lead': {
+            'event_name': "Lead",
+            'custom_data': {"content_name": "Email Signup", "content_category": "Lead Generation",
+                            "value": 0.0, "currency": "USD"},
+        },
+        'start_trial': {
+            'event_name': "StartTrial",
+            'custom_data': {"content_type": "product", "content_name": "Captain English Pro Trial",
+                            "content_ids": ["captain_english_pro"],
+                            "contents": [{"id": "captain_english_pro", "quantity": 1}], "num_items": 1},
+        },
+        'trial_purchase': {
+            'event_name': "Purchase",
+            'custom_data': {"content_type": "product", "content_name": "Captain English Pro Trial",
+                            "content_ids": ["captain_english_pro"],
+                            "contents": [{"id": "captain_english_pro", "quantity": 1}], "num_items": 1},
+        },
+        'upsell_purchase': {
+            'event_name': "Purchase",
+            'custom_data': {"content_type": "product", "content_name": "Captain English Lifetime Access",
+                            "content_ids": ["captain_english_lifetime"],
+                            "contents": [{"id": "captain_english_lifetime", "quantity": 1}], "num_items": 1},
+        },
+        'subscribe': {
+            'event_name': "Subscribe",
+            'custom_data': {"content_type": "product", "content_name": "Captain English Pro Subscription",
+                            "content_ids": ["captain_english_pro_subscription"],
+                            "contents": [{"id": "captain_english_pro_subscription", "quantity": 1}],
+                            "num_items": 1},
+        },
+        'cancel_subscription': {
+            'event_name': "CancelSubscription",
+            'custom_data': {"content_type": "product", "content_name": "Captain English Pro Subscription"},
+        },
+        'refund': {
+            'event_name': "Refund",
+            'custom_data': {"content_type": "product", "content_name": "Captain English Pro"},
+        },
+    },
+}
+
+# env var -> (settings path, parser)
+SETTINGS_ENV_OVERRIDES = {
+    'SITE_URL': (('site_url',), str),
+    'META_GRAPH_API_VERSION': (('meta_graph_api_version',), str),
+    'STRIPE_SUBSCRIPTION_PRICE_ID': (('subscription', 'price_id'), str),
+    'TRIAL_PERIOD_DAYS': (('subscription', 'trial_period_days'), int),
+    'STRIPE_UPSELL_PRICE_ID': (('upsell', 'price_id'), str),
+}
+
+
+def merge_settings(base, overrides, path=()):
+    """Recursively merge overrides into a copy of base, reporting keys base does not have"""
+    merged, unknown = dict(base), []
+    for key, value in overrides.items():
+        if key not in base:
+            unknown.append('.'.join(path + (key,)))
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merged[key], nested_unknown = merge_settings(base[key], value, path + (key,))
+            unknown.extend(nested_unknown)
+        else:
+            merged[key] = value
+    return merged, unknown
+
+
+def freeze_settings(value):
+    """Read-only view: dicts become mappingproxies and lists become tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_settings(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze_settings(item) for item in value)
+    return value
+
+
+def thaw_settings(value):
+    """Plain (JSON-serializable) copy of a frozen settings value"""
+    if isinstance(value, MappingProxyType):
+        return {key: thaw_settings(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw_settings(item) for item in value]
+    return value
+
+
+def load_settings():
+    """Build the catalog from the defaults, SETTINGS_FILE and env overrides. Returns (settings, problems)"""
+    settings, problems = DEFAULT_SETTINGS, []
+
+    settings_file = os.environ.get('SETTINGS_FILE')
+    if settings_file:
+        try:
+            with open(settings_file) as f:
+                overrides = json.load(f)
+            if not isinstance(overrides, dict):
+                raise ValueError("top level must be a JSON object")
+            settings, unknown = merge_settings(settings, overrides)
+            for key in unknown:
+                logging.warning(f"Settings file {settings_file}: unknown key {key}")
+        except (OSError, ValueError) as e:
+            problems.append(f"SETTINGS_FILE {settings_file} could not be loaded ({e}), using defaults")
+
+    for env_var, (path, parse) in SETTINGS_ENV_OVERRIDES.items():
+        raw = os.environ.get(env_var)
+        if raw is None or raw == '':
+            continue
+        try:
+            value = parse(raw)
+        except ValueError:
+            problems.append(f"{env_var}={raw!r} is not a valid {parse.__name__}")
+            continue
+        override = value
+        for key in reversed(path):
+            override = {key: override}
+        settings, _ = merge_settings(settings, override)
+
+    settings = dict(settings, site_url=str(settings['site_url']).rstrip('/'))
+    if not settings['site_url'].startswith('https://'):
+        problems.append(f"site_url {settings['site_url']!r} is not an https URL")
+    subscription = settings['subscription']
+    if not str(subscription.get('price_id') or '').startswith('price_'):
+        problems.append(f"subscription.price_id {subscription.get('price_id')!r} is not a Stripe price ID")
+    if not isinstance(subscription.get('trial_period_days'), int) or subscription['trial_period_days'] < 0:
+        problems.append(f"subscription.trial_period_days {subscription.get('trial_period_days')!r} is not a non-negative integer")
+    for name, template in settings['meta_events'].items():
+        if not isinstance(template, dict) or not template.get('event_name') or not isinstance(template.get('custom_data'), dict):
+            problems.append(f"meta_events.{name} needs an event_name and a custom_data object")
+    return freeze_settings(settings), problems
+
+
+def report_startup_problems(problems):
+    """Log configuration problems; STRICT_STARTUP_CONFIG=true turns them into an import error"""
+    for problem in problems:
+        logging.error(f"Startup configuration: {problem}")
+    if problems and os.environ.get('STRICT_STARTUP_CONFIG', 'false').lower() == 'true':
+        raise RuntimeError(f"Invalid startup configuration: {'; '.join(problems)}")
+
+
+SETTINGS, _settings_problems = load_settings()
+report_startup_problems(_settings_problems)
+
+
+# --- Startup Configuration ---
+# Credentials and required settings are read and validated once per process, at module
+# init, so a misconfigured deploy shows up in the cold-start logs rather than per request.
+# STRICT_STARTUP_CONFIG=true turns problems into an import error (the deploy fails fast).
+# Each function asks for the settings it cannot run without.
+
+def load_startup_config(meta=False, webhook_secret=False, upsell_price=False):
+    """Read and validate the Stripe key plus the Meta credentials, webhook signing secret
+    and upsell price when asked for"""
+    config = {'stripe_secret_key': os.environ.get('STRIPE_SECRET_KEY')}
+    problems = []
+    if not config['stripe_secret_key']:
+        problems.append("STRIPE_SECRET_KEY is not set")
+    if webhook_secret:
+        config['webhook_secret'] = os.environ.get('STRIPE_WEBHOOK_SECRET')
+        if not config['webhook_secret']:
+            problems.append("STRIPE_WEBHOOK_SECRET is not set, every delivery will fail signature verification")
+    if meta:
+        config.update({
+            'meta_pixel_id': os.environ.get('META_PIXEL_ID'),
+            'meta_access_token': os.environ.get('META_ACCESS_TOKEN'),
+            'meta_graph_api_base': os.environ.get(
+                'META_GRAPH_API_BASE', f"https://graph.facebook.com/{SETTINGS['meta_graph_api_version']}"
+            ),
+        })
+        if bool(config['meta_pixel_id']) != bool(config['meta_access_token']):
+            problems.append("only one of META_PIXEL_ID / META_ACCESS_TOKEN is set, Meta events are disabled")
+    if upsell_price:
+        config['upsell_price_id'] = SETTINGS['upsell']['price_id']
+        if not config['upsell_price_id']:
+            problems.append("STRIPE_UPSELL_PRICE_ID (upsell.price_id) is not set")
+    report_startup_problems(problems)
+    return config
+
+
+# --- Cold-start mode ---
+# FAST_COLD_START=true defers the Stripe SDK and requests imports (most of a function's
+# import time) to a background thread each function starts at the end of its module init,
+# so requests that never touch them (CORS preflight, /metrics) are served without waiting,
+# and the SDK loads while the browser sends the POST that follows a preflight. The first
+# Stripe call blocks until the SDK is loaded. Functions use this module's stripe.
+
+class LazyModule:
+    """Module proxy that imports the real module on first attribute access"""
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    object.__setattr__(self, '_module', importlib.import_module(self._name))
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+
+if os.environ.get('FAST_COLD_START', 'false').lower() == 'true':
+    requests = LazyModule('requests')
+    stripe = LazyModule('stripe')
+else:
+    import requests
+    import stripe
+
+
+def preload_lazy_modules():
+    for module in (stripe, requests):
+        if isinstance(module, LazyModule):
+            module.load()
+
+
+# IMPORT_TIME_BUDGET_MS: warn at cold start when loading a function module took longer
+def finish_module_load(module_name, started):
+    """End of a function module's init: check its import time (since the perf_counter value
+    started) against the budget and start the deferred imports. Returns the import time in seconds"""
+    seconds = time.perf_counter() - started
+    budget_ms = os.environ.get('IMPORT_TIME_BUDGET_MS', '1500')
+    if seconds * 1000 > float(budget_ms):
+        logging.warning("%s module import took %.0f ms (budget %s ms)", module_name, seconds * 1000, budget_ms)
+    if isinstance(stripe, LazyModule):
+        threading.Thread(target=preload_lazy_modules, name='preload-modules', daemon=True).start()
+    return seconds
+
+
+# --- Shared HTTP clients (kept alive across invocations on a warm instance) ---
+# HTTP_POOL_SIZE: max pooled connections per host
+# META_HTTP_TIMEOUT / STRIPE_HTTP_TIMEOUT: read timeouts in seconds
+# HTTP_CONNECT_TIMEOUT: TCP/TLS connect timeout in seconds
+# ASYNC_HTTP_MAX_CONNECTIONS: connection cap per outbound host for an event loop's httpx
+#   client (async entry points only; httpx is an optional dependency)
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+_stripe_configured = False
+_stripe_async_configured = False
+_async_http_clients = {}
+
+
+def get_http_session(name):
+    """Return a process-wide requests.Session with a keep-alive connection pool"""
+    session = _http_sessions.get(name)
+    if session is None:
+        with _http_sessions_lock:
+            session = _http_sessions.get(name)
+            if session is None:
+                pool_size = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.hooks['response'].append(
+                    lambda response, *args, **kwargs: record_outbound_call(name, response)
+                )
+                _http_sessions[name] = session
+    return session
+
+
+def http_timeout(env_name, default):
+    return (float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05')), float(os.environ.get(env_name, default)))
+
+
+def configure_stripe(api_key, async_client=False):
+    """Set the Stripe API key and pooled HTTP client once per process.
+
+    async_client=True also gives the SDK the httpx client its *_async methods use.
+    """
+    global _stripe_configured, _stripe_async_configured
+    if not _stripe_configured or (async_client and not _stripe_async_configured):
+        stripe.api_key = api_key
+        async_fallback_client = None
+        if async_client:
+            async_fallback_client = stripe.HTTPXClient(timeout=async_timeout('STRIPE_HTTP_TIMEOUT', '30'))
+            async_fallback_client._client_async = LoopAsyncHTTPClient('stripe')
+        stripe.default_http_client = stripe.RequestsClient(
+            timeout=http_timeout('STRIPE_HTTP_TIMEOUT', '30'),
+            session=get_http_session('stripe'),
+            async_fallback_client=async_fallback_client
+        )
+        _stripe_configured = True
+        _stripe_async_configured = async_client
+
+
+class LoopAsyncHTTPClient:
+    """Stands in for the httpx.AsyncClient inside stripe.HTTPXClient.
+
+    An httpx client only works on the event loop it first ran on; this one sends each request
+    through the running loop's pooled client (get_async_http_client) instead.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    async def request(self, *args, **kwargs):
+        return await get_async_http_client(self.name).request(*args, **kwargs)
+
+
+def get_http_pool_stats():
+    """Connection reuse per pooled host: requests sent vs. new connections opened"""
+    stats = {}
+    for name, session in list(_http_sessions.items()):
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = f"{name}:{pool.host}"
+                entry = stats.setdefault(host, {'requests': 0, 'connections': 0})
+                entry['requests'] += pool.num_requests
+                entry['connections'] += pool.num_connections
+    for entry in stats.values():
+        entry['reused'] = max(entry['requests'] - entry['connections'], 0)
+    return stats
+
+
+def get_async_http_client(name):
+    """Return the httpx.AsyncClient for an outbound service on the running event loop"""
+    import httpx  # Optional dependency, only needed by the async entry points
+    key = (name, asyncio.get_running_loop())
+    client = _async_http_clients.get(key)
+    if client is None:
+        max_connections = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+        client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=int(os.environ.get('HTTP_POOL_SIZE', '10'))
+        ))
+        _async_http_clients[key] = client
+    return client
+
+
+def async_timeout(env_name, default):
+    import httpx
+    connect, read = http_timeout(env_name, default)
+    return httpx.Timeout(read, connect=connect)
+
+
+async def call_async(service, operation, func, *args, **kwargs):
+    """Await an outbound call inside a client span and count it in the request summary"""
+    started = time.perf_counter()
+    try:
+        with trace_span(operation):
+            return await func(*args, **kwargs)
+    finally:
+        summary = _current_request_summary.get()
+        if summary is not None:
+            summary.record_call(service, (time.perf_counter() - started) * 1000)
+
+
+# --- Stripe Rate Limiting and Retries ---
+# Every Stripe API call takes a token from a token bucket first.
+# STRIPE_RATE_LIMIT_PER_SECOND: refill rate (default 0: no limit)
+# STRIPE_RATE_LIMIT_BURST: bucket size (default: one second of refill)
+# STRIPE_RATE_LIMIT_MAX_WAIT_SECONDS: longest a call waits for a token (default 2). After that
+#   the call fails with StripeThrottledError and the request is answered with 429.
+# STRIPE_RATE_LIMIT_BACKEND: "sqlite" shares one bucket (STRIPE_RATE_LIMIT_PATH) between all
+#   worker processes and functions on the host instead of one bucket per process.
+# Priorities: a call only takes a token while the bucket holds more than its reserve (a share of
+# the burst), so checkout.Session.create ("critical") keeps getting through while customer
+# lookups ("normal", the default) and webhook enrichment ("background") wait. One limiter
+# serves every function in the process.
+# STRIPE_RETRY_ATTEMPTS (default 3): attempts per call when Stripe answers 429 (rate_limit or
+#   lock_timeout); retries back off with full jitter from STRIPE_RETRY_BASE_SECONDS (default 0.25)
+#   up to STRIPE_RETRY_MAX_DELAY_SECONDS (default 2)
+
+STRIPE_PRIORITY_RESERVES = {'critical': 0.0, 'normal': 0.25, 'background': 0.5}
+STRIPE_DEFAULT_PRIORITY = 'normal'
+
+
+class StripeThrottledError(Exception):
+    """No rate limiter token within STRIPE_RATE_LIMIT_MAX_WAIT_SECONDS (the call was not made)"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Stripe API call throttled locally, retry in {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe in-process token bucket"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, reserve):
+        """Take a token if more than `reserve` are left; else return the seconds until one is"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens - 1 >= reserve:
+                self.tokens -= 1
+                return 0.0
+            return (reserve + 1 - self.tokens) / self.rate
+
+
+class SqliteTokenBucket:
+    """Token bucket in a local SQLite file, shared by every worker process on the host"""
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS token_bucket (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def take(self, reserve):
+        with closing(sqlite3.connect(self.path, timeout=5, isolation_level=None)) as conn:
+            conn.execute("BEGIN IMMEDIATE")  # Serializes the read-modify-write across processes
+            try:
+                now = time.time()
+                row = conn.execute("SELECT tokens, updated FROM token_bucket WHERE name = 'stripe'").fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+                wait = 0.0 if tokens - 1 >= reserve else (reserve + 1 - tokens) / self.rate
+                if not wait:
+                    tokens -= 1
+                conn.execute("INSERT OR REPLACE INTO token_bucket (name, tokens, updated) VALUES ('stripe', ?, ?)",
+                             (tokens, now))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
+
+
+class StripeRateLimiter:
+    """Hands out bucket tokens by priority and records the time callers spent throttled"""
+
+    def __init__(self, bucket, burst, max_wait):
+        self.bucket = bucket
+        self.burst = burst
+        self.max_wait = max_wait
+
+    def _next_wait(self, priority, started):
+        """0 once a token is taken, else how long to sleep before asking again"""
+        try:
+            # Never reserve the whole bucket, or a small burst would starve the lower priorities
+            wait = self.bucket.take(min(self.burst * STRIPE_PRIORITY_RESERVES[priority], self.burst - 1))
+        except sqlite3.Error as e:
+            logging.warning(f"Shared Stripe rate limiter unavailable, not throttling: {e}")
+            return 0.0
+        if wait and time.monotonic() - started + wait > self.max_wait:
+            METRICS.inc('stripe_throttled_total', {'priority': priority, 'outcome': 'rejected'})
+            raise StripeThrottledError(wait)
+        return wait
+
+    def _granted(self, priority, started):
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            METRICS.inc('stripe_throttled_total', {'priority': priority, 'outcome': 'delayed'})
+            METRICS.observe('stripe_throttle_wait_seconds', {'priority': priority}, waited)
+            summary = _current_request_summary.get()
+            if summary is not None:
+                summary.add(stripe_throttled_ms=round(waited * 1000, 1))
+
+    def acquire(self, priority):
+        started = time.monotonic()
+        while True:
+            wait = self._next_wait(priority, started)
+            if not wait:
+                break
+            time.sleep(wait)
+        self._granted(priority, started)
+
+    async def acquire_async(self, priority):
+        started = time.monotonic()
+        while True:
+            wait = self._next_wait(priority, started)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        self._granted(priority, started)
+
+
+_stripe_rate_limiter = None
+_stripe_rate_limiter_configured = False
+_stripe_rate_limiter_lock = threading.Lock()
+
+
+def get_stripe_rate_limiter():
+    """Return the process-wide Stripe rate limiter, or None when STRIPE_RATE_LIMIT_PER_SECOND is unset"""
+    global _stripe_rate_limiter, _stripe_rate_limiter_configured
+    if not _stripe_rate_limiter_configured:
+        with _stripe_rate_limiter_lock:
+            if not _stripe_rate_limiter_configured:
+                rate = float(os.environ.get('STRIPE_RATE_LIMIT_PER_SECOND', '0'))
+                if rate > 0:
+                    burst = max(1.0, float(os.environ.get('STRIPE_RATE_LIMIT_BURST', rate)))
+                    bucket = None
+                    if os.environ.get('STRIPE_RATE_LIMIT_BACKEND', '') == 'sqlite':
+                        try:
+                            bucket = SqliteTokenBucket(os.environ.get('STRIPE_RATE_LIMIT_PATH', '/tmp/stripe_rate_limit.sqlite3'),
+                                                       rate, burst)
+                        except sqlite3.Error as e:
+                            logging.warning(f"Shared Stripe rate limiter unavailable, using a per-process bucket: {e}")
+                    _stripe_rate_limiter = StripeRateLimiter(
+                        bucket or TokenBucket(rate, burst), burst,
+                        float(os.environ.get('STRIPE_RATE_LIMIT_MAX_WAIT_SECONDS', '2'))
+                    )
+                _stripe_rate_limiter_configured = True
+    return _stripe_rate_limiter
+
+
+def stripe_retry_delays():
+    """Full-jitter backoff before each retry of a call Stripe answered with 429"""
+    attempts = max(1, int(os.environ.get('STRIPE_RETRY_ATTEMPTS', '3')))
+    base = float(os.environ.get('STRIPE_RETRY_BASE_SECONDS', '0.25'))
+    cap = float(os.environ.get('STRIPE_RETRY_MAX_DELAY_SECONDS', '2'))
+    return [random.uniform(0, min(cap, base * 2 ** attempt)) for attempt in range(attempts - 1)]
+
+
+def should_retry_stripe(operation, error, delays):
+    """Count and log a Stripe 429; False when no retries are left"""
+    if not delays:
+        return False
+    code = error.code or 'rate_limit'
+    METRICS.inc('stripe_retries_total', {'operation': operation, 'code': code})
+    logging.warning("Stripe %s answered 429 (%s), retrying in %.2fs", operation, code, delays[0])
+    return True
+
+
+def call_stripe(operation, func, *args, priority=None, **kwargs):
+    """Make a Stripe API call through the rate limiter, retrying 429s (rate_limit, lock_timeout) with jitter"""
+    priority = priority or STRIPE_DEFAULT_PRIORITY
+    limiter = get_stripe_rate_limiter()
+    delays = stripe_retry_delays()
+    while True:
+        if limiter is not None:
+            limiter.acquire(priority)
+        try:
+            with trace_span(operation, priority=priority):
+                return func(*args, **kwargs)
+        except stripe.error.RateLimitError as e:
+            if not should_retry_stripe(operation, e, delays):
+                raise
+            time.sleep(delays.pop(0))
+
+
+async def call_stripe_async(operation, func, *args, priority=None, **kwargs):
+    """call_stripe for the *_async Stripe methods"""
+    priority = priority or STRIPE_DEFAULT_PRIORITY
+    limiter = get_stripe_rate_limiter()
+    delays = stripe_retry_delays()
+    while True:
+        if limiter is not None:
+            await limiter.acquire_async(priority)
+        try:
+            return await call_async('stripe', operation, func, *args, **kwargs)
+        except stripe.error.RateLimitError as e:
+            if not should_retry_stripe(operation, e, delays):
+                raise
+            await asyncio.sleep(delays.pop(0))
+
+
+def stripe_rate_limited(error, headers):
+    """Answer a request that hit the Stripe rate limit (locally or at Stripe) with 429 instead of 500"""
+    logging.warning(f"Stripe rate limit reached, answering 429: {error}")
+    retry_after = str(max(1, round(getattr(error, 'retry_after', 1))))
+    return {'error': 'Too many requests, please try again shortly'}, 429, {**headers, 'Retry-After': retry_after}
+
+
+# --- Runtimes (one handler implementation for the Flask and ASGI entry points) ---
+# Handlers served by both entry points are coroutines that do their outbound I/O through
+# the runtime they are given. SYNC_RUNTIME calls the pooled blocking clients, so awaiting it
+# never suspends and the Flask entry point runs the coroutine on its own thread (run_sync).
+# ASYNC_RUNTIME awaits the SDK's *_async methods and the event loop's httpx client, so the
+# ASGI entry point holds no thread while a request waits on Stripe or Meta.
+
+class SyncRuntime:
+    """Outbound I/O on the pooled requests sessions (blocks the calling thread)"""
+
+    is_async = False
+
+    @property
+    def timeout_errors(self):
+        return (requests.exceptions.Timeout,)
+
+    async def call_stripe(self, operation, func, *args, **kwargs):
+        return call_stripe(operation, func, *args, **kwargs)
+
+    async def post(self, service, url, timeout, **kwargs):
+        """POST on the pooled session for service; timeout is (connect, read) in seconds"""
+        return get_http_session(service).post(url, timeout=timeout, **kwargs)
+
+    async def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def wait(self, future, timeout=None):
+        """Result of a concurrent.futures.Future; TimeoutError after timeout seconds"""
+        return future.result(timeout)
+
+
+class AsyncRuntime:
+    """Outbound I/O on the running event loop"""
+
+    is_async = True
+
+    @property
+    def timeout_errors(self):
+        import httpx
+        return (httpx.TimeoutException,)
+
+    async def call_stripe(self, operation, func, *args, **kwargs):
+        """func is the sync SDK method (e.g. stripe.Customer.list); its *_async twin is awaited"""
+        return await call_stripe_async(operation, getattr(func.__self__, f"{func.__name__}_async"), *args, **kwargs)
+
+    async def post(self, service, url, timeout, **kwargs):
+        import httpx
+        connect, read = timeout
+        return await call_async(service, f"{service}.post", get_async_http_client(service).post, url,
+                                timeout=httpx.Timeout(read, connect=connect), **kwargs)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, future, timeout=None):
+        # Shielded: a timeout must not cancel a future other callers share
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+
+
+SYNC_RUNTIME = SyncRuntime()
+ASYNC_RUNTIME = AsyncRuntime()
+
+
+def run_sync(coroutine):
+    """Run a coroutine that only awaits SYNC_RUNTIME (it never suspends) to completion"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    coroutine.close()
+    raise RuntimeError(f"{coroutine.__qualname__} suspended; run_sync only drives SYNC_RUNTIME I/O")
+
+
+# --- Stripe Idempotency Keys ---
+# IDEMPOTENCY_WINDOW_SECONDS: identical Checkout Session and customer-create requests inside
+#   this window reuse the same Stripe object (see checkout_session_idempotency_key); customer
+#   updates are only deduplicated within one request (request_idempotency_key)
+
+IDEMPOTENCY_WINDOW_SECONDS = int(os.environ.get('IDEMPOTENCY_WINDOW_SECONDS', '60'))
+
+
+def idempotency_key(operation, params, window=None):
+    """Deterministic Stripe idempotency key: identical requests (within the same window) share it"""
+    material = json.dumps(params, sort_keys=True, default=str)
+    if window:
+        material += f"|{int(time.time() // window)}"
+    return f"{operation}-{hashlib.sha256(material.encode()).hexdigest()[:40]}"
+
+
+def request_idempotency_key(operation, params):
+    """Key scoped to the current request: its own retries share it, later requests never do"""
+    span = _current_span.get()
+    if span is None:
+        return None
+    return idempotency_key(operation, [span.trace_id, params])
+
+
+def checkout_session_idempotency_key(session_data, client_request_id=None):
+    """Key shared by repeated clicks of one visitor within IDEMPOTENCY_WINDOW_SECONDS, or None.
+
+    Without a customer or email only the client's per-attempt client_request_id tells visitors
+    apart; keying on the rest of session_data would let visitors behind one IP share a session.
+    """
+    if not client_request_id and not (session_data.get('customer') or session_data.get('customer_email')):
+        return None
+    return idempotency_key('checkout-session', [session_data, client_request_id], window=IDEMPOTENCY_WINDOW_SECONDS)
+
+
+# --- Signed Funnel Token ---
+# Each funnel step hands the next one a compact token carrying the Stripe customer ID, email,
+# locale, funnel and Meta tracking IDs (fbc/fbp/fbclid), signed with CUSTOMER_TOKEN_SECRET (the
+# same secret must be set on both checkout functions). A later step that gets a valid token
+# trusts it instead of looking the customer up in Stripe again, and falls back to the lookups
+# when the token is missing, invalid or expired. Tokens expire after CUSTOMER_TOKEN_TTL_SECONDS
+# (default 24 hours). Tokens from before the locale/funnel/tracking claims still verify.
+
+FUNNEL_TOKEN_TRACKING_FIELDS = ('fbc', 'fbp', 'fbclid')
+
+
+def normalize_email(email):
+    """The form emails are compared and hashed in (funnel tokens, customer locks, Meta user data)"""
+    return email.strip().lower()
+
+
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64url_decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def sign_token_payload(payload, secret):
+    return b64url_encode(hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest())
+
+
+def issue_funnel_token(customer_id, email, locale='', funnel='', metadata=None):
+    """Signed token for the next funnel step, or None when CUSTOMER_TOKEN_SECRET is not set"""
+    secret = os.environ.get('CUSTOMER_TOKEN_SECRET')
+    if not secret or not customer_id:
+        return None
+    ttl = int(os.environ.get('CUSTOMER_TOKEN_TTL_SECONDS', '86400'))
+    # Expiry is rounded down to the hour so repeated clicks build the same return_url
+    # and keep sharing the Checkout Session idempotency key
+    expires_at = int(time.time()) // 3600 * 3600 + ttl
+    claims = {'c': customer_id, 'e': email or '', 'x': expires_at}
+    if locale:
+        claims['l'] = locale
+    if funnel:
+        claims['f'] = funnel
+    tracking = {field: (metadata or {}).get(field) for field in FUNNEL_TOKEN_TRACKING_FIELDS}
+    tracking = {field: value for field, value in tracking.items() if value}
+    if tracking:
+        claims['t'] = tracking
+    payload = b64url_encode(json.dumps(claims, separators=(',', ':')).encode())
+    return f"{payload}.{sign_token_payload(payload, secret)}"
+
+
+def verify_funnel_token(token):
+    """Return the claims of a valid, unexpired funnel token, else None"""
+    secret = os.environ.get('CUSTOMER_TOKEN_SECRET')
+    if not secret or not isinstance(token, str) or '.' not in token:
+        return None
+    payload, signature = token.rsplit('.', 1)
+    try:
+        # Bytes: compare_digest rejects non-ASCII str arguments with a TypeError
+        if not hmac.compare_digest(signature.encode(), sign_token_payload(payload, secret).encode()):
+            logging.warning("Funnel token signature mismatch")
+            return None
+        claims = json.loads(b64url_decode(payload))
+        if claims.get('x', 0) < time.time():
+            logging.info("Funnel token expired")
+            return None
+        tracking = claims.get('t', {})
+        if not isinstance(tracking, dict):
+            raise TypeError("tracking claim is not an object")
+    except (TypeError, ValueError, AttributeError) as e:
+        # Malformed payload (not base64/JSON/an object) or a claim of the wrong type
+        logging.warning(f"Invalid funnel token: {e}")
+        return None
+    return {
+        'customer_id': claims.get('c'),
+        'email': claims.get('e') or None,
+        'locale': claims.get('l', ''),
+        'funnel': claims.get('f', ''),
+        'tracking': tracking
+    }
+
+
+def fill_tracking_from_token(metadata, claims):
+    """Fill in the tracking IDs the request did not send; values from the request win"""
+    for field, value in claims['tracking'].items():
+        if field in FUNNEL_TOKEN_TRACKING_FIELDS and not metadata.get(field):
+            metadata[field] = value
+
+
+def read_funnel_token(data, email):
+    """Claims of the token sent with a checkout request, if it was issued for that email"""
+    # customer_token is the field name from before the token carried funnel claims
+    claims = verify_funnel_token(data.get('funnel_token') or data.get('customer_token'))
+    if claims and email and normalize_email(claims['email'] or '') != normalize_email(email):
+        logging.info("Funnel token was issued for another email, resolving the customer again")
+        return None
+    return claims
+
+
+# --- Customer Cache (email -> customer ID, customer ID -> Customer) ---
+# CUSTOMER_CACHE_TTL_SECONDS / CUSTOMER_CACHE_MAX_ENTRIES: in-process LRU limits
+# CUSTOMER_CACHE_BACKEND: optional shared second level for all workers on the host:
+#   "sqlite" - local file at CUSTOMER_CACHE_PATH (stand-in for a shared cache)
+#   "redis"  - CUSTOMER_CACHE_REDIS_URL (requires the redis package)
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SqliteCacheBackend:
+    """Shared cache in a local SQLite file, visible to every worker process on the host"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def get(self, key):
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn:
+            row = conn.execute("SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), time.time() + self.ttl))
+
+    def delete(self, key):
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCacheBackend:
+    """Shared cache in Redis"""
+
+    def __init__(self, url, ttl):
+        import redis  # Optional dependency, only needed for this backend
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value else None
+
+    def set(self, key, value):
+        self.client.setex(key, int(self.ttl), json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class CustomerCache:
+    """Two-level cache for Stripe customers: in-process LRU first, then the optional shared backend"""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                logging.warning(f"Shared customer cache read failed: {e}")
+            if value is not None:
+                self.local.set(key, value)
+        self.stats['hits' if value is not None else 'misses'] += 1
+        return value
+
+    def _set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value)
+            except Exception as e:
+                logging.warning(f"Shared customer cache write failed: {e}")
+
+    def _delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception as e:
+                logging.warning(f"Shared customer cache delete failed: {e}")
+
+    def get_customer(self, customer_id):
+        data = self._get(f"customer:{customer_id}")
+        return stripe.Customer.construct_from(data, stripe.api_key) if data else None
+
+    def get_customer_by_email(self, email):
+        customer_id = self._get(f"email:{email.strip()}")
+        return self.get_customer(customer_id) if customer_id else None
+
+    def put(self, customer):
+        """Store a customer fetched from or returned by Stripe (create/modify write through here)"""
+        self._set(f"customer:{customer.id}", customer.to_dict())
+        if customer.get('email'):
+            self._set(f"email:{customer.email.strip()}", customer.id)
+
+    def invalidate(self, customer_id=None, email=None):
+        if customer_id:
+            self._delete(f"customer:{customer_id}")
+        if email:
+            self._delete(f"email:{email.strip()}")
+
+
+_customer_cache = None
+_customer_cache_lock = threading.Lock()
+
+
+def get_customer_cache():
+    """Return the process-wide customer cache configured from the environment"""
+    global _customer_cache
+    if _customer_cache is None:
+        with _customer_cache_lock:
+            if _customer_cache is None:
+                ttl = float(os.environ.get('CUSTOMER_CACHE_TTL_SECONDS', '300'))
+                local = TTLCache(int(os.environ.get('CUSTOMER_CACHE_MAX_ENTRIES', '1024')), ttl)
+                shared = None
+                backend = os.environ.get('CUSTOMER_CACHE_BACKEND', '')
+                try:
+                    if backend == 'sqlite':
+                        shared = SqliteCacheBackend(os.environ.get('CUSTOMER_CACHE_PATH', '/tmp/customer_cache.sqlite3'), ttl)
+                    elif backend == 'redis':
+                        shared = RedisCacheBackend(os.environ['CUSTOMER_CACHE_REDIS_URL'], ttl)
+                except Exception as e:
+                    logging.warning(f"Shared customer cache '{backend}' unavailable, using in-process cache only: {e}")
+                _customer_cache = CustomerCache(local, shared)
+    return _customer_cache
+
+
+async def find_customer_by_email(runtime, email):
+    """Return the Stripe customer for an email (or None), served from cache when possible"""
+    cache = get_customer_cache()
+    customer = cache.get_customer_by_email(email)
+    if customer is not None:
+        logging.info("Customer cache hit for email lookup: %s", customer.id)
+        summarize_request(customer_cache='hit')
+        return customer
+    
+    customers = await runtime.call_stripe('stripe.Customer.list', stripe.Customer.list, email=email, limit=1)
+    if not customers.data:
+        return None
+    cache.put(customers.data[0])
+    return customers.data[0]
+
+
+async def retrieve_customer(runtime, customer_id):
+    """Return the Stripe customer by ID, served from cache when possible"""
+    cache = get_customer_cache()
+    customer = cache.get_customer(customer_id)
+    if customer is None:
+        customer = await runtime.call_stripe('stripe.Customer.retrieve', stripe.Customer.retrieve, customer_id)
+        cache.put(customer)
+    return customer
+
+
+async def create_customer(runtime, **params):
+    """Create a Stripe customer and write it through to the cache"""
+    cache = get_customer_cache()
+    cache.invalidate(email=params.get('email'))
+    customer = await runtime.call_stripe(
+        'stripe.Customer.create', stripe.Customer.create,
+        **params, idempotency_key=idempotency_key('customer-create', params, window=IDEMPOTENCY_WINDOW_SECONDS)
+    )
+    cache.put(customer)
+    return customer
+
+
+async def modify_customer(runtime, customer_id, **params):
+    """Update a Stripe customer and refresh its cache entry"""
+    cache = get_customer_cache()
+    cache.invalidate(customer_id=customer_id)
+    customer = await runtime.call_stripe(
+        'stripe.Customer.modify', stripe.Customer.modify,
+        customer_id, **params, idempotency_key=request_idempotency_key('customer-modify', [customer_id, params])
+    )
+    cache.put(customer)
+    return customer
+
+
+# --- Meta Event Templates ---
+# Each catalog entry in meta_events is compiled once into a template holding the static
+# envelope and custom_data; building an event only adds the per-event fields.
+
+class MetaEventTemplate:
+    """Precompiled Conversions API event (the shared static values must not be mutated)"""
+
+    __slots__ = ('event_name', 'custom_data')
+
+    def __init__(self, event_name, custom_data):
+        self.event_name = event_name
+        self.custom_data = custom_data
+
+    def build(self, event_id, user_data, **custom_fields):
+        return {
+            "event_name": self.event_name,
+            "event_time": int(time.time()),
+            "event_id": event_id,
+            **META_EVENT_ENVELOPE,
+            "user_data": user_data,
+            "custom_data": {**self.custom_data, **custom_fields}
+        }
+
+
+def compile_meta_event_templates(settings):
+    return {
+        name: MetaEventTemplate(template['event_name'], thaw_settings(template['custom_data']))
+        for name, template in settings['meta_events'].items()
+    }
+
+
+META_EVENT_ENVELOPE = {"event_source_url": SETTINGS['site_url'], "action_source": "website"}
+META_EVENT_TEMPLATES = compile_meta_event_templates(SETTINGS)
+
+
+# --- Meta Circuit Breaker and Adaptive Timeouts ---
+# Every Conversions API request goes through one process-wide breaker. It opens after
+# META_BREAKER_FAILURE_THRESHOLD consecutive failures (default 5): timeouts, connection
+# errors, 5xx/429 responses, or calls slower than META_BREAKER_SLOW_CALL_SECONDS (default 5).
+# While open, calls are rejected without touching the network. After META_BREAKER_OPEN_SECONDS
+# (default 30) one probe request is let through (half-open). Its outcome closes or reopens the breaker.
+# The read timeout follows recent latency: the META_TIMEOUT_PERCENTILE (default 0.99) of the
+# last META_TIMEOUT_WINDOW successful calls times META_TIMEOUT_MULTIPLIER (default 3), clamped
+# to [META_TIMEOUT_MIN_SECONDS, META_HTTP_TIMEOUT]. Until META_TIMEOUT_MIN_SAMPLES calls have
+# been seen, it is META_HTTP_TIMEOUT.
+# META_BREAKER_ENABLED: "false" for the fixed META_HTTP_TIMEOUT and no breaker
+
+META_CIRCUIT_OPEN = 'circuit open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker that also derives a read timeout from recent latency"""
+
+    def __init__(self, name, failure_threshold=5, open_seconds=30.0, slow_call_seconds=5.0,
+                 max_timeout=10.0, min_timeout=1.0, percentile=0.99, multiplier=3.0,
+                 window=200, min_samples=20, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.clock = clock
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def rejecting(self):
+        """True when a call made now would be rejected (open, or half-open with its probe in flight)"""
+        with self._lock:
+            self._maybe_half_open()
+            return self.state == 'open' or (self.state == 'half_open' and self._probe_in_flight)
+
+    def allow(self):
+        """Claim a call: always allowed when closed, one probe at a time when half-open"""
+        with self._lock:
+            self._maybe_half_open()
+            if self.state == 'open' or (self.state == 'half_open' and self._probe_in_flight):
+                return False
+            if self.state == 'half_open':
+                self._probe_in_flight = True
+            return True
+
+    def record(self, healthy, seconds):
+        """Report an allowed call's outcome; a healthy but slow call counts as a failure"""
+        with self._lock:
+            if healthy:
+                self._latencies.append(seconds)
+            if healthy and (self.slow_call_seconds is None or seconds <= self.slow_call_seconds):
+                self._failures = 0
+                if self.state != 'closed':
+                    self._transition('closed')
+            else:
+                self._failures += 1
+                if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                    self._opened_at = self.clock()
+                    self._transition('open')
+            self._probe_in_flight = False
+
+    def timeout(self):
+        """Read timeout in seconds for the next call"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.max_timeout
+            ordered = sorted(self._latencies)
+        value = ordered[min(int(len(ordered) * self.percentile), len(ordered) - 1)] * self.multiplier
+        return min(max(value, self.min_timeout), self.max_timeout)
+
+    def snapshot(self):
+        with self._lock:
+            return {'state': self.state, 'consecutive_failures': self._failures, 'samples': len(self._latencies)}
+
+    def _maybe_half_open(self):
+        if self.state == 'open' and self.clock() - self._opened_at >= self.open_seconds:
+            self._transition('half_open')
+
+    def _transition(self, state):
+        logging.warning("%s circuit breaker %s -> %s (consecutive failures: %s)",
+                        self.name, self.state, state, self._failures)
+        METRICS.inc('circuit_breaker_transitions_total', {'service': self.name, 'state': state})
+        self.state = state
+
+
+_meta_breaker = None
+_meta_breaker_lock = threading.Lock()
+
+
+def get_meta_breaker():
+    """Return the process-wide Meta breaker, or None when META_BREAKER_ENABLED is "false" """
+    global _meta_breaker
+    if os.environ.get('META_BREAKER_ENABLED', 'true').lower() != 'true':
+        return None
+    if _meta_breaker is None:
+        with _meta_breaker_lock:
+            if _meta_breaker is None:
+                slow_call_seconds = float(os.environ.get('META_BREAKER_SLOW_CALL_SECONDS', '5'))
+                _meta_breaker = CircuitBreaker(
+                    'meta',
+                    failure_threshold=int(os.environ.get('META_BREAKER_FAILURE_THRESHOLD', '5')),
+                    open_seconds=float(os.environ.get('META_BREAKER_OPEN_SECONDS', '30')),
+                    slow_call_seconds=slow_call_seconds if slow_call_seconds > 0 else None,
+                    max_timeout=float(os.environ.get('META_HTTP_TIMEOUT', '10')),
+                    min_timeout=float(os.environ.get('META_TIMEOUT_MIN_SECONDS', '1')),
+                    percentile=float(os.environ.get('META_TIMEOUT_PERCENTILE', '0.99')),
+                    multiplier=float(os.environ.get('META_TIMEOUT_MULTIPLIER', '3')),
+                    window=int(os.environ.get('META_TIMEOUT_WINDOW', '200')),
+                    min_samples=int(os.environ.get('META_TIMEOUT_MIN_SAMPLES', '20'))
+                )
+    return _meta_breaker
+
+
+def meta_response_healthy(status_code):
+    """Whether a Meta response says the API itself is fine (a rejected event is still a healthy answer)"""
+    return status_code < 500 and status_code != 429
+
+
+async def post_to_meta(runtime, url, **kwargs):
+    """POST to the Graph API through the Meta breaker, with its adaptive read timeout"""
+    breaker = get_meta_breaker()
+    connect_timeout, read_timeout = http_timeout('META_HTTP_TIMEOUT', '10')
+    if breaker is None:
+        return await runtime.post('meta', url, (connect_timeout, read_timeout), **kwargs)
+    if not breaker.allow():
+        METRICS.inc('circuit_breaker_rejected_total', {'service': 'meta'})
+        raise CircuitOpenError(META_CIRCUIT_OPEN)
+    started = time.monotonic()
+    try:
+        response = await runtime.post('meta', url, (connect_timeout, breaker.timeout()), **kwargs)
+    except BaseException:
+        breaker.record(False, time.monotonic() - started)
+        raise
+    breaker.record(meta_response_healthy(response.status_code), time.monotonic() - started)
+    return response
+
+
+# --- Meta Delivery and Batching ---
+# deliver_meta_events posts events to the Conversions API in one request, on the caller's
+# runtime. Events produced by one request are always sent together; set
+# META_BATCH_MAX_WAIT_MS > 0 to also coalesce events from concurrent requests (flushed at
+# META_BATCH_MAX_SIZE events or after META_BATCH_MAX_WAIT_MS, whichever comes first).
+
+# Conversions API accepts up to 1000 events per request
+META_MAX_EVENTS_PER_REQUEST = 1000
+
+
+class MetaEventResult:
+    """Delivery result for one event handed to MetaEventBatcher"""
+
+    def __init__(self, event_id):
+        self.event_id = event_id
+        self.ok = None
+        self.error = None
+        self._done = Future()
+
+    def set(self, ok, error=None):
+        self.ok = ok
+        self.error = error
+        self._done.set_result(ok)
+
+    async def wait_on(self, runtime, timeout=None):
+        """Wait until the batch holding this event was sent. Returns True if Meta accepted it"""
+        try:
+            return await runtime.wait(self._done, timeout)
+        except TimeoutError:
+            self.error = 'timed out waiting for batch flush'
+            return False
+
+    def wait(self, timeout=None):
+        return run_sync(self.wait_on(SYNC_RUNTIME, timeout))
+
+
+class MetaEventBatcher:
+    """Collects events from concurrent requests and posts them together.
+
+    A batch is flushed when it holds max_size events or when its oldest event
+    has waited max_wait seconds, whichever comes first.
+    """
+
+    def __init__(self, deliver, max_size=META_MAX_EVENTS_PER_REQUEST, max_wait=0.05):
+        self.deliver = deliver
+        self.max_size = min(max_size, META_MAX_EVENTS_PER_REQUEST)
+        self.max_wait = max_wait
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, events):
+        """Queue events (kept in the same batch) and return their MetaEventResult handles"""
+        results = [MetaEventResult(event['event_id']) for event in events]
+        batch = None
+        with self._lock:
+            self._pending.extend(zip(events, results))
+            if len(self._pending) >= self.max_size:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._send(batch)
+        return results
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        self._send(batch)
+
+    def _take(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _send(self, batch):
+        for start in range(0, len(batch), self.max_size):
+            chunk = batch[start:start + self.max_size]
+            try:
+                outcomes = self.deliver([event for event, _ in chunk])
+            except Exception as e:
+                outcomes = [(False, str(e))] * len(chunk)
+            for (_, result), (ok, error) in zip(chunk, outcomes):
+                result.set(ok, error)
+
+
+async def deliver_meta_events(runtime, events, config):
+    """POST events to Meta Conversions API in one request. Returns (ok, error message) per event.
+
+    config is the calling function's STARTUP_CONFIG (loaded with meta=True).
+    """
+    event_names = ', '.join(event['event_name'] for event in events)
+    url = f"{config['meta_graph_api_base']}/{config['meta_pixel_id']}/events?access_token={config['meta_access_token']}"
+    try:
+        with trace_span('meta.events', events=len(events)):
+            response = await post_to_meta(runtime, url, json={"data": events})
+            response.raise_for_status()
+        for event in events:
+            logging.info("Successfully sent '%s' to Meta. Event ID: %s", event['event_name'], event['event_id'])
+        result = response.json()
+        if 'events_received' in result:
+            meta_log.debug("Meta confirmed events received: %s", result['events_received'])
+        return [(True, None)] * len(events)
+    except CircuitOpenError:
+        logging.warning("Meta circuit open, not sending '%s'", event_names)
+        return [(False, META_CIRCUIT_OPEN)] * len(events)
+    except Exception as e:
+        if isinstance(e, runtime.timeout_errors):
+            logging.error(f"Timeout sending '{event_names}' to Meta")
+            return [(False, 'timeout')] * len(events)
+        logging.error(f"Failed to send '{event_names}' to Meta: {e}")
+        response = getattr(e, 'response', None)
+        if response is None:
+            return [(False, str(e))] * len(events)
+        logging.error(f"Meta API response: {response.text}")
+        # One invalid event makes Meta reject the whole request; split the
+        # batch so the valid events still go through and the bad one is isolated
+        if response.status_code == 400 and len(events) > 1:
+            middle = len(events) // 2
+            return (await deliver_meta_events(runtime, events[:middle], config)
+                    + await deliver_meta_events(runtime, events[middle:], config))
+        return [(False, f"{e}: {response.text[:500]}")] * len(events)
+
+
+_meta_batcher = None
+_meta_batcher_lock = threading.Lock()
+
+
+def get_meta_batcher(config):
+    """Return the process-wide batcher, or None when cross-request batching is disabled.
+
+    Its batches are posted with the Meta settings in config (the same environment variables
+    configure every function in the process).
+    """
+    global _meta_batcher
+    max_wait_ms = int(os.environ.get('META_BATCH_MAX_WAIT_MS', '0'))
+    if max_wait_ms <= 0:
+        return None
+    if _meta_batcher is None:
+        with _meta_batcher_lock:
+            if _meta_batcher is None:
+                _meta_batcher = MetaEventBatcher(
+                    lambda events: run_sync(deliver_meta_events(SYNC_RUNTIME, events, config)),
+                    max_size=int(os.environ.get('META_BATCH_MAX_SIZE', META_MAX_EVENTS_PER_REQUEST)),
+                    max_wait=max_wait_ms / 1000.0
+                )
+    return _meta_batcher
+
+
+# --- Async (ASGI) entry points ---
+# Helpers shared by the *_async entry points (Starlette request in, Starlette response
+# out); starlette comes with the ASGI runtime and is only imported there.
+
+def asgi_response(result):
+    """Turn a Flask-style return value ((body, status, headers) tuple or body) into a Starlette response"""
+    from starlette.responses import JSONResponse, Response
+    if not isinstance(result, tuple):
+        result = (result,)
+    body, status, headers = result + (200, None)[len(result) - 1:]
+    if isinstance(body, (dict, list)):
+        return JSONResponse(body, status_code=status, headers=headers)
+    return Response(body, status_code=status, headers=headers, media_type='text/html')
+
+
+def summarized_request_async(request_log):
+    """summarized_request for async entry points: Starlette request in, Starlette response out"""
+    def decorate(func):
+        @wraps(func)
+        async def wrapper(request):
+            if is_metrics_request(request):
+                return asgi_response(metrics_response(request))
+            summary = RequestSummary(func.__name__, request_log)
+            status = 500
+            try:
+                with use_request_summary(summary), \
+                        trace_span(func.__name__, kind='server', **{'http.status_code': status}) as span:
+                    summary.set(trace_id=span.trace_id)
+                    response = asgi_response(await func(request))
+                    status = span.attributes['http.status_code'] = response.status_code
+                return response
+            finally:
+                summary.emit(status)
+        return wrapper
+    return decorate
+
+
+class BufferedRequest:
+    """The parts of a Flask request the handler reads, over a Starlette request and its body"""
+
+    def __init__(self, request, body):
+        self.method = request.method
+        self.headers = request.headers
+        self.remote_addr = request.client.host if request.client else None
+        self.data = body
+
+    def get_json(self, silent=False):
+        try:
+            return json.loads(self.data)
+        except ValueError:
+            if silent:
+                return None
+            raise
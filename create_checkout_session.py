@@ -1,20 +1,44 @@
+import time
+MODULE_LOAD_STARTED = time.perf_counter()  # Checked against the import-time budget at the end
+
 import os
-import stripe
+import fcntl
 import logging
 import functions_framework
-from flask import request, jsonify, make_response
-import time
+from flask import request, make_response
 import hashlib
-import requests
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from common import (
+    ASYNC_RUNTIME, BufferedRequest, call_stripe, checkout_session_idempotency_key,
+    configure_stripe, create_customer, deliver_meta_events, fill_tracking_from_token,
+    find_customer_by_email, finish_module_load, get_meta_batcher, get_meta_breaker,
+    idempotency_key, IDEMPOTENCY_WINDOW_SECONDS, issue_funnel_token, load_startup_config,
+    META_EVENT_TEMPLATES, modify_customer, normalize_email, read_funnel_token,
+    RedisCacheBackend, run_sync, SETTINGS, SqliteCacheBackend, stripe, stripe_rate_limited,
+    StripeThrottledError, summarize_request, summarized_request, summarized_request_async,
+    SYNC_RUNTIME, TTLCache,
+)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# --- Structured Logging ---
+# Formats, sampling and PII redaction are set up in common.py (LOG_FORMAT, LOG_LEVEL,
+# LOG_SAMPLE_RATES, LOG_REDACT_PII). Every request emits a single summary record on the
+# "checkout.request" logger; per-field tracking lines go to
+# "checkout.detail" at DEBUG.
 
-# Helper function to send Lead event to Meta
-def send_lead_to_meta(email, metadata):
-    """Send Lead event to Meta Conversions API"""
-    META_PIXEL_ID = os.environ.get('META_PIXEL_ID')
-    META_ACCESS_TOKEN = os.environ.get('META_ACCESS_TOKEN')
+detail_log = logging.getLogger('checkout.detail')
+request_log = logging.getLogger('checkout.request')
+
+
+# Settings this function cannot run without, validated once per process at module init
+STARTUP_CONFIG = load_startup_config(meta=True)
+
+
+# Helper functions to send Lead event to Meta
+def build_lead_event(email, metadata):
+    """Lead event for Meta Conversions API, or None when Meta is not configured"""
+    META_PIXEL_ID = STARTUP_CONFIG['meta_pixel_id']
+    META_ACCESS_TOKEN = STARTUP_CONFIG['meta_access_token']
     
     # Only proceed if Meta is configured
     if not META_PIXEL_ID or not META_ACCESS_TOKEN:
@@ -31,7 +55,7 @@ def send_lead_to_meta(email, metadata):
         # Convert fbclid to fbc format
         fbc = f"fb.1.{int(time.time() * 1000)}.{metadata['fbclid']}"
         user_data["fbc"] = fbc
-        logging.info(f"Adding fbc to Lead event: {fbc}")
+        detail_log.debug("Adding fbc to Lead event: %s", fbc)
     
     # Add client IP if available
     if metadata.get('client_ip'):
@@ -41,48 +65,377 @@ def send_lead_to_meta(email, metadata):
     if metadata.get('user_agent'):
         user_data["client_user_agent"] = metadata['user_agent']
     
-    # Build payload
-    payload = {
-        "data": [{
-            "event_name": "Lead",
-            "event_time": int(time.time()),
-            "event_id": f"lead_{email}_{int(time.time())}",
-            "event_source_url": "https://captainenglish.com",
-            "action_source": "website",
-            "user_data": user_data,
-            "custom_data": {
-                "content_name": "Email Signup",
-                "content_category": "Lead Generation",
-                "value": 0.0,
-                "currency": "USD",
-                "lead_source": metadata.get('source', 'email_capture_step'),
-                "locale": metadata.get('locale', '')
-            }
-        }]
+    # Build event
+    return META_EVENT_TEMPLATES['lead'].build(
+        f"lead_{email}_{int(time.time())}",
+        user_data,
+        lead_source=metadata.get('source', 'email_capture_step'),
+        locale=metadata.get('locale', '')
+    )
+
+
+async def send_lead_to_meta(runtime, email, metadata):
+    """Send Lead event to Meta Conversions API"""
+    event = build_lead_event(email, metadata)
+    if event is None:
+        return
+    
+    # Meta is degraded: skip the lead instead of holding the checkout on it
+    breaker = get_meta_breaker()
+    if breaker is not None and breaker.rejecting():
+        logging.error("Meta circuit open, Lead event for %s not sent", email)
+        return False
+    
+    # Send to Meta (batched with other requests' events when enabled)
+    batcher = get_meta_batcher(STARTUP_CONFIG)
+    if batcher:
+        result = batcher.add([event])[0]
+        ok = await result.wait_on(runtime, timeout=batcher.max_wait + 15)
+        if not ok:
+            logging.error(f"Failed to send Lead to Meta: {result.error}")
+    else:
+        ok, _ = (await deliver_meta_events(runtime, [event], STARTUP_CONFIG))[0]
+    if ok:
+        logging.info("Successfully sent Lead event to Meta for %s", email)
+    return ok
+
+
+# --- Single-flight Customer Find-or-Create ---
+# Concurrent find-or-create calls for the same normalized email (double clicks, the lead step
+# racing the checkout step) share one Stripe lookup and at most one create: the first caller
+# does the work and the others in this process wait for its result.
+# CUSTOMER_LOCK_DIR: also serialize them across worker processes on the host through striped
+#   flock files in this directory (default: in-process only). A worker that waited finds the
+#   customer the other one created through the shared customer cache (CUSTOMER_CACHE_BACKEND)
+#   or one Customer.list, never a second create.
+# CUSTOMER_LOCK_TIMEOUT_SECONDS: longest a worker waits for that lock (default 10) before
+#   going ahead without it
+
+CUSTOMER_LOCK_STRIPES = 256
+
+
+class SingleFlight:
+    """Run a function once for all concurrent callers with the same key"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    async def do(self, key, func, runtime):
+        """Return (result, shared): shared is True for callers that waited on another's call.
+
+        func is a coroutine function; followers wait for the leader's result through runtime.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return await runtime.wait(call), True
+        try:
+            result = await func()
+            call.set_result(result)
+            return result, False
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class CustomerLock:
+    """Cross-process lock on one of CUSTOMER_LOCK_STRIPES flock files, picked by the email's hash"""
+
+    def __init__(self, directory, key, timeout):
+        stripe_index = int(hashlib.sha256(key.encode()).hexdigest(), 16) % CUSTOMER_LOCK_STRIPES
+        self.path = os.path.join(directory, f"customer-{stripe_index:03d}.lock")
+        self.deadline = time.monotonic() + timeout
+        self._file = None
+
+    def try_acquire(self):
+        """True once the lock is held or the timeout has passed (then the caller proceeds unlocked)"""
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() < self.deadline:
+                return False
+            logging.warning(f"Timed out waiting for customer lock {self.path}, proceeding without it")
+            self.release()
+            return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()  # Closing drops the flock
+            self._file = None
+
+
+_customer_single_flight = SingleFlight()
+
+
+def customer_lock(key):
+    """CustomerLock for an email, or None when CUSTOMER_LOCK_DIR is not set"""
+    directory = os.environ.get('CUSTOMER_LOCK_DIR')
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return CustomerLock(directory, key, float(os.environ.get('CUSTOMER_LOCK_TIMEOUT_SECONDS', '10')))
+
+
+def created_by_checkout(customer):
+    """True for customers the checkout step created (they have not been through the lead step)"""
+    return (customer.metadata or {}).get('source') == 'checkout_prefill'
+
+
+async def find_or_create_customer(runtime, email, metadata):
+    """Return (customer, outcome, shared) where outcome is 'found' or 'created'.
+
+    shared is True when a concurrent call for the same email in this process did the lookup
+    (and, for 'created', the create with its own metadata). metadata is used only when creating.
+    """
+    async def run():
+        lock = customer_lock(normalize_email(email))
+        try:
+            while lock is not None and not lock.try_acquire():
+                await runtime.sleep(0.02)
+            customer = await find_customer_by_email(runtime, email)
+            if customer:
+                return customer, 'found'
+            return await create_customer(runtime, email=email, metadata=metadata), 'created'
+        finally:
+            if lock is not None:
+                lock.release()
+
+    (customer, outcome), shared = await _customer_single_flight.do(normalize_email(email), run, runtime)
+    if shared:
+        summarize_request(customer_single_flight='shared')
+    return customer, outcome, shared
+
+
+# Static Checkout Session parameters, built once from the catalog (callers only set top-level keys)
+SUBSCRIPTION_CHECKOUT_TEMPLATE = {
+    "line_items": [{"price": SETTINGS['subscription']['price_id'], "quantity": 1}],
+    "allow_promotion_codes": False,
+    "mode": "subscription",
+    "subscription_data": {"trial_period_days": SETTINGS['subscription']['trial_period_days']},
+    "ui_mode": "embedded",
+    # SIMPLIFIED: Only collect billing country, not full address
+    "billing_address_collection": "auto",  # This only collects country
+    # REMOVED: No phone collection
+    # "phone_number_collection": {"enabled": False}  # This is already false by default
+}
+
+
+def build_checkout_session_data(email, funnel_type, locale, metadata, client_ip):
+    """Checkout Session parameters for the subscription checkout (customer is added by the caller)"""
+    locale_prefix = f"/{locale}" if locale else ""
+    
+    # IMPORTANT: Updated success URL to pass customer info to upsell page
+    SUCCESS_REDIRECT_URL = SETTINGS['site_url'] + locale_prefix + SETTINGS['subscription']['return_path']
+    
+    return {
+        **SUBSCRIPTION_CHECKOUT_TEMPLATE,
+        "return_url": SUCCESS_REDIRECT_URL,
+        # NEW: Enhanced metadata for Meta tracking
+        "metadata": {
+            "funnel_type": funnel_type,
+            "locale": locale,
+            "email": email,
+            "fbc": metadata.get('fbc', ''),  # Facebook Click ID
+            "fbp": metadata.get('fbp', ''),  # Facebook Browser ID
+            "client_ip": client_ip,  # IP Address for Meta
+            "source": 'web_checkout'
+        }
     }
+
+
+# --- Prewarmed Checkout Sessions ---
+# CHECKOUT_PREWARM: "off" (default), "background" or "sync". When enabled, create_lead also
+#   creates the Checkout Session the follow-up checkout action would create, so that action
+#   returns its clientSecret without any Stripe call. "background" keeps the Stripe call off
+#   the lead response; it needs CPU allocated after the response (Cloud Run
+#   "CPU always allocated" / Cloud Functions gen2), otherwise use "sync".
+# CHECKOUT_PREWARM_TTL_SECONDS: lifetime of a prewarmed session (Stripe minimum 1800). It is
+#   created with that expires_at, so unused sessions expire on their own; sessions that are
+#   replaced are expired right away.
+# CHECKOUT_PREWARM_BACKEND: optional shared store so any instance can serve the checkout
+#   action - "sqlite" (CHECKOUT_PREWARM_PATH) or "redis" (CHECKOUT_PREWARM_REDIS_URL)
+
+PREWARM_EXPIRY_MARGIN_SECONDS = 300  # Never hand out a session this close to its expiry
+PREWARM_TRACKING_FIELDS = ('fbc', 'fbp', 'client_ip')
+
+
+def prewarm_mode():
+    return os.environ.get('CHECKOUT_PREWARM', 'off').lower()
+
+
+def prewarm_key(email, locale, funnel_type):
+    return f"prewarm:{email.strip().lower()}|{locale}|{funnel_type}"
+
+
+class CheckoutSessionPool:
+    """Prewarmed sessions, single use: in-process first, then the optional shared backend"""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.stats = {'created': 0, 'served': 0, 'misses': 0, 'expired': 0}
+
+    def put(self, key, entry):
+        """Store an entry and return the one it replaces (to be expired), if any"""
+        previous = self.take(key, count=False)
+        self.local.set(key, entry)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, entry)
+            except Exception as e:
+                logging.warning(f"Shared checkout session pool write failed: {e}")
+        self.stats['created'] += 1
+        return previous
+
+    def take(self, key, count=True):
+        entry = self.local.get(key)
+        self.local.delete(key)
+        if self.shared is not None:
+            try:
+                entry = entry or self.shared.get(key)
+                self.shared.delete(key)
+            except Exception as e:
+                logging.warning(f"Shared checkout session pool read failed: {e}")
+        if entry and entry['expires_at'] - PREWARM_EXPIRY_MARGIN_SECONDS < time.time():
+            entry = None
+        if count:
+            self.stats['served' if entry else 'misses'] += 1
+        return entry
+
+
+_checkout_session_pool = None
+_prewarm_executor = None
+_prewarm_lock = threading.Lock()
+
+
+def get_checkout_session_pool():
+    """Return the process-wide prewarmed session pool configured from the environment"""
+    global _checkout_session_pool
+    if _checkout_session_pool is None:
+        with _prewarm_lock:
+            if _checkout_session_pool is None:
+                ttl = prewarm_ttl()
+                local = TTLCache(int(os.environ.get('CHECKOUT_PREWARM_MAX_ENTRIES', '1024')), ttl)
+                shared = None
+                backend = os.environ.get('CHECKOUT_PREWARM_BACKEND', '')
+                try:
+                    if backend == 'sqlite':
+                        shared = SqliteCacheBackend(os.environ.get('CHECKOUT_PREWARM_PATH', '/tmp/checkout_prewarm.sqlite3'), ttl)
+                    elif backend == 'redis':
+                        shared = RedisCacheBackend(os.environ['CHECKOUT_PREWARM_REDIS_URL'], ttl)
+                except Exception as e:
+                    logging.warning(f"Shared checkout session pool '{backend}' unavailable, using in-process pool only: {e}")
+                _checkout_session_pool = CheckoutSessionPool(local, shared)
+    return _checkout_session_pool
+
+
+def get_prewarm_executor():
+    global _prewarm_executor
+    if _prewarm_executor is None:
+        with _prewarm_lock:
+            if _prewarm_executor is None:
+                _prewarm_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='checkout-prewarm')
+    return _prewarm_executor
+
+
+def prewarm_ttl():
+    # Stripe accepts expires_at between 30 minutes and 24 hours ahead
+    return min(max(1800, int(os.environ.get('CHECKOUT_PREWARM_TTL_SECONDS', '1800'))), 23 * 3600)
+
+
+async def prewarm_checkout_session(runtime, customer_id, email, funnel_type, locale, metadata, client_ip):
+    """Create and pool the Checkout Session the checkout action will ask for"""
+    session_data = build_checkout_session_data(email, funnel_type, locale, metadata, client_ip)
+    session_data["customer"] = customer_id
+    funnel_token = issue_funnel_token(customer_id, email, locale, funnel_type, metadata)
+    if funnel_token:
+        session_data["return_url"] += f"&funnel_token={funnel_token}"
+    # Expiry is derived from the idempotency window so a repeated lead click replays the same request
+    window = max(1, IDEMPOTENCY_WINDOW_SECONDS)
+    expires_at = int(time.time() // window * window) + window + prewarm_ttl()
+    session_data["expires_at"] = expires_at
     
-    # Send to Meta
-    try:
-        url = f"https://graph.facebook.com/v18.0/{META_PIXEL_ID}/events?access_token={META_ACCESS_TOKEN}"
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
-        logging.info(f"Successfully sent Lead event to Meta for {email}")
-        result = response.json()
-        if 'events_received' in result:
-            logging.info(f"Meta confirmed events received: {result['events_received']}")
-    except Exception as e:
-        logging.error(f"Failed to send Lead to Meta: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logging.error(f"Meta API response: {e.response.text}")
+    session = await runtime.call_stripe(
+        'stripe.checkout.Session.create', stripe.checkout.Session.create,
+        **session_data,
+        idempotency_key=idempotency_key('checkout-prewarm', session_data, window=window)
+    )
+    
+    previous = get_checkout_session_pool().put(prewarm_key(email, locale, funnel_type), {
+        'session_id': session.id,
+        'client_secret': session.client_secret,
+        'customer_id': customer_id,
+        'funnel_token': funnel_token,
+        'tracking': {field: session_data['metadata'].get(field, '') for field in PREWARM_TRACKING_FIELDS},
+        'expires_at': expires_at
+    })
+    if previous and previous['session_id'] != session.id:
+        expire_checkout_session(previous['session_id'])
+    logging.info("Prewarmed checkout session %s for customer %s", session.id, customer_id)
+
+
+async def schedule_checkout_prewarm(runtime, customer_id, email, funnel_type, locale, metadata, client_ip):
+    """Prewarm according to CHECKOUT_PREWARM; failures only cost the prewarm"""
+    async def run(runtime):
+        try:
+            await prewarm_checkout_session(runtime, customer_id, email, funnel_type, locale, metadata, client_ip)
+        except Exception as e:
+            logging.warning(f"Checkout session prewarm failed for customer {customer_id}: {e}")
+    
+    mode = prewarm_mode()
+    if mode == 'sync':
+        await run(runtime)
+    elif mode == 'background':
+        get_prewarm_executor().submit(lambda: run_sync(run(SYNC_RUNTIME)))
+
+
+def take_prewarmed_session(email, locale, funnel_type, metadata, client_ip):
+    """Return a pooled session for this checkout, with its tracking metadata brought up to date"""
+    entry = get_checkout_session_pool().take(prewarm_key(email, locale, funnel_type))
+    if entry is None:
+        return None
+    
+    # The lead step usually has no fbc/fbp yet; patch them in off the critical path
+    # (the webhook only reads them once the customer has paid)
+    current = {'fbc': metadata.get('fbc', ''), 'fbp': metadata.get('fbp', ''), 'client_ip': client_ip}
+    changed = {field: value for field, value in current.items() if entry['tracking'].get(field) != value}
+    if changed:
+        def update_tracking():
+            try:
+                call_stripe('stripe.checkout.Session.modify', stripe.checkout.Session.modify,
+                            entry['session_id'], metadata=changed, priority='background')
+            except Exception as e:
+                logging.warning(f"Could not update tracking metadata on session {entry['session_id']}: {e}")
+        get_prewarm_executor().submit(update_tracking)
+    return entry
+
+
+def expire_checkout_session(session_id):
+    """Expire an unused prewarmed session in the background"""
+    def expire():
+        try:
+            call_stripe('stripe.checkout.Session.expire', stripe.checkout.Session.expire, session_id, priority='background')
+            get_checkout_session_pool().stats['expired'] += 1
+        except Exception as e:
+            logging.warning(f"Could not expire prewarmed session {session_id}: {e}")
+    get_prewarm_executor().submit(expire)
+
 
 # --- Function to create Checkout Session ---
 # SIMPLIFIED VERSION - Only collects email, name, card, and country
-@functions_framework.http
-def create_checkout_session(request):
-    # Set up Stripe API key
-    stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
-
-    # Handle CORS preflight requests
+async def handle_checkout_request(request, runtime):
+    """create_checkout_session's handling, shared by the Flask and ASGI entry points"""
+    # Handle CORS preflight requests (before touching Stripe, so a cold instance answers them at once)
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
@@ -95,22 +448,35 @@ def create_checkout_session(request):
     response_headers = {'Access-Control-Allow-Origin': '*'}
 
     if request.method != 'POST':
-        return (jsonify({'error': 'Method not allowed'}), 405, response_headers)
+        return ({'error': 'Method not allowed'}, 405, response_headers)
+
+    # Set up Stripe API key and pooled HTTP client (once per instance)
+    configure_stripe(STARTUP_CONFIG['stripe_secret_key'], async_client=runtime.is_async)
 
     try:
         data = request.get_json(silent=True) or {}
         email = data.get("email")
         # TODO: Return error if email is not provided
         action = data.get("action", "checkout")
+        # Per-attempt nonce from the client, part of the Checkout Session idempotency key
+        client_request_id = data.get("client_request_id")
         funnel_type = data.get("funnel_type", "option_b")
         
         # Get locale from request data
         locale = data.get("current_locale", "")
-        locale_prefix = f"/{locale}" if locale else ""
         
         # NEW: Get Meta tracking metadata
         metadata = data.get("metadata", {})
         
+        # Token from an earlier funnel step: fills in what this request left out
+        token_claims = read_funnel_token(data, email) if action != "create_lead" else None
+        if token_claims:
+            email = email or token_claims['email']
+            locale = locale or token_claims['locale']
+            if "funnel_type" not in data:
+                funnel_type = token_claims['funnel'] or funnel_type
+            fill_tracking_from_token(metadata, token_claims)
+        
         # NEW: Get client IP address for Meta tracking
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
         if client_ip and ',' in client_ip:
@@ -120,23 +486,26 @@ def create_checkout_session(request):
         metadata['client_ip'] = client_ip
         metadata['locale'] = locale
         
-        # IMPORTANT: Updated success URL to pass customer info to upsell page
-        SUCCESS_REDIRECT_URL = f"https://captainenglish.com{locale_prefix}/captain-forever?session_id={{CHECKOUT_SESSION_ID}}&customer_id={{CHECKOUT_SESSION_CUSTOMER}}&customer_email={{CHECKOUT_SESSION_CUSTOMER_EMAIL}}"
-
         # Action: Create a lead in Stripe for Option B's first step
         if action == "create_lead":
             if not email:
-                return (jsonify({'error': 'Email is required for lead creation'}), 400, response_headers)
+                return ({'error': 'Email is required for lead creation'}, 400, response_headers)
             
-            logging.info(f"Action: create_lead for email: {email}")
-            logging.info(f"Lead metadata: fbclid={metadata.get('fbclid')}, user_agent={metadata.get('user_agent', '')[:50]}")
+            logging.info("Action: create_lead for email: %s", email)
+            summarize_request(action='create_lead', funnel_type=funnel_type)
+            detail_log.debug("Lead metadata: fbclid=%s, user_agent=%.50s", metadata.get('fbclid'), metadata.get('user_agent', ''))
             
             try:
-                # Check if customer already exists
-                existing_customers = stripe.Customer.list(email=email, limit=1)
-                if existing_customers.data:
-                    customer = existing_customers.data[0]
-                    logging.info(f"Found existing customer: {customer.id}")
+                lead_metadata = {
+                    'source': metadata.get('source', 'lead_capture_step_1'),
+                    'funnel': 'option_b',
+                    'fbclid': metadata.get('fbclid', ''),  # NEW: Store Facebook Click ID
+                    'locale': locale
+                }
+                # Find the customer or create the lead (once for concurrent requests with this email)
+                customer, outcome, shared = await find_or_create_customer(runtime, email, lead_metadata)
+                if outcome == 'found':
+                    logging.info("Found existing customer: %s", customer.id)
                     
                     # NEW: Update customer metadata with Facebook data if available
                     if metadata.get('fbclid'):
@@ -144,92 +513,104 @@ def create_checkout_session(request):
                         updated_metadata['fbclid'] = metadata['fbclid']
                         updated_metadata['last_seen_locale'] = locale
                         
-                        stripe.Customer.modify(
-                            customer.id,
+                        await modify_customer(
+                            runtime, customer.id,
                             metadata=updated_metadata
                         )
+                elif shared and created_by_checkout(customer):
+                    # A concurrent checkout request created the customer: it still becomes a lead
+                    logging.info("Recording lead on customer %s created by a concurrent checkout", customer.id)
+                    await modify_customer(runtime, customer.id, metadata=lead_metadata)
+                    await send_lead_to_meta(runtime, email, metadata)
+                elif shared:
+                    logging.info("Lead %s was created by a concurrent request", customer.id)
                 else:
-                    customer = stripe.Customer.create(
-                        email=email,
-                        metadata={
-                            'source': metadata.get('source', 'lead_capture_step_1'),
-                            'funnel': 'option_b',
-                            'fbclid': metadata.get('fbclid', ''),  # NEW: Store Facebook Click ID
-                            'locale': locale
-                        }
-                    )
-                    logging.info(f"New lead created: {customer.id}")
+                    logging.info("New lead created: %s", customer.id)
                     
                     # Send Lead event to Meta for new leads
-                    send_lead_to_meta(email, metadata)
+                    await send_lead_to_meta(runtime, email, metadata)
+                
+                if prewarm_mode() != 'off':
+                    await schedule_checkout_prewarm(runtime, customer.id, email, funnel_type, locale, metadata, client_ip)
                 
-                return (jsonify({'status': 'lead_created', 'customer_id': customer.id}), 200, response_headers)
+                response_data = {'status': 'lead_created', 'customer_id': customer.id}
+                # Lets the checkout step skip finding the customer again
+                funnel_token = issue_funnel_token(customer.id, email, locale, funnel_type, metadata)
+                if funnel_token:
+                    response_data['funnel_token'] = funnel_token
+                return (response_data, 200, response_headers)
+            except (StripeThrottledError, stripe.error.RateLimitError):
+                raise
             except Exception as e:
                 logging.error(f"Lead creation failed: {e}")
-                return (jsonify({'status': 'lead_creation_failed', 'error': str(e)}), 500, response_headers)
+                return ({'status': 'lead_creation_failed', 'error': str(e)}, 500, response_headers)
 
         # Action: Create a checkout session
-        logging.info(f"Action: create_checkout_session for email: {email}, funnel: {funnel_type}, locale: {locale}")
+        logging.info("Action: create_checkout_session for email: %s, funnel: %s, locale: %s", email, funnel_type, locale)
+        summarize_request(action='create_checkout_session', funnel_type=funnel_type, locale=locale)
         
         # NEW: Log Meta tracking data
-        logging.info(f"Meta tracking - fbc: {metadata.get('fbc', 'none')}, fbp: {metadata.get('fbp', 'none')}, client_ip: {client_ip}")
+        detail_log.debug("Meta tracking - fbc: %s, fbp: %s, client_ip: %s",
+                         metadata.get('fbc', 'none'), metadata.get('fbp', 'none'), client_ip)
+
+        # Session prewarmed by create_lead: no Stripe call on the critical path
+        if email and prewarm_mode() != 'off':
+            prewarmed = take_prewarmed_session(email, locale, funnel_type, metadata, client_ip)
+            if prewarmed:
+                logging.info("Serving prewarmed checkout session: %s", prewarmed['session_id'])
+                summarize_request(checkout_session=prewarmed['session_id'], prewarmed=True)
+                response_data = {'clientSecret': prewarmed['client_secret'], 'customer_id': prewarmed['customer_id']}
+                if prewarmed.get('funnel_token'):
+                    response_data['funnel_token'] = prewarmed['funnel_token']
+                return (response_data, 200, response_headers)
 
         # Store customer_id for later use
         customer_id = None
 
-        session_data = {
-            "line_items": [{"price": "price_1RihNELm9s3Kr237MPqAlg9l", "quantity": 1}],
-            "allow_promotion_codes": False,
-            "mode": "subscription",
-            "subscription_data": {"trial_period_days": 3},
-            "ui_mode": "embedded",
-            "return_url": SUCCESS_REDIRECT_URL,
-            # NEW: Enhanced metadata for Meta tracking
-            "metadata": {
-                "funnel_type": funnel_type,
-                "locale": locale,
-                "email": email,
-                "fbc": metadata.get('fbc', ''),  # Facebook Click ID
-                "fbp": metadata.get('fbp', ''),  # Facebook Browser ID
-                "client_ip": client_ip,  # IP Address for Meta
-                "source": 'web_checkout'
-            },
-            # SIMPLIFIED: Only collect billing country, not full address
-            "billing_address_collection": "auto",  # This only collects country
-            # REMOVED: No phone collection
-            # "phone_number_collection": {"enabled": False}  # This is already false by default
-        }
+        session_data = build_checkout_session_data(email, funnel_type, locale, metadata, client_ip)
 
+        # A valid funnel token already names the customer: no Stripe lookup
+        if token_claims and token_claims['customer_id']:
+            customer_id = token_claims['customer_id']
+            session_data["customer"] = customer_id
+            summarize_request(customer_resolution='token')
+            logging.info("Using customer %s from signed funnel token", customer_id)
+        
         # If an email is provided, pre-fill it in checkout
-        if email:
+        elif email:
             try:
-                customers = stripe.Customer.list(email=email, limit=1)
-                if customers.data:
-                    customer_id = customers.data[0].id
-                    session_data["customer"] = customer_id
-                    logging.info(f"Using existing customer: {customer_id}")
+                # Find or create the customer (once for concurrent requests with this email)
+                customer, outcome, _ = await find_or_create_customer(runtime, email, {
+                    'source': 'checkout_prefill',
+                    'funnel': funnel_type,
+                    'fbclid': metadata.get('fbclid', ''),  # Store fbclid on customer
+                    'locale': locale
+                })
+                customer_id = customer.id
+                session_data["customer"] = customer_id
+                if outcome == 'created':
+                    logging.info("Created new customer for checkout: %s", customer_id)
                 else:
-                    # Create a new customer with the email
-                    new_customer = stripe.Customer.create(
-                        email=email,
-                        metadata={
-                            'source': 'checkout_prefill',
-                            'funnel': funnel_type,
-                            'fbclid': metadata.get('fbclid', ''),  # Store fbclid on customer
-                            'locale': locale
-                        }
-                    )
-                    customer_id = new_customer.id
-                    session_data["customer"] = new_customer.id
-                    logging.info(f"Created new customer for checkout: {new_customer.id}")
+                    logging.info("Using existing customer: %s", customer_id)
             except Exception as e:
                 logging.warning(f"Could not create/find customer, passing email directly: {e}")
                 session_data["customer_email"] = email
         
+        # Let the upsell page skip re-resolving the customer
+        funnel_token = issue_funnel_token(customer_id, email, locale, funnel_type, metadata)
+        if funnel_token:
+            session_data["return_url"] += f"&funnel_token={funnel_token}"
+        
         # Create the checkout session
-        session = stripe.checkout.Session.create(**session_data)
-        logging.info(f"Checkout session created: {session.id}")
-        logging.info(f"Session metadata: {session.metadata}")
+        # Double clicks within the idempotency window get the same session back
+        session = await runtime.call_stripe(
+            'stripe.checkout.Session.create', stripe.checkout.Session.create,
+            **session_data, priority='critical',
+            idempotency_key=checkout_session_idempotency_key(session_data, client_request_id)
+        )
+        logging.info("Checkout session created: %s", session.id)
+        summarize_request(checkout_session=session.id)
+        detail_log.debug("Session metadata: %s", session.metadata)
         
         # Return both clientSecret and customer_id for tracking
         response_data = {
@@ -239,9 +620,37 @@ def create_checkout_session(request):
         # Add customer_id if we have it (for frontend tracking if needed)
         if customer_id:
             response_data['customer_id'] = customer_id
+        if funnel_token:
+            response_data['funnel_token'] = funnel_token
         
-        return (jsonify(response_data), 200, response_headers)
+        return (response_data, 200, response_headers)
 
+    except (StripeThrottledError, stripe.error.RateLimitError) as e:
+        return stripe_rate_limited(e, response_headers)
     except Exception as e:
         logging.exception("FATAL ERROR in create_checkout_session")
-        return (jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500, response_headers)
+        return ({'error': f'An unexpected error occurred: {str(e)}'}, 500, response_headers)
+
+
+@functions_framework.http
+@summarized_request(request_log)
+def create_checkout_session(request):
+    return run_sync(handle_checkout_request(request, SYNC_RUNTIME))
+
+
+# --- Async (ASGI) entry points ---
+# create_checkout_session_async serves the same request/response contract from the ASGI
+# runtime, e.g. `functions-framework --asgi --target create_checkout_session_async`. The one
+# handler implementation (handle_checkout_request) runs on the event loop with ASYNC_RUNTIME:
+# Stripe calls go through the SDK's *_async methods and Meta through the loop's httpx client,
+# so a request waiting on either holds no thread (needs httpx).
+
+
+@summarized_request_async(request_log)
+async def create_checkout_session_async(request):
+    """create_checkout_session for the ASGI runtime"""
+    return await handle_checkout_request(BufferedRequest(request, await request.body()), ASYNC_RUNTIME)
+
+
+# Import-time budget and Stripe preload (see finish_module_load in common.py)
+MODULE_IMPORT_SECONDS = finish_module_load('create_checkout_session', MODULE_LOAD_STARTED)
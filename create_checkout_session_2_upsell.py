@@ -1,21 +1,43 @@
-import os
-import stripe
+import time
+MODULE_LOAD_STARTED = time.perf_counter()  # Checked against the import-time budget at the end
+
 import logging
 import functions_framework
-from flask import request, jsonify
+from flask import request
+from common import (
+    ASYNC_RUNTIME, BufferedRequest, checkout_session_idempotency_key, configure_stripe,
+    create_customer, fill_tracking_from_token, find_customer_by_email, finish_module_load,
+    get_customer_cache, load_startup_config, retrieve_customer, run_sync, SETTINGS, stripe,
+    stripe_rate_limited, StripeThrottledError, summarize_request, summarized_request,
+    summarized_request_async, SYNC_RUNTIME, verify_funnel_token,
+)
 
-logging.basicConfig(level=logging.INFO)
+# --- Structured Logging ---
+# Formats, sampling and PII redaction are set up in common.py (LOG_FORMAT, LOG_LEVEL,
+# LOG_SAMPLE_RATES, LOG_REDACT_PII). Every request emits a single summary record on the
+# "upsell_checkout.request" logger; per-field tracking lines go to
+# "upsell_checkout.detail" at DEBUG.
 
-@functions_framework.http
-def create_checkout_session(request):
-    stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
-    
-    # Validate required environment variables
-    STRIPE_UPSELL_PRICE_ID = os.environ.get("STRIPE_UPSELL_PRICE_ID")
-    if not STRIPE_UPSELL_PRICE_ID:
-        logging.error("STRIPE_UPSELL_PRICE_ID environment variable is not set")
-        return (jsonify({'error': 'Server configuration error'}), 500, {'Access-Control-Allow-Origin': '*'})
+detail_log = logging.getLogger('upsell_checkout.detail')
+request_log = logging.getLogger('upsell_checkout.request')
+
+
+# Settings this function cannot run without, validated once per process at module init
+STARTUP_CONFIG = load_startup_config(upsell_price=True)
+
+# Static Checkout Session parameters, built once from the catalog (callers only set top-level keys)
+UPSELL_CHECKOUT_TEMPLATE = {
+    "line_items": [{"price": STARTUP_CONFIG['upsell_price_id'], "quantity": 1}],
+    "mode": "payment",
+    "ui_mode": "embedded",
+    # SIMPLIFIED: Only collect billing country, not full address
+    "billing_address_collection": "auto",  # This only collects country
+    # REMOVED: No phone collection
+}
 
+
+async def handle_upsell_request(request, runtime):
+    """create_checkout_session's handling, shared by the Flask and ASGI entry points"""
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
@@ -24,53 +46,84 @@ def create_checkout_session(request):
         }
         return ('', 204, headers)
 
+    # Validated once at startup (see load_startup_config)
+    STRIPE_UPSELL_PRICE_ID = STARTUP_CONFIG['upsell_price_id']
+    if not STRIPE_UPSELL_PRICE_ID:
+        return ({'error': 'Server configuration error'}, 500, {'Access-Control-Allow-Origin': '*'})
+
     headers = {'Access-Control-Allow-Origin': '*'}
 
     if request.method != 'POST':
-        return (jsonify({'error': 'Method not allowed'}), 405, headers)
+        return ({'error': 'Method not allowed'}, 405, headers)
+
+    configure_stripe(STARTUP_CONFIG['stripe_secret_key'], async_client=runtime.is_async)
 
     try:
         data = request.get_json(silent=True) or {}
         email = data.get("email")
         customer_id = data.get("customer_id")  # Accept customer_id from frontend
         session_id = data.get("session_id")     # Accept session_id from frontend
+        # Signed by the earlier funnel steps (customer_token is the field name from before
+        # the token carried locale and tracking claims)
+        funnel_token = data.get("funnel_token") or data.get("customer_token")
+        # Per-attempt nonce from the client, part of the Checkout Session idempotency key
+        client_request_id = data.get("client_request_id")
         funnel_type = data.get("funnel_type", "upsell")
         locale = data.get("current_locale", "")
-        locale_prefix = f"/{locale}" if locale else ""
         
         # NEW: Get Meta tracking metadata
         metadata = data.get("metadata", {})
         
+        # Fill in the locale and tracking IDs this request left out from the token
+        token_claims = verify_funnel_token(funnel_token)
+        if token_claims:
+            locale = locale or token_claims['locale']
+            fill_tracking_from_token(metadata, token_claims)
+        locale_prefix = f"/{locale}" if locale else ""
+        
         # NEW: Get client IP address for Meta tracking
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
         if client_ip and ',' in client_ip:
             client_ip = client_ip.split(',')[0].strip()
         
-        SUCCESS_REDIRECT_URL = f"https://captainenglish.com{locale_prefix}/thank-you-lifetime?session_id={{CHECKOUT_SESSION_ID}}"
+        SUCCESS_REDIRECT_URL = SETTINGS['site_url'] + locale_prefix + SETTINGS['upsell']['return_path']
+        summarize_request(action='create_upsell_session', funnel_type=funnel_type, locale=locale)
 
         # Initialize variables
         final_customer_id = None
         prefill_email = email
+        customer_resolution = 'none'
         
-        # Try to retrieve customer info from previous session
-        if session_id:
+        # Cheapest first: a funnel token signed by the first checkout needs no Stripe call
+        if token_claims and token_claims['customer_id']:
+            final_customer_id = token_claims['customer_id']
+            prefill_email = token_claims['email'] or prefill_email
+            customer_resolution = 'token'
+            logging.info("Using customer %s from signed funnel token", final_customer_id)
+        
+        # Otherwise one call returns the previous session together with its customer
+        if not final_customer_id and session_id:
             try:
                 # Retrieve the previous checkout session
-                previous_session = stripe.checkout.Session.retrieve(session_id)
+                previous_session = await runtime.call_stripe(
+                    'stripe.checkout.Session.retrieve', stripe.checkout.Session.retrieve, session_id, expand=['customer']
+                )
                 
                 # Get customer ID from previous session
-                if previous_session.customer:
-                    final_customer_id = previous_session.customer
-                    logging.info(f"Retrieved customer {final_customer_id} from previous session")
-                    
-                    # Get full customer details
-                    customer = stripe.Customer.retrieve(final_customer_id)
-                    prefill_email = customer.email
+                previous_customer = previous_session.customer
+                if isinstance(previous_customer, str):
+                    previous_customer = await retrieve_customer(runtime, previous_customer)  # Expansion not applied
+                if previous_customer and not previous_customer.get('deleted'):
+                    final_customer_id = previous_customer.id
+                    prefill_email = previous_customer.email or prefill_email
+                    get_customer_cache().put(previous_customer)
+                    customer_resolution = 'previous_session'
+                    logging.info("Retrieved customer %s from previous session", final_customer_id)
                     
                 # If no customer but has customer_details
                 elif previous_session.customer_details:
                     prefill_email = previous_session.customer_details.email
-                    logging.info(f"Retrieved email {prefill_email} from session customer_details")
+                    logging.info("Retrieved email %s from session customer_details", prefill_email)
                     
             except Exception as e:
                 logging.warning(f"Could not retrieve previous session: {e}")
@@ -79,24 +132,26 @@ def create_checkout_session(request):
         if not final_customer_id and customer_id:
             try:
                 # Verify this customer exists
-                customer = stripe.Customer.retrieve(customer_id)
+                customer = await retrieve_customer(runtime, customer_id)
                 final_customer_id = customer_id
                 prefill_email = customer.email
-                logging.info(f"Using customer_id passed from frontend: {final_customer_id}")
+                customer_resolution = 'customer_id'
+                logging.info("Using customer_id passed from frontend: %s", final_customer_id)
             except Exception as e:
                 logging.warning(f"Could not retrieve customer {customer_id}: {e}")
         
         # If we still don't have a customer, try to find by email
         if not final_customer_id and prefill_email:
             try:
-                customers = stripe.Customer.list(email=prefill_email, limit=1)
-                if customers.data:
-                    final_customer_id = customers.data[0].id
-                    logging.info(f"Found existing customer by email: {final_customer_id}")
+                existing_customer = await find_customer_by_email(runtime, prefill_email)
+                if existing_customer:
+                    final_customer_id = existing_customer.id
+                    customer_resolution = 'email_lookup'
+                    logging.info("Found existing customer by email: %s", final_customer_id)
                 else:
                     # Create new customer
-                    customer = stripe.Customer.create(
-                        email=prefill_email,
+                    customer = await create_customer(
+                        runtime, email=prefill_email,
                         metadata={
                             'source': 'upsell_checkout',
                             'funnel': funnel_type,
@@ -105,18 +160,20 @@ def create_checkout_session(request):
                         }
                     )
                     final_customer_id = customer.id
-                    logging.info(f"Created new customer for upsell: {final_customer_id}")
+                    customer_resolution = 'created'
+                    logging.info("Created new customer for upsell: %s", final_customer_id)
             except Exception as e:
                 logging.warning(f"Customer lookup/creation failed: {e}")
 
+        summarize_request(customer_resolution=customer_resolution)
+        
         # NEW: Log Meta tracking data
-        logging.info(f"Upsell Meta tracking - fbc: {metadata.get('fbc', 'none')}, fbp: {metadata.get('fbp', 'none')}, client_ip: {client_ip}")
+        detail_log.debug("Upsell Meta tracking - fbc: %s, fbp: %s, client_ip: %s",
+                         metadata.get('fbc', 'none'), metadata.get('fbp', 'none'), client_ip)
 
         # Build session data
         session_data = {
-            "line_items": [{"price": STRIPE_UPSELL_PRICE_ID, "quantity": 1}],
-            "mode": "payment",
-            "ui_mode": "embedded",
+            **UPSELL_CHECKOUT_TEMPLATE,
             "return_url": SUCCESS_REDIRECT_URL,
             # NEW: Enhanced metadata for Meta tracking
             "metadata": {
@@ -129,10 +186,7 @@ def create_checkout_session(request):
                 "client_ip": client_ip,  # IP Address for Meta
                 "original_session_id": metadata.get('original_session_id', ''),
                 "source": 'upsell_checkout'
-            },
-            # SIMPLIFIED: Only collect billing country, not full address
-            "billing_address_collection": "auto",  # This only collects country
-            # REMOVED: No phone collection
+            }
         }
 
         # Set customer or email for the session
@@ -140,17 +194,23 @@ def create_checkout_session(request):
             session_data["customer"] = final_customer_id
             # Note: payment_method_collection is not needed for embedded checkout
             # Stripe will automatically show saved payment methods for the customer
-            logging.info(f"Creating upsell session with customer {final_customer_id}")
+            logging.info("Creating upsell session with customer %s", final_customer_id)
         elif prefill_email:
             session_data["customer_email"] = prefill_email
-            logging.info(f"Creating upsell session with email {prefill_email}")
+            logging.info("Creating upsell session with email %s", prefill_email)
         else:
             logging.warning("Creating upsell session without customer info")
 
         # Create the session
-        session = stripe.checkout.Session.create(**session_data)
-        logging.info(f"Upsell session created: {session.id}")
-        logging.info(f"Upsell session metadata: {session.metadata}")
+        # Double clicks within the idempotency window get the same session back
+        session = await runtime.call_stripe(
+            'stripe.checkout.Session.create', stripe.checkout.Session.create,
+            **session_data, priority='critical',
+            idempotency_key=checkout_session_idempotency_key(session_data, client_request_id)
+        )
+        logging.info("Upsell session created: %s", session.id)
+        summarize_request(checkout_session=session.id, has_customer=bool(final_customer_id))
+        detail_log.debug("Upsell session metadata: %s", session.metadata)
         
         response_data = {
             'clientSecret': session.client_secret,
@@ -158,8 +218,34 @@ def create_checkout_session(request):
             'customer_email': prefill_email
         }
         
-        return (jsonify(response_data), 200, headers)
+        return (response_data, 200, headers)
 
+    except (StripeThrottledError, stripe.error.RateLimitError) as e:
+        return stripe_rate_limited(e, headers)
     except Exception as e:
         logging.exception("Error in create_checkout_session")
-        return (jsonify({'error': str(e)}), 500, headers)
+        return ({'error': str(e)}, 500, headers)
+
+
+@functions_framework.http
+@summarized_request(request_log)
+def create_checkout_session(request):
+    return run_sync(handle_upsell_request(request, SYNC_RUNTIME))
+
+
+# --- Async (ASGI) entry points ---
+# create_checkout_session_async serves the same request/response contract from the ASGI
+# runtime, e.g. `functions-framework --asgi --target create_checkout_session_async`. The one
+# handler implementation (handle_upsell_request) runs on the event loop with ASYNC_RUNTIME:
+# Stripe calls go through the SDK's *_async methods, so a request waiting on Stripe holds
+# no thread (needs httpx).
+
+
+@summarized_request_async(request_log)
+async def create_checkout_session_async(request):
+    """create_checkout_session for the ASGI runtime"""
+    return await handle_upsell_request(BufferedRequest(request, await request.body()), ASYNC_RUNTIME)
+
+
+# Import-time budget and Stripe preload (see finish_module_load in common.py)
+MODULE_IMPORT_SECONDS = finish_module_load('create_checkout_session_2_upsell', MODULE_LOAD_STARTED)
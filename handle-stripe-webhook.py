@@ -1,300 +1,924 @@
+import time
+MODULE_LOAD_STARTED = time.perf_counter()  # Checked against the import-time budget at the end
+
 import os
+import re
+import hmac
 import json
-import time
+import math
+import queue
+import random
+import fcntl
+import sqlite3
 import hashlib
-import requests
-import stripe
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from functools import lru_cache
 import logging
 import functions_framework
+from common import (
+    ASYNC_RUNTIME, call_stripe, call_stripe_async, configure_stripe, deliver_meta_events,
+    finish_module_load, get_http_pool_stats, get_meta_batcher, get_meta_breaker,
+    load_startup_config, META_CIRCUIT_OPEN, META_EVENT_TEMPLATES, META_MAX_EVENTS_PER_REQUEST,
+    normalize_email, register_trace_tag_values, RequestSummary, run_sync, stripe,
+    summarize_request, summarized_request, summarized_request_async, SYNC_RUNTIME, trace_span,
+    TTLCache, use_request_summary,
+)
+
+# Settings this function cannot run without, validated once per process at module init
+STARTUP_CONFIG = load_startup_config(meta=True, webhook_secret=True)
+
+
+# Meta delivery mode:
+#   "sync"   - post to Meta inside the webhook request (original behaviour)
+#   "outbox" - persist the built events locally and return 200 right away;
+#              drain_meta_outbox (or `python handle-stripe-webhook.py drain`) delivers them
+# The outbox is a single-host queue: both backends rely on SQLite / flock locking, which is
+# only reliable on a local disk (not NFS or Filestore). Put META_OUTBOX_PATH on a disk that
+# the webhook and the drain worker share on one host (e.g. one VM or container running
+# both); instances that don't share a host can't share an outbox. /tmp is only visible to
+# the current instance.
+META_OUTBOX_MAX_ATTEMPTS = 8
+META_OUTBOX_BASE_BACKOFF_SECONDS = 30
+META_OUTBOX_MAX_BACKOFF_SECONDS = 3600
+META_OUTBOX_LEASE_SECONDS = 120
+META_MAX_EVENT_AGE_SECONDS = 7 * 24 * 3600  # Meta rejects events older than 7 days
+
+# Rate-limiter priority of every Stripe call made here (see STRIPE_PRIORITY_RESERVES in
+# common.py): webhook enrichment yields to the checkout functions
+WEBHOOK_STRIPE_PRIORITY = 'background'
+
+# --- Structured Logging ---
+# Formats, sampling and PII redaction are set up in common.py (LOG_FORMAT, LOG_LEVEL,
+# LOG_SAMPLE_RATES, LOG_REDACT_PII). Every request emits a single summary record on the
+# "stripe_webhook.request" logger; per-field tracking lines go to
+# "stripe_webhook.detail" at DEBUG.
+
+detail_log = logging.getLogger('stripe_webhook.detail')
+request_log = logging.getLogger('stripe_webhook.request')
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 
 # --- Combined Function to handle Stripe Webhooks and Meta Tracking ---
 @functions_framework.http
+@summarized_request(request_log)
 def handle_stripe_webhook(request):
     """
     Combined webhook that:
     1. Updates customer names in Stripe
     2. Sends events to Meta Conversions API with enhanced tracking
-    """
     
-    # Set up Stripe API key and Webhook Secret
-    stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
-    webhook_secret = os.environ.get("STRIPE_WEBHOOK_SECRET")
+    Event types are routed through WEBHOOK_HANDLERS (see webhook_handler below).
+    """
     
-    # Meta configuration (optional - webhook still works without these)
-    META_PIXEL_ID = os.environ.get('META_PIXEL_ID')
-    META_ACCESS_TOKEN = os.environ.get('META_ACCESS_TOKEN')
-
     if request.method != 'POST':
         return 'Method Not Allowed', 405
 
-    payload = request.data
-    sig_header = request.headers.get('stripe-signature')
+    # Set up Stripe API key
+    configure_stripe(STARTUP_CONFIG['stripe_secret_key'])
+
+    # Verified against the raw body; the event is only parsed if a handler needs it
+    delivery, response = screen_delivery(request.data, request.headers.get('stripe-signature'))
+    if response is not None:
+        return response
+    try:
+        event = delivery.event
+    except ValueError as e:
+        logging.error(f"Webhook - Invalid payload: {e}")
+        return 'Invalid payload', 400
+
+    unfinished = []
+    token = _unfinished_side_effects.set(unfinished)
+    try:
+        dispatch_event(event)
+    finally:
+        _unfinished_side_effects.reset(token)
+    finish_delivery(event, unfinished)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("HTTP connection reuse: %s", get_http_pool_stats())
+
+    return 'OK', 200
+
+
+# --- Webhook Verification ---
+# The Stripe-Signature HMAC is checked against the raw request bytes before anything is
+# parsed. Each signature that verifies is remembered until its timestamp leaves the
+# tolerance window, so a captured delivery replayed inside the window is rejected (per
+# instance; older replays already fail the timestamp check). Only the event's id and type
+# are read up front (Stripe writes "id" first and "type" last); the event itself is
+# parsed just for deliveries that reach a handler.
+# WEBHOOK_TOLERANCE_SECONDS: max age of a signature timestamp (default 300, as in the Stripe SDK)
+# WEBHOOK_REPLAY_CACHE_MAX_ENTRIES: signatures remembered per instance (default 100000, 0 disables)
+
+EVENT_ID_PATTERN = re.compile(rb'\s*\{\s*"id"\s*:\s*"(evt_[A-Za-z0-9_]+)"')
+EVENT_TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([A-Za-z0-9_.]+)"\s*\}\s*\Z')
+EVENT_TYPE_SEARCH_BYTES = 256
+
+
+class WebhookDelivery:
+    """A verified Stripe delivery whose event is parsed only when needed"""
+
+    __slots__ = ('payload', 'signature', 'timestamp', 'event_id', 'event_type', '_event')
+
+    def __init__(self, payload, signature, timestamp):
+        self.payload = payload
+        self.signature = signature
+        self.timestamp = timestamp
+        self._event = None
+        id_match = EVENT_ID_PATTERN.match(payload)
+        type_match = EVENT_TYPE_PATTERN.search(payload, max(len(payload) - EVENT_TYPE_SEARCH_BYTES, 0))
+        if id_match and type_match:
+            self.event_id = id_match.group(1).decode()
+            self.event_type = type_match.group(1).decode()
+        else:
+            # Not in Stripe's key order, read them from the parsed event
+            self.event_id = self.event.get('id')
+            self.event_type = self.event['type']
+
+    @property
+    def event(self):
+        """The event as plain dicts, parsed on first access (raises ValueError for invalid JSON).
+
+        Handlers only use item access, so the StripeObject tree construct_event builds
+        (most of its cost on large invoices and charges) is skipped.
+        """
+        if self._event is None:
+            self._event = json.loads(self.payload)
+        return self._event
+
+
+def webhook_tolerance():
+    return int(os.environ.get('WEBHOOK_TOLERANCE_SECONDS', '300'))
+
+
+def verify_webhook_delivery(payload, sig_header, secret, tolerance=None):
+    """Check the Stripe-Signature header against the raw payload. Returns a WebhookDelivery.
+
+    Raises stripe.error.SignatureVerificationError like stripe.Webhook.construct_event.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    tolerance = webhook_tolerance() if tolerance is None else tolerance
     
+    timestamp, signatures = None, []
+    for item in (sig_header or '').split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value.encode('ascii', 'replace'))
     try:
-        event = stripe.Webhook.construct_event(
-            payload=payload, sig_header=sig_header, secret=webhook_secret
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        raise stripe.error.SignatureVerificationError(
+            "Unable to extract timestamp and signatures from header", sig_header, payload
+        )
+    if not signatures:
+        raise stripe.error.SignatureVerificationError(
+            "No signatures found with expected scheme v1", sig_header, payload
+        )
+    
+    expected = hmac.new(secret.encode('utf-8'), b'%d.%s' % (timestamp, payload), hashlib.sha256).hexdigest().encode()
+    signature = next((candidate for candidate in signatures if hmac.compare_digest(expected, candidate)), None)
+    if signature is None:
+        raise stripe.error.SignatureVerificationError(
+            "No signatures found matching the expected signature for payload", sig_header, payload
+        )
+    if tolerance and timestamp < time.time() - tolerance:
+        raise stripe.error.SignatureVerificationError(
+            f"Timestamp outside the tolerance zone ({timestamp})", sig_header, payload
         )
-        logging.info(f"Webhook - Received event: {event['type']} - ID: {event.get('id')}")
+    return WebhookDelivery(payload, signature.decode(), timestamp)
+
+
+class ReplayCache:
+    """Signatures seen on this instance, each kept until its delivery could no longer verify"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+
+    def first_use(self, signature, expires_at):
+        """Record a signature. Returns False if it was already seen and hasn't expired"""
+        now = time.time()
+        with self._lock:
+            # Entries arrive roughly in expiry order, so expired ones collect at the front
+            while self._expires:
+                oldest, oldest_expiry = next(iter(self._expires.items()))
+                if oldest_expiry > now:
+                    break
+                del self._expires[oldest]
+            if signature in self._expires:
+                return False
+            self._expires[signature] = expires_at
+            while len(self._expires) > self.max_entries:
+                self._expires.popitem(last=False)
+            return True
+
+
+_replay_cache = None
+_replay_cache_lock = threading.Lock()
+
+
+def get_replay_cache():
+    """Return the process-wide replay cache, or None when WEBHOOK_REPLAY_CACHE_MAX_ENTRIES is 0"""
+    global _replay_cache
+    max_entries = int(os.environ.get('WEBHOOK_REPLAY_CACHE_MAX_ENTRIES', '100000'))
+    if max_entries <= 0:
+        return None
+    if _replay_cache is None:
+        with _replay_cache_lock:
+            if _replay_cache is None:
+                _replay_cache = ReplayCache(max_entries)
+    return _replay_cache
+
+
+def screen_delivery(payload, sig_header):
+    """Verify a delivery and settle the ones that need no handler.
+
+    Returns (delivery, None) for a new event with an enabled handler, otherwise
+    (None, response) with the response to send (rejected, replayed, unhandled or duplicate).
+    """
+    try:
+        delivery = verify_webhook_delivery(payload, sig_header, STARTUP_CONFIG['webhook_secret'])
+        logging.info("Webhook - Received event: %s - ID: %s", delivery.event_type, delivery.event_id)
+        summarize_request(event_type=delivery.event_type, event_id=delivery.event_id)
     except ValueError as e:
         logging.error(f"Webhook - Invalid payload: {e}")
-        return 'Invalid payload', 400
+        return None, ('Invalid payload', 400)
     except stripe.error.SignatureVerificationError as e:
         logging.error(f"Webhook - Invalid signature: {e}")
-        return 'Invalid signature', 400
+        return None, ('Invalid signature', 400)
 
-    # Handle customer.created event for Lead tracking
-    if event['type'] == 'customer.created' and META_PIXEL_ID and META_ACCESS_TOKEN:
-        customer = event['data']['object']
-        customer_email = customer.get('email')
-        customer_metadata = customer.get('metadata', {})
-        
-        # Only send Lead event if this is from lead capture (not checkout)
-        if customer_email and customer_metadata.get('source') in ['lead_capture_step_1', 'email_capture_step']:
-            try:
-                user_data = build_meta_user_data(
-                    email=customer_email,
-                    customer_id=customer.get('id'),
-                    session_metadata=customer_metadata
-                )
-                
-                send_meta_event(
-                    event_name="Lead",
-                    event_id=f"lead_{customer.get('id')}",
-                    user_data=user_data,
-                    custom_data={
-                        "content_name": "Email Signup",
-                        "content_category": "Lead Generation",
-                        "value": 0.0,
-                        "currency": "USD",
-                        "lead_source": customer_metadata.get('source', 'unknown'),
-                        "locale": customer_metadata.get('locale', '')
-                    }
-                )
-                logging.info(f"Lead event sent for customer {customer.get('id')}")
-            except Exception as e:
-                logging.error(f"Failed to send Lead event for customer.created: {e}")
-
-    # Handle the checkout.session.completed event
-    elif event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        session_id = session.get('id')
-        customer_id = session.get('customer')
-        customer_details = session.get('customer_details', {})
-
-        # Task 1: Update customer name in Stripe (original functionality)
-        if customer_id and customer_details:
-            customer_name = customer_details.get('name')
-            if customer_name:
-                try:
-                    stripe.Customer.modify(
-                        customer_id,
-                        name=customer_name
-                    )
-                    logging.info(f"Successfully updated name for customer {customer_id} to '{customer_name}'")
-                except Exception as e:
-                    logging.error(f"Failed to update customer name for {customer_id}: {e}")
-        
-        # Task 2: Send to Meta Conversions API (if configured)
-        if META_PIXEL_ID and META_ACCESS_TOKEN:
-            try:
-                # Retrieve full session with metadata for Meta tracking
-                full_session = stripe.checkout.Session.retrieve(session_id)
-                session_metadata = full_session.get('metadata', {})
-                logging.info(f"Session metadata for Meta: {json.dumps(session_metadata)}")
-                
-                # Get email
-                email = customer_details.get('email')
-                if not email:
-                    logging.warning(f"No email found for session {session_id}")
-                
-                # Build user data for Meta
-                user_data = build_meta_user_data(
-                    email=email,
-                    customer_details=customer_details,
-                    customer_id=customer_id,
-                    session_metadata=session_metadata
+    replay_cache = get_replay_cache()
+    if replay_cache is not None and not replay_cache.first_use(delivery.signature, delivery.timestamp + webhook_tolerance()):
+        logging.warning("Webhook - Replayed delivery of %s rejected", delivery.event_id)
+        summarize_request(outcome='replay')
+        return None, ('Replayed delivery', 400)
+
+    # Fast path: nothing to do for event types without an enabled handler
+    if get_webhook_handler(delivery.event_type) is None:
+        logging.info("Unhandled event type: %s", delivery.event_type)
+        summarize_request(outcome='unhandled')
+        return None, ('OK', 200)
+
+    # Stripe retries deliveries it considers failed; skip events we already handled
+    if get_processed_event_store().is_processed(delivery.event_id):
+        logging.info("Webhook - Event %s already processed, skipping", delivery.event_id)
+        summarize_request(outcome='duplicate')
+        return None, ('OK', 200)
+
+    return delivery, None
+
+
+# --- Event Dispatch ---
+# WEBHOOK_DISABLED_HANDLERS: comma-separated event types to acknowledge without handling
+# Handlers registered with requires_meta=True are skipped when Meta is not configured.
+
+WEBHOOK_HANDLERS = {}
+
+# Per event type: calls, errors, total and slowest handler time in seconds
+WEBHOOK_HANDLER_STATS = {}
+_webhook_handler_stats_lock = threading.Lock()  # Handlers run on many threads at once
+
+
+def webhook_handler(event_type, requires_meta=False):
+    """Register a function as the handler for a Stripe event type"""
+    def register(func):
+        WEBHOOK_HANDLERS[event_type] = {'func': func, 'requires_meta': requires_meta}
+        register_trace_tag_values('event_type', [event_type])  # A metric label of its own
+        return func
+    return register
+
+
+def meta_configured():
+    """Meta configuration is optional - webhook still works without it"""
+    return bool(STARTUP_CONFIG['meta_pixel_id'] and STARTUP_CONFIG['meta_access_token'])
+
+
+def get_webhook_handler(event_type):
+    """Return the enabled handler function for an event type, or None"""
+    handler = WEBHOOK_HANDLERS.get(event_type)
+    if handler is None:
+        return None
+    disabled = os.environ.get('WEBHOOK_DISABLED_HANDLERS', '')
+    if event_type in (t.strip() for t in disabled.split(',')):
+        return None
+    if handler['requires_meta'] and not meta_configured():
+        return None
+    return handler['func']
+
+
+def dispatch_event(event, resolver=None):
+    """Run the registered handler for an event and record its timing. Returns False if none ran"""
+    handler = get_webhook_handler(event['type'])
+    if handler is None:
+        return False
+    
+    # Each Stripe object is fetched at most once while handling this delivery
+    resolver = resolver or StripeObjectResolver()
+    start = time.perf_counter()
+    failed = False
+    try:
+        with trace_span(f"webhook.{event['type']}", kind='internal'):
+            handler(event, resolver)
+    except Exception as e:
+        failed = True
+        summarize_request(handler_error=f"{type(e).__name__}: {e}")
+        logging.exception(f"Webhook - Handler for {event['type']} failed: {e}")
+    finally:
+        elapsed = time.perf_counter() - start
+        with _webhook_handler_stats_lock:
+            stats = WEBHOOK_HANDLER_STATS.setdefault(
+                event['type'], {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            )
+            stats['calls'] += 1
+            stats['errors'] += int(failed)
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+        summarize_request(handler_ms=round(elapsed * 1000, 1), stripe_fetches=resolver.fetches)
+        detail_log.debug("Webhook - %s handled in %.1f ms (%d Stripe fetches)", event['type'], elapsed * 1000, resolver.fetches)
+    return True
+
+
+# --- Concurrent Side Effects ---
+# WEBHOOK_DEADLINE_SECONDS: time budget for a handler's side effects (default 8s)
+# WEBHOOK_GUARANTEED_RESPONSE: "true" to stop waiting at the deadline and hand unfinished
+#   work to its retry path, so Stripe always gets its 200 within the budget. Work with no
+#   retry path of its own keeps running; the event is only marked processed once it has
+#   succeeded, so a failure after the response is picked up by `replay --skip-processed`
+# WEBHOOK_SIDE_EFFECT_WORKERS: size of the process-wide side-effect thread pool
+
+_side_effect_executor = None
+_side_effect_executor_lock = threading.Lock()
+
+
+def get_side_effect_executor():
+    global _side_effect_executor
+    if _side_effect_executor is None:
+        with _side_effect_executor_lock:
+            if _side_effect_executor is None:
+                _side_effect_executor = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get('WEBHOOK_SIDE_EFFECT_WORKERS', '8')),
+                    thread_name_prefix='webhook-side-effect'
                 )
-                
-                # Send events to Meta
-                amount = session.get('amount_total', 0) / 100.0
-                currency = session.get('currency', 'usd').upper()
-                is_upsell = session_metadata.get('is_upsell') == 'true'
-                
-                if is_upsell:
-                    # Send only Purchase for upsells
-                    send_meta_event(
-                        event_name="Purchase",
-                        event_id=f"upsell_purchase_{session_id}",
-                        user_data=user_data,
-                        custom_data={
-                            "currency": currency,
-                            "value": amount,
-                            "content_type": "product",
-                            "content_name": "Captain English Lifetime Access",
-                            "content_ids": ["captain_english_lifetime"],
-                            "contents": [{"id": "captain_english_lifetime", "quantity": 1}],
-                            "num_items": 1
-                        }
-                    )
-                else:
-                    # Send StartTrial and Purchase for regular subscriptions
-                    send_meta_event(
-                        event_name="StartTrial",
-                        event_id=f"trial_{session_id}",
-                        user_data=user_data,
-                        custom_data={
-                            "currency": currency,
-                            "value": 0.00,
-                            "content_type": "product",
-                            "content_name": "Captain English Pro Trial",
-                            "content_ids": ["captain_english_pro"],
-                            "contents": [{"id": "captain_english_pro", "quantity": 1}],
-                            "num_items": 1
-                        }
-                    )
-                    
-                    send_meta_event(
-                        event_name="Purchase",
-                        event_id=f"purchase_{session_id}",
-                        user_data=user_data,
-                        custom_data={
-                            "currency": currency,
-                            "value": amount if amount > 0 else 0.01,
-                            "content_type": "product",
-                            "content_name": "Captain English Pro Trial",
-                            "content_ids": ["captain_english_pro"],
-                            "contents": [{"id": "captain_english_pro", "quantity": 1}],
-                            "num_items": 1
-                        }
-                    )
-                    
-            except Exception as e:
-                logging.error(f"Failed to send to Meta: {e}")
-                # Don't fail the webhook if Meta sending fails
+    return _side_effect_executor
+
+
+def run_side_effects(event, side_effects):
+    """Run independent side effects concurrently within the deadline budget.
+
+    side_effects maps a name to (func, on_deadline) or (func, on_deadline, async_func).
+    on_deadline is called for work still running when the deadline is hit in
+    guaranteed-response mode and returns True when it took the work over; work without
+    one (or whose on_deadline returns False) is left 'running' and holds back the
+    processed mark (see finish_delivery). Under handle_stripe_webhook_async, async_func is
+    awaited on the event loop instead of running func on the pool. Failures are collected
+    and logged as one summary line.
+    Returns {name: 'ok' | 'deferred' | 'running' | 'offloaded' | error message}.
+    """
+    offloaded = {}
+    offload = _event_loop_offload.get()
+    if offload is not None:
+        for name, spec in list(side_effects.items()):
+            if len(spec) > 2:
+                offload.submit(name, spec[2]())
+                offloaded[name] = 'offloaded'
+        side_effects = {name: spec for name, spec in side_effects.items() if name not in offloaded}
+    if not side_effects:
+        return offloaded
     
-    # Handle invoice.payment_succeeded (for Subscribe event)
-    elif event['type'] == 'invoice.payment_succeeded' and META_PIXEL_ID and META_ACCESS_TOKEN:
-        invoice = event['data']['object']
-        
-        if invoice.get('amount_paid', 0) > 0 and invoice.get('subscription'):
-            billing_reason = invoice.get('billing_reason')
-            if billing_reason in ['subscription_create', 'subscription_cycle', 'subscription_update']:
-                try:
-                    email = invoice.get('customer_email')
-                    customer_id = invoice.get('customer')
-                    
-                    if not email and customer_id:
-                        customer = stripe.Customer.retrieve(customer_id)
-                        email = customer.get('email')
-                    
-                    if email:
-                        # Get customer metadata for tracking
-                        customer = stripe.Customer.retrieve(customer_id) if customer_id else None
-                        customer_metadata = customer.get('metadata', {}) if customer else {}
-                        
-                        user_data = build_meta_user_data(
-                            email=email,
-                            customer_id=customer_id,
-                            session_metadata=customer_metadata
-                        )
-                        
-                        amount_paid = invoice.get('amount_paid', 0) / 100.0
-                        currency = invoice.get('currency', 'usd').upper()
-                        
-                        send_meta_event(
-                            event_name="Subscribe",
-                            event_id=f"subscribe_{invoice.get('id')}",
-                            user_data=user_data,
-                            custom_data={
-                                "currency": currency,
-                                "value": amount_paid,
-                                "content_type": "product",
-                                "content_name": "Captain English Pro Subscription",
-                                "content_ids": ["captain_english_pro_subscription"],
-                                "contents": [{"id": "captain_english_pro_subscription", "quantity": 1}],
-                                "num_items": 1,
-                                "predicted_ltv": amount_paid * 12
-                            }
-                        )
-                        
-                except Exception as e:
-                    logging.error(f"Failed to process invoice payment for Meta: {e}")
-    
-    # Handle subscription cancellation
-    elif event['type'] == 'customer.subscription.deleted' and META_PIXEL_ID and META_ACCESS_TOKEN:
-        subscription = event['data']['object']
-        customer_id = subscription.get('customer')
-        
+    deadline = float(os.environ.get('WEBHOOK_DEADLINE_SECONDS', '8'))
+    guaranteed = os.environ.get('WEBHOOK_GUARANTEED_RESPONSE', 'false').lower() == 'true'
+    
+    start = time.perf_counter()
+    executor = get_side_effect_executor()
+    # Each side effect runs in a copy of the request context so its outbound calls count
+    # towards this request's summary record
+    futures = {executor.submit(contextvars.copy_context().run, func): name
+               for name, (func, *_) in side_effects.items()}
+    done, pending = wait(futures, timeout=deadline if guaranteed else None)
+    elapsed = time.perf_counter() - start
+    
+    outcomes = dict(offloaded)
+    for future in done:
+        error = future.exception()
+        outcomes[futures[future]] = 'ok' if error is None else f"{type(error).__name__}: {error}"
+    for future in pending:
+        name = futures[future]
+        on_deadline = side_effects[name][1]
         try:
-            customer = stripe.Customer.retrieve(customer_id)
-            email = customer.get('email')
-            customer_metadata = customer.get('metadata', {})
-            
-            if email:
-                user_data = build_meta_user_data(
-                    email=email,
-                    customer_id=customer_id,
-                    session_metadata=customer_metadata
-                )
-                
-                send_meta_event(
-                    event_name="CancelSubscription",
-                    event_id=f"cancel_{subscription.get('id')}",
-                    user_data=user_data,
-                    custom_data={
-                        "subscription_id": subscription.get('id'),
-                        "cancel_at_period_end": subscription.get('cancel_at_period_end', False),
-                        "content_type": "product",
-                        "content_name": "Captain English Pro Subscription"
-                    }
-                )
-                
+            deferred = on_deadline is not None and on_deadline()
         except Exception as e:
-            logging.error(f"Failed to process subscription cancellation for Meta: {e}")
+            logging.error(f"Webhook - {event['type']} {event['id']}: deferring {name} failed: {e}")
+            deferred = False
+        if deferred:
+            outcomes[name] = 'deferred'
+        else:
+            track_unfinished_side_effect(name, future)
+            outcomes[name] = 'running'
+
     
-    # Handle refunds
-    elif event['type'] == 'charge.refunded' and META_PIXEL_ID and META_ACCESS_TOKEN:
-        charge = event['data']['object']
-        customer_id = charge.get('customer')
-        
+    summarize_request(side_effects_ms=round(elapsed * 1000, 1), side_effects=outcomes)
+    summary = ', '.join(f"{name}={outcome}" for name, outcome in sorted(outcomes.items()))
+    message = f"Webhook - {event['type']} {event['id']} side effects in {elapsed:.2f}s: {summary}"
+    if any(outcome not in ('ok', 'deferred', 'running', 'offloaded') for outcome in outcomes.values()):
+        logging.error(message)
+    elif pending:
+        logging.warning(f"{message} (deadline of {deadline}s reached)")
+    else:
+        detail_log.debug(message)
+        if elapsed > deadline:
+            logging.warning(f"Webhook - {event['type']} side effects exceeded the {deadline}s deadline budget")
+    return outcomes
+
+
+# Set by the webhook entry points for the delivery being handled: side effects without a
+# deferral path that were still running when the response went out
+_unfinished_side_effects = contextvars.ContextVar('unfinished_side_effects', default=None)
+
+
+def track_unfinished_side_effect(name, future):
+    unfinished = _unfinished_side_effects.get()
+    if unfinished is not None:
+        unfinished.append((name, future))
+
+
+def finish_delivery(event, unfinished):
+    """Mark a handled event processed, or, while side effects are still running, once they
+    have all succeeded. One that fails leaves the event unmarked for `replay --skip-processed`"""
+    event_store = get_processed_event_store()
+    if not unfinished:
+        event_store.mark_processed(event['id'])
+        summarize_request(outcome='handled')
+        return
+    
+    futures = [future for _, future in unfinished]
+    
+    def on_done(name, future):
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled() or error is not None:
+            logging.error(f"Webhook - {event['type']} {event['id']}: {name} failed after the response "
+                          f"({error or 'cancelled'}); the event is left unprocessed for replay")
+        elif all(f.done() and not f.cancelled() and f.exception() is None for f in futures):
+            event_store.mark_processed(event['id'])
+    
+    for name, future in unfinished:
+        future.add_done_callback(lambda future, name=name: on_done(name, future))
+    summarize_request(outcome='handled_pending', running=sorted(name for name, _ in unfinished))
+
+
+# --- Event Handlers ---
+
+@webhook_handler('customer.created', requires_meta=True)
+def handle_customer_created(event, resolver):
+    """Send a Lead event for customers created by the lead capture step"""
+    customer = event['data']['object']
+    customer_email = customer.get('email')
+    customer_metadata = customer.get('metadata', {})
+    
+    # Only send Lead event if this is from lead capture (not checkout)
+    if customer_email and customer_metadata.get('source') in ['lead_capture_step_1', 'email_capture_step']:
         try:
-            customer = stripe.Customer.retrieve(customer_id)
-            email = customer.get('email')
-            customer_metadata = customer.get('metadata', {})
+            user_data = build_meta_user_data(
+                email=customer_email,
+                customer_id=customer.get('id'),
+                session_metadata=customer_metadata
+            )
             
-            if email:
-                user_data = build_meta_user_data(
-                    email=email,
-                    customer_id=customer_id,
-                    session_metadata=customer_metadata
+            send_meta_event(
+                'lead',
+                event_id=f"lead_{customer.get('id')}",
+                user_data=user_data,
+                lead_source=customer_metadata.get('source', 'unknown'),
+                locale=customer_metadata.get('locale', '')
+            )
+            logging.info("Lead event sent for customer %s", customer.get('id'))
+        except Exception as e:
+            logging.error(f"Failed to send Lead event for customer.created: {e}")
+
+
+@webhook_handler('checkout.session.completed')
+def handle_checkout_session_completed(event, resolver):
+    """Update the customer name and send StartTrial/Purchase (or upsell Purchase) events"""
+    # Work from the event payload; only re-fetch the session if fields are missing
+    session = resolve_completed_session(event['data']['object'], resolver)
+    customer_id = session.get('customer')
+    if isinstance(customer_id, dict):
+        customer_id = customer_id.get('id')  # Expanded customer object
+    customer_details = session.get('customer_details') or {}
+
+    side_effects = {}
+
+    # Task 1: Update customer name in Stripe (original functionality)
+    if customer_id and customer_details:
+        customer_update = {}
+        customer_name = customer_details.get('name')
+        if customer_name:
+            customer_update['name'] = customer_name
+        
+        # Optionally keep the hashed profile on the customer so renewals, cancellations and
+        # refunds (which only carry a customer ID) can send the same match keys
+        if os.environ.get('META_PERSIST_HASHED_PROFILE', 'false').lower() == 'true':
+            profile_metadata = hashed_profile_metadata(hash_customer_details(customer_details))
+            if profile_metadata:
+                customer_update['metadata'] = profile_metadata
+        
+        if customer_update:
+            key_prefix = 'profile' if 'metadata' in customer_update else 'name'
+            
+            def update_customer_name():
+                if is_dry_run():
+                    logging.info("Dry run - would update customer %s (%s)", customer_id, ', '.join(customer_update))
+                    return
+                call_stripe(
+                    'stripe.Customer.modify', stripe.Customer.modify,
+                    customer_id,
+                    idempotency_key=f"{key_prefix}-{event['id']}",
+                    priority=WEBHOOK_STRIPE_PRIORITY,
+                    **customer_update
                 )
-                
-                refund_amount = charge.get('amount_refunded', 0) / 100.0
-                currency = charge.get('currency', 'usd').upper()
-                
-                send_meta_event(
-                    event_name="Refund",
-                    event_id=f"refund_{charge.get('id')}",
-                    user_data=user_data,
-                    custom_data={
-                        "currency": currency,
-                        "value": refund_amount,
-                        "refund_reason": charge.get('refunds', {}).get('data', [{}])[0].get('reason', 'unknown'),
-                        "content_type": "product",
-                        "content_name": "Captain English Pro"
-                    }
+                logging.info("Successfully updated customer %s (%s)", customer_id, ', '.join(customer_update))
+            
+            async def update_customer_name_async():
+                await call_stripe_async(
+                    'stripe.Customer.modify', stripe.Customer.modify_async,
+                    customer_id, idempotency_key=f"{key_prefix}-{event['id']}",
+                    priority=WEBHOOK_STRIPE_PRIORITY, **customer_update
                 )
-                
+                logging.info("Successfully updated customer %s (%s)", customer_id, ', '.join(customer_update))
+            
+            # Past the deadline the update keeps running on the side-effect pool (or the event
+            # loop) and the event is only marked processed once it succeeds; its idempotency
+            # key makes a later replay of this event safe
+            side_effects['customer_name'] = (update_customer_name, None, update_customer_name_async)
+    
+    # Task 2: Send to Meta Conversions API (if configured)
+    if meta_configured():
+        try:
+            meta_events = build_session_meta_events(session)
+            side_effects['meta'] = (
+                lambda: send_meta_events_or_raise(meta_events),
+                # Drained later by drain_meta_outbox, when one is configured
+                lambda: all(defer_meta_events(meta_events, reason='Webhook deadline reached'))
+            )
         except Exception as e:
-            logging.error(f"Failed to process refund for Meta: {e}")
+            logging.error(f"Failed to build Meta events: {e}")
+            # Don't fail the webhook if Meta sending fails
     
+    # Task 1 and Task 2 are independent I/O, so run them concurrently
+    run_side_effects(event, side_effects)
+
+
+def build_session_meta_events(session):
+    """Build the StartTrial and Purchase events (or the upsell Purchase) for a completed session"""
+    session_id = session.get('id')
+    customer_id = session.get('customer')
+    if isinstance(customer_id, dict):
+        customer_id = customer_id.get('id')  # Expanded customer object
+    customer_details = session.get('customer_details') or {}
+    
+    # Metadata set at checkout creation is already in the event payload
+    session_metadata = session.get('metadata') or {}
+    detail_log.debug("Session metadata for Meta: %s", session_metadata)
+    
+    # Get email
+    email = customer_details.get('email')
+    if not email:
+        logging.warning(f"No email found for session {session_id}")
+    
+    # Build user data for Meta
+    user_data = build_meta_user_data(
+        email=email,
+        customer_details=customer_details,
+        customer_id=customer_id,
+        session_metadata=session_metadata
+    )
+    
+    # Build events for Meta
+    amount = session.get('amount_total', 0) / 100.0
+    currency = session.get('currency', 'usd').upper()
+    
+    if session_metadata.get('is_upsell') == 'true':
+        # Send only Purchase for upsells
+        return [META_EVENT_TEMPLATES['upsell_purchase'].build(
+            f"upsell_purchase_{session_id}", user_data, currency=currency, value=amount
+        )]
+    # Send StartTrial and Purchase for regular subscriptions in one request
+    return [
+        META_EVENT_TEMPLATES['start_trial'].build(
+            f"trial_{session_id}", user_data, currency=currency, value=0.00
+        ),
+        META_EVENT_TEMPLATES['trial_purchase'].build(
+            f"purchase_{session_id}", user_data, currency=currency,
+            value=amount if amount > 0 else 0.01
+        )
+    ]
+
+
+
+# Invoices that count as a new or renewed subscription (Meta Subscribe)
+SUBSCRIBE_BILLING_REASONS = ('subscription_create', 'subscription_cycle', 'subscription_update')
+
+
+@webhook_handler('invoice.payment_succeeded', requires_meta=True)
+def handle_invoice_payment_succeeded(event, resolver):
+    """Send a Subscribe event for paid subscription invoices"""
+    try:
+        meta_events = build_invoice_meta_events(event['data']['object'], resolver)
+        if meta_events:
+            send_meta_events(meta_events)
+    except Exception as e:
+        logging.error(f"Failed to process invoice payment for Meta: {e}")
+
+
+def build_invoice_meta_events(invoice, resolver):
+    """Build the Subscribe event for a paid subscription invoice ([] for other invoices)"""
+    if not (invoice.get('amount_paid', 0) > 0 and invoice.get('subscription')
+            and invoice.get('billing_reason') in SUBSCRIBE_BILLING_REASONS):
+        return []
+    
+    email = invoice.get('customer_email')
+    customer_id = invoice.get('customer')
+    
+    # One (memoized) customer lookup serves both the email fallback and the tracking metadata
+    if customer_id:
+        user_data = build_customer_user_data(customer_id, resolver, email=email)
     else:
-        logging.info(f"Unhandled event type: {event['type']}")
+        user_data = build_meta_user_data(email=email) if email else None
+    if not user_data:
+        return []
+    
+    amount_paid = invoice.get('amount_paid', 0) / 100.0
+    currency = invoice.get('currency', 'usd').upper()
+    return [META_EVENT_TEMPLATES['subscribe'].build(
+        f"subscribe_{invoice.get('id')}", user_data,
+        currency=currency, value=amount_paid, predicted_ltv=amount_paid * 12
+    )]
+
+
+@webhook_handler('customer.subscription.deleted', requires_meta=True)
+def handle_subscription_deleted(event, resolver):
+    """Send a CancelSubscription event"""
+    subscription = event['data']['object']
+    customer_id = subscription.get('customer')
+    
+    try:
+        user_data = build_customer_user_data(customer_id, resolver)
+        
+        if user_data:
+            send_meta_event(
+                'cancel_subscription',
+                event_id=f"cancel_{subscription.get('id')}",
+                user_data=user_data,
+                subscription_id=subscription.get('id'),
+                cancel_at_period_end=subscription.get('cancel_at_period_end', False)
+            )
+            
+    except Exception as e:
+        logging.error(f"Failed to process subscription cancellation for Meta: {e}")
+
+
+@webhook_handler('charge.refunded', requires_meta=True)
+def handle_charge_refunded(event, resolver):
+    """Send a Refund event"""
+    charge = event['data']['object']
+    customer_id = charge.get('customer')
+    
+    try:
+        user_data = build_customer_user_data(customer_id, resolver)
+        
+        if user_data:
+            refund_amount = charge.get('amount_refunded', 0) / 100.0
+            currency = charge.get('currency', 'usd').upper()
+            
+            send_meta_event(
+                'refund',
+                event_id=f"refund_{charge.get('id')}",
+                user_data=user_data,
+                currency=currency,
+                value=refund_amount,
+                refund_reason=charge.get('refunds', {}).get('data', [{}])[0].get('reason', 'unknown')
+            )
+            
+    except Exception as e:
+        logging.error(f"Failed to process refund for Meta: {e}")
 
-    return 'OK', 200
+
+
+# --- Helper Functions for Stripe Objects ---
+
+class StripeObjectResolver:
+    """Request-scoped cache so each Stripe object is fetched at most once per webhook delivery"""
+
+    def __init__(self):
+        self._objects = {}
+        self.fetches = 0
+
+    def _retrieve(self, resource, operation, object_id, **params):
+        key = (resource.OBJECT_NAME, object_id)
+        if key not in self._objects:
+            self._objects[key] = call_stripe(operation, resource.retrieve, object_id,
+                                             priority=WEBHOOK_STRIPE_PRIORITY, **params)
+            self.fetches += 1
+        return self._objects[key]
+
+    def seed(self, obj):
+        """Register an object that is already available (e.g. expanded in another response)"""
+        self._objects[(obj.get('object'), obj.get('id'))] = obj
+
+    def customer(self, customer_id):
+        return self._retrieve(stripe.Customer, 'stripe.Customer.retrieve', customer_id)
+
+    def checkout_session(self, session_id, **params):
+        return self._retrieve(stripe.checkout.Session, 'stripe.checkout.Session.retrieve', session_id, **params)
+
+
+# How often checkout.session.completed was served from the event payload vs.
+# needed the expanded-session fallback fetch
+SESSION_FETCH_STATS = {'from_payload': 0, 'fallback_fetches': 0}
+_session_fetch_stats_lock = threading.Lock()
+COMPLETED_SESSION_REQUIRED_FIELDS = ('metadata', 'customer_details')
+
+
+def resolve_completed_session(session, resolver):
+    """Return the completed session, fetching it (with customer/line_items expanded) only when
+    required fields are missing from the event payload and STRIPE_FETCH_EXPANDED_SESSION is enabled"""
+    missing = [field for field in COMPLETED_SESSION_REQUIRED_FIELDS if session.get(field) is None]
+    fetch_enabled = os.environ.get('STRIPE_FETCH_EXPANDED_SESSION', 'false').lower() == 'true'
+    
+    if not missing or not fetch_enabled:
+        with _session_fetch_stats_lock:
+            SESSION_FETCH_STATS['from_payload'] += 1
+        if missing:
+            logging.warning(f"Session {session.get('id')} payload is missing {missing}; expanded fetch disabled")
+        return session
+    
+    with _session_fetch_stats_lock:
+        SESSION_FETCH_STATS['fallback_fetches'] += 1
+        fallback_fetches = SESSION_FETCH_STATS['fallback_fetches']
+    logging.info("Session %s payload is missing %s, fetching expanded session (fallback fetches so far: %d)",
+                 session.get('id'), missing, fallback_fetches)
+    full_session = resolver.checkout_session(session.get('id'), expand=['customer', 'line_items'])
+    if isinstance(full_session.get('customer'), dict):
+        resolver.seed(full_session['customer'])
+    return full_session
+
+
+# --- Processed Event Store (webhook deduplication) ---
+# WEBHOOK_EVENT_STORE: "memory" (default, per instance), "sqlite" or "file" (survive restarts
+# and are shared by workers on the same host via WEBHOOK_EVENT_STORE_PATH)
+# WEBHOOK_EVENT_TTL_SECONDS: how long an event ID is remembered; Stripe retries for up to 3 days
+
+class MemoryEventStore:
+    """Bounded LRU of processed event IDs with expiry"""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, event_id):
+        with self._lock:
+            expires_at = self._entries.get(event_id)
+            if expires_at is None:
+                return False
+            if expires_at < time.time():
+                del self._entries[event_id]
+                return False
+            return True
+
+    def add(self, event_id, expires_at=None):
+        with self._lock:
+            self._entries[event_id] = expires_at or time.time() + self.ttl
+            self._entries.move_to_end(event_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SqliteEventStore:
+    """Processed event IDs in a SQLite table; expired rows are purged as new ones arrive"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        with closing(sqlite3.connect(self.path, timeout=10)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS processed_events (event_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    def contains(self, event_id):
+        with closing(sqlite3.connect(self.path, timeout=10)) as conn:
+            row = conn.execute("SELECT 1 FROM processed_events WHERE event_id = ? AND expires_at > ?",
+                               (event_id, time.time())).fetchone()
+        return row is not None
+
+    def add(self, event_id):
+        now = time.time()
+        with closing(sqlite3.connect(self.path, timeout=10)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO processed_events (event_id, expires_at) VALUES (?, ?)", (event_id, now + self.ttl))
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM processed_events WHERE expires_at <= ?", (now,))
+
+
+class FileEventStore:
+    """Append-only file of 'event_id expires_at' lines, mirrored in memory"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._seen = MemoryEventStore(ttl, max_entries=1000000)
+        self._lines = 0
+        if os.path.exists(path):
+            now = time.time()
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    self._lines += 1
+                    if len(parts) == 2 and float(parts[1]) > now:
+                        self._seen.add(parts[0], float(parts[1]))
+
+    def contains(self, event_id):
+        return self._seen.contains(event_id)
+
+    def add(self, event_id):
+        expires_at = time.time() + self.ttl
+        self._seen.add(event_id, expires_at)
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(f"{event_id} {expires_at}\n")
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self._lines += 1
+        if self._lines > 2 * self._seen.max_entries:
+            self._compact()
+
+    def _compact(self):
+        now = time.time()
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                live = [line for line in f if len(line.split()) == 2 and float(line.split()[1]) > now]
+                f.seek(0)
+                f.truncate()
+                f.writelines(live)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self._lines = len(live)
+
+
+class ProcessedEventStore:
+    """In-memory LRU in front of an optional durable store"""
+
+    def __init__(self, memory, durable=None):
+        self.memory = memory
+        self.durable = durable
+
+    def is_processed(self, event_id):
+        if self.memory.contains(event_id):
+            return True
+        if self.durable is not None:
+            try:
+                if self.durable.contains(event_id):
+                    self.memory.add(event_id)
+                    return True
+            except Exception as e:
+                logging.warning(f"Processed event store lookup failed: {e}")
+        return False
+
+    def mark_processed(self, event_id):
+        self.memory.add(event_id)
+        if self.durable is not None:
+            try:
+                self.durable.add(event_id)
+            except Exception as e:
+                logging.warning(f"Processed event store write failed: {e}")
+
+
+_processed_event_store = None
+_processed_event_store_lock = threading.Lock()
+
+
+def get_processed_event_store():
+    """Return the process-wide processed event store configured from the environment"""
+    global _processed_event_store
+    if _processed_event_store is None:
+        with _processed_event_store_lock:
+            if _processed_event_store is None:
+                ttl = float(os.environ.get('WEBHOOK_EVENT_TTL_SECONDS', 3 * 24 * 3600))
+                backend = os.environ.get('WEBHOOK_EVENT_STORE', 'memory')
+                durable = None
+                if backend == 'sqlite':
+                    durable = SqliteEventStore(os.environ.get('WEBHOOK_EVENT_STORE_PATH', '/tmp/processed_events.sqlite3'), ttl)
+                elif backend == 'file':
+                    durable = FileEventStore(os.environ.get('WEBHOOK_EVENT_STORE_PATH', '/tmp/processed_events.log'), ttl)
+                _processed_event_store = ProcessedEventStore(MemoryEventStore(ttl), durable)
+    return _processed_event_store
 
 
 # --- Helper Functions for Meta Integration ---
@@ -305,127 +929,1208 @@ def build_meta_user_data(email=None, customer_details=None, customer_id=None, se
     
     # Email (most important)
     if email:
-        user_data["em"] = [hashlib.sha256(email.lower().strip().encode()).hexdigest()]
+        user_data["em"] = [hash_pii(normalize_email(email))]
     
     # Meta tracking data from session metadata
     if session_metadata:
         # Client IP Address (Meta recommendation)
         if session_metadata.get('client_ip'):
             user_data["client_ip_address"] = session_metadata['client_ip']
-            logging.info(f"Meta tracking - IP Address: {session_metadata['client_ip']}")
+            detail_log.debug("Meta tracking - IP Address: %s", session_metadata['client_ip'])
         
         # Facebook Click ID (Meta recommendation)
         if session_metadata.get('fbc'):
             user_data["fbc"] = session_metadata['fbc']
-            logging.info(f"Meta tracking - Click ID (fbc): {session_metadata['fbc']}")
+            detail_log.debug("Meta tracking - Click ID (fbc): %s", session_metadata['fbc'])
         elif session_metadata.get('fbclid'):
             # Convert fbclid to fbc format if only fbclid is stored
             fbc = f"fb.1.{int(time.time() * 1000)}.{session_metadata['fbclid']}"
             user_data["fbc"] = fbc
-            logging.info(f"Meta tracking - Click ID (fbc) from fbclid: {fbc}")
+            detail_log.debug("Meta tracking - Click ID (fbc) from fbclid: %s", fbc)
         
         # Facebook Browser ID
         if session_metadata.get('fbp'):
             user_data["fbp"] = session_metadata['fbp']
-            logging.info(f"Meta tracking - Browser ID (fbp): {session_metadata['fbp']}")
+            detail_log.debug("Meta tracking - Browser ID (fbp): %s", session_metadata['fbp'])
 
         # User Agent
         if session_metadata.get('user_agent'):
             user_data["client_user_agent"] = session_metadata['user_agent']
-            logging.info(f"Meta tracking - User Agent: {session_metadata['user_agent'][:50]}...")  # Log first 50 chars
+            detail_log.debug("Meta tracking - User Agent: %.50s...", session_metadata['user_agent'])  # Log first 50 chars
     
     # External ID for matching
     if customer_id:
         user_data["external_id"] = customer_id
     
-    # Process customer details
+    # Process customer details (name, phone, address) - normalized and hashed once per distinct value
     if customer_details:
-        # Name
-        if customer_details.get('name'):
-            name_parts = customer_details['name'].split(' ', 1)
-            if len(name_parts) > 0:
-                user_data["fn"] = [hashlib.sha256(name_parts[0].lower().strip().encode()).hexdigest()]
-            if len(name_parts) > 1:
-                user_data["ln"] = [hashlib.sha256(name_parts[1].lower().strip().encode()).hexdigest()]
+        user_data.update(hash_customer_details(customer_details))
+        if 'st' in user_data:
+            detail_log.debug("Meta tracking - State: %s", customer_details['address']['state'].upper().strip())
+    
+    # Hashed profile persisted on the customer by an earlier checkout (META_PERSIST_HASHED_PROFILE)
+    if session_metadata:
+        for field in HASHED_PROFILE_FIELDS:
+            persisted = session_metadata.get(f"{HASHED_PROFILE_METADATA_PREFIX}{field}")
+            if persisted and field not in user_data:
+                user_data[field] = [persisted]
+    
+    if detail_log.isEnabledFor(logging.DEBUG):
+        detail_log.debug("Meta user data fields: %s", ', '.join(user_data.keys()))
+    return user_data
+
+
+# --- Meta user_data Normalization and Hashing ---
+# Normalization follows Meta's guidance (lowercase, trimmed, digits-only phone, 2-letter
+# state and country). Hashes are memoized per distinct value, so the same customer is not
+# re-hashed for every renewal, cancellation and refund handled by a warm instance.
+
+HASHED_PROFILE_FIELDS = ('fn', 'ln', 'ph', 'st', 'ct', 'zp', 'country')
+HASHED_PROFILE_METADATA_PREFIX = 'meta_hash_'
+
+# ISO 3166-1 country names (official and common) plus frequent aliases -> alpha-2 code
+COUNTRY_NAME_TO_CODE = {
+    'afghanistan': 'af', 'albania': 'al', 'algeria': 'dz', 'american samoa': 'as', 'andorra': 'ad',
+    'angola': 'ao', 'anguilla': 'ai', 'antarctica': 'aq', 'antigua and barbuda': 'ag', 'argentina': 'ar',
+    'armenia': 'am', 'aruba': 'aw', 'australia': 'au', 'austria': 'at', 'azerbaijan': 'az', 'bahamas': 'bs',
+    'bahrain': 'bh', 'bangladesh': 'bd', 'barbados': 'bb', 'belarus': 'by', 'belgium': 'be', 'belize': 'bz',
+    'benin': 'bj', 'bermuda': 'bm', 'bhutan': 'bt', 'bolivia': 'bo', 'bolivia, plurinational state of': 'bo',
+    'bonaire, sint eustatius and saba': 'bq', 'bosnia and herzegovina': 'ba', 'botswana': 'bw',
+    'bouvet island': 'bv', 'brazil': 'br', 'british indian ocean territory': 'io', 'brunei darussalam': 'bn',
+    'bulgaria': 'bg', 'burkina faso': 'bf', 'burundi': 'bi', 'cabo verde': 'cv', 'cambodia': 'kh',
+    'cameroon': 'cm', 'canada': 'ca', 'cayman islands': 'ky', 'central african republic': 'cf', 'chad': 'td',
+    'chile': 'cl', 'china': 'cn', 'christmas island': 'cx', 'cocos (keeling) islands': 'cc',
+    'colombia': 'co', 'comoros': 'km', 'congo': 'cg', 'congo, the democratic republic of the': 'cd',
+    'cook islands': 'ck', 'costa rica': 'cr', 'croatia': 'hr', 'cuba': 'cu', 'curaçao': 'cw', 'cyprus': 'cy',
+    'czech republic': 'cz', 'czechia': 'cz', "côte d'ivoire": 'ci', 'denmark': 'dk', 'djibouti': 'dj',
+    'dominica': 'dm', 'dominican republic': 'do', 'ecuador': 'ec', 'egypt': 'eg', 'el salvador': 'sv',
+    'england': 'gb', 'equatorial guinea': 'gq', 'eritrea': 'er', 'estonia': 'ee', 'eswatini': 'sz',
+    'ethiopia': 'et', 'falkland islands (malvinas)': 'fk', 'faroe islands': 'fo', 'fiji': 'fj',
+    'finland': 'fi', 'france': 'fr', 'french guiana': 'gf', 'french polynesia': 'pf',
+    'french southern territories': 'tf', 'gabon': 'ga', 'gambia': 'gm', 'georgia': 'ge', 'germany': 'de',
+    'ghana': 'gh', 'gibraltar': 'gi', 'great britain': 'gb', 'greece': 'gr', 'greenland': 'gl',
+    'grenada': 'gd', 'guadeloupe': 'gp', 'guam': 'gu', 'guatemala': 'gt', 'guernsey': 'gg', 'guinea': 'gn',
+    'guinea-bissau': 'gw', 'guyana': 'gy', 'haiti': 'ht', 'heard island and mcdonald islands': 'hm',
+    'holland': 'nl', 'holy see (vatican city state)': 'va', 'honduras': 'hn', 'hong kong': 'hk',
+    'hungary': 'hu', 'iceland': 'is', 'india': 'in', 'indonesia': 'id', 'iran': 'ir',
+    'iran, islamic republic of': 'ir', 'iraq': 'iq', 'ireland': 'ie', 'isle of man': 'im', 'israel': 'il',
+    'italy': 'it', 'ivory coast': 'ci', 'jamaica': 'jm', 'japan': 'jp', 'jersey': 'je', 'jordan': 'jo',
+    'kazakhstan': 'kz', 'kenya': 'ke', 'kiribati': 'ki', "korea, democratic people's republic of": 'kp',
+    'korea, republic of': 'kr', 'kuwait': 'kw', 'kyrgyzstan': 'kg', "lao people's democratic republic": 'la',
+    'laos': 'la', 'latvia': 'lv', 'lebanon': 'lb', 'lesotho': 'ls', 'liberia': 'lr', 'libya': 'ly',
+    'liechtenstein': 'li', 'lithuania': 'lt', 'luxembourg': 'lu', 'macao': 'mo', 'madagascar': 'mg',
+    'malawi': 'mw', 'malaysia': 'my', 'maldives': 'mv', 'mali': 'ml', 'malta': 'mt',
+    'marshall islands': 'mh', 'martinique': 'mq', 'mauritania': 'mr', 'mauritius': 'mu', 'mayotte': 'yt',
+    'mexico': 'mx', 'micronesia, federated states of': 'fm', 'moldova': 'md', 'moldova, republic of': 'md',
+    'monaco': 'mc', 'mongolia': 'mn', 'montenegro': 'me', 'montserrat': 'ms', 'morocco': 'ma',
+    'mozambique': 'mz', 'myanmar': 'mm', 'namibia': 'na', 'nauru': 'nr', 'nepal': 'np', 'netherlands': 'nl',
+    'new caledonia': 'nc', 'new zealand': 'nz', 'nicaragua': 'ni', 'niger': 'ne', 'nigeria': 'ng',
+    'niue': 'nu', 'norfolk island': 'nf', 'north korea': 'kp', 'north macedonia': 'mk',
+    'northern mariana islands': 'mp', 'norway': 'no', 'oman': 'om', 'pakistan': 'pk', 'palau': 'pw',
+    'palestine, state of': 'ps', 'panama': 'pa', 'papua new guinea': 'pg', 'paraguay': 'py', 'peru': 'pe',
+    'philippines': 'ph', 'pitcairn': 'pn', 'poland': 'pl', 'portugal': 'pt', 'puerto rico': 'pr',
+    'qatar': 'qa', 'romania': 'ro', 'russia': 'ru', 'russian federation': 'ru', 'rwanda': 'rw',
+    'réunion': 're', 'saint barthélemy': 'bl', 'saint helena, ascension and tristan da cunha': 'sh',
+    'saint kitts and nevis': 'kn', 'saint lucia': 'lc', 'saint martin (french part)': 'mf',
+    'saint pierre and miquelon': 'pm', 'saint vincent and the grenadines': 'vc', 'samoa': 'ws',
+    'san marino': 'sm', 'sao tome and principe': 'st', 'saudi arabia': 'sa', 'scotland': 'gb',
+    'senegal': 'sn', 'serbia': 'rs', 'seychelles': 'sc', 'sierra leone': 'sl', 'singapore': 'sg',
+    'sint maarten (dutch part)': 'sx', 'slovakia': 'sk', 'slovenia': 'si', 'solomon islands': 'sb',
+    'somalia': 'so', 'south africa': 'za', 'south georgia and the south sandwich islands': 'gs',
+    'south korea': 'kr', 'south sudan': 'ss', 'spain': 'es', 'sri lanka': 'lk', 'sudan': 'sd',
+    'suriname': 'sr', 'svalbard and jan mayen': 'sj', 'sweden': 'se', 'switzerland': 'ch', 'syria': 'sy',
+    'syrian arab republic': 'sy', 'taiwan': 'tw', 'taiwan, province of china': 'tw', 'tajikistan': 'tj',
+    'tanzania': 'tz', 'tanzania, united republic of': 'tz', 'thailand': 'th', 'the netherlands': 'nl',
+    'timor-leste': 'tl', 'togo': 'tg', 'tokelau': 'tk', 'tonga': 'to', 'trinidad and tobago': 'tt',
+    'tunisia': 'tn', 'turkey': 'tr', 'turkmenistan': 'tm', 'turks and caicos islands': 'tc', 'tuvalu': 'tv',
+    'türkiye': 'tr', 'uae': 'ae', 'uganda': 'ug', 'uk': 'gb', 'ukraine': 'ua', 'united arab emirates': 'ae',
+    'united kingdom': 'gb', 'united states': 'us', 'united states minor outlying islands': 'um',
+    'united states of america': 'us', 'uruguay': 'uy', 'usa': 'us', 'uzbekistan': 'uz', 'vanuatu': 'vu',
+    'venezuela': 've', 'venezuela, bolivarian republic of': 've', 'viet nam': 'vn', 'vietnam': 'vn',
+    'virgin islands, british': 'vg', 'virgin islands, u.s.': 'vi', 'wales': 'gb', 'wallis and futuna': 'wf',
+    'western sahara': 'eh', 'yemen': 'ye', 'zambia': 'zm', 'zimbabwe': 'zw', 'åland islands': 'ax'
+}
+
+
+@lru_cache(maxsize=8192)
+def hash_pii(value):
+    """SHA-256 of an already normalized value"""
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def normalize_country(country):
+    """Map a country name or code to a lowercase ISO alpha-2 code"""
+    country = country.strip()
+    return COUNTRY_NAME_TO_CODE.get(country.lower(), country[:2].lower())
+
+
+def hash_customer_details(customer_details):
+    """Hashed fn/ln/ph/st/ct/zp/country user_data fields from Stripe customer_details"""
+    address = customer_details.get('address') or {}
+    hashed = hash_customer_detail_values(
+        customer_details.get('name'),
+        customer_details.get('phone'),
+        address.get('state'),
+        address.get('city'),
+        address.get('postal_code'),
+        address.get('country')
+    )
+    return {field: [value] for field, value in hashed}
+
+
+@lru_cache(maxsize=4096)
+def hash_customer_detail_values(name, phone, state, city, postal_code, country):
+    """(field, hash) pairs for one set of customer details"""
+    fields = {}
+    
+    if name:
+        name_parts = name.split(' ', 1)
+        fields["fn"] = hash_pii(name_parts[0].lower().strip())
+        if len(name_parts) > 1:
+            fields["ln"] = hash_pii(name_parts[1].lower().strip())
+    
+    if phone:
+        digits = ''.join(filter(str.isdigit, phone))
+        if digits:
+            fields["ph"] = hash_pii(digits)
+    
+    # State (Meta recommendation) - only 2-letter codes
+    if state:
+        state_code = state.strip().lower()
+        if len(state_code) == 2:
+            fields["st"] = hash_pii(state_code)
+    
+    if city:
+        fields["ct"] = hash_pii(city.lower().strip())
+    
+    if postal_code:
+        fields["zp"] = hash_pii(postal_code.strip())
+    
+    if country:
+        fields["country"] = hash_pii(normalize_country(country))
+    
+    return tuple(fields.items())
+
+
+def hashed_profile_metadata(user_data):
+    """Customer metadata entries that persist the hashed profile for later events"""
+    return {f"{HASHED_PROFILE_METADATA_PREFIX}{field}": user_data[field][0]
+            for field in HASHED_PROFILE_FIELDS if field in user_data}
+
+
+# user_data per customer for events that only carry a customer ID (renewals, cancels, refunds)
+# META_USER_DATA_CACHE_TTL_SECONDS: how long a warm instance reuses it (default 1 hour)
+_customer_user_data_cache = None
+_customer_user_data_cache_lock = threading.Lock()
+
+
+def get_customer_user_data_cache():
+    global _customer_user_data_cache
+    if _customer_user_data_cache is None:
+        with _customer_user_data_cache_lock:
+            if _customer_user_data_cache is None:
+                _customer_user_data_cache = TTLCache(
+                    int(os.environ.get('META_USER_DATA_CACHE_MAX_ENTRIES', '4096')),
+                    float(os.environ.get('META_USER_DATA_CACHE_TTL_SECONDS', '3600'))
+                )
+    return _customer_user_data_cache
+
+
+def build_customer_user_data(customer_id, resolver, email=None):
+    """Meta user_data for a customer, memoized per customer so repeat events skip the
+    Customer fetch and re-hashing. Returns None when no email is known"""
+    cache = get_customer_user_data_cache()
+    cached = cache.get(customer_id)
+    if cached is not None and (not email or cached.get('em') == [hash_pii(normalize_email(email))]):
+        return cached
+    
+    customer = resolver.customer(customer_id)
+    email = email or customer.get('email')
+    if not email:
+        return None
+    
+    user_data = build_meta_user_data(
+        email=email,
+        customer_id=customer_id,
+        session_metadata=customer.get('metadata', {})
+    )
+    cache.set(customer_id, user_data)
+    return user_data
+
+
+def send_meta_event(template_name, event_id, user_data, **custom_fields):
+    """Send a catalog event to Meta Conversions API (or queue it when outbox mode is enabled)"""
+    event = META_EVENT_TEMPLATES[template_name].build(event_id, user_data, **custom_fields)
+    return send_meta_events([event])[0]
+
+
+def send_meta_events(events):
+    """Send built events to Meta in as few requests as possible. Returns True/False per event"""
+    replay = _current_replay.get()
+    if replay is None:
+        return route_meta_events(events)
+    # A replayed conversion happened when the Stripe event was created, not now
+    for event in events:
+        event['event_time'] = replay.event_time
+    if time.time() - replay.event_time > META_MAX_EVENT_AGE_SECONDS:
+        logging.warning("Replay - not sending %s: older than Meta's 7-day event window",
+                        ', '.join(event['event_id'] for event in events))
+        replay.expired += len(events)
+        return [True] * len(events)
+    if replay.dry_run:
+        for event in events:
+            logging.info("Dry run - would send '%s' to Meta. Event ID: %s", event['event_name'], event['event_id'])
+        results = [True] * len(events)
+    else:
+        results = route_meta_events(events)
+    replay.record(results)
+    return results
+
+
+def route_meta_events(events):
+    """Queue, defer, offload, batch or post events as configured. Returns True/False per event"""
+    if os.environ.get('META_DELIVERY_MODE', 'sync') == 'outbox':
+        try:
+            enqueue_meta_events(events)
+            return [True] * len(events)
+        except Exception as e:
+            # Never lose the events because the outbox is unavailable
+            logging.error(f"Failed to queue events in Meta outbox, sending directly: {e}")
+    
+    # Meta is degraded: don't hold the request on it (drain_meta_outbox delivers them later
+    # when an outbox is configured)
+    breaker = get_meta_breaker()
+    if breaker is not None and breaker.rejecting():
+        return defer_meta_events(events)
+    
+    # Under handle_stripe_webhook_async the request's event loop posts them
+    offload = _event_loop_offload.get()
+    if offload is not None:
+        offload.submit_meta_events(events)
+        return [True] * len(events)
+    
+    batcher = get_meta_batcher(STARTUP_CONFIG)
+    if batcher:
+        results = batcher.add(events)
+        outcomes = [(result.wait(timeout=batcher.max_wait + 15), result.error) for result in results]
+    else:
+        outcomes = run_sync(deliver_meta_events(SYNC_RUNTIME, events, STARTUP_CONFIG))
+    
+    # The breaker opened while these were waiting (or another request holds the half-open probe)
+    rejected = [event for event, (_, error) in zip(events, outcomes) if error == META_CIRCUIT_OPEN]
+    deferred = dict(zip((event['event_id'] for event in rejected), defer_meta_events(rejected)))
+    return [deferred.get(event['event_id'], ok) for event, (ok, _) in zip(events, outcomes)]
+
+
+def meta_outbox_configured():
+    """True when someone drains the outbox: outbox delivery mode or an explicit META_OUTBOX_PATH.
+    The default /tmp path is local to the instance, so events parked there would be lost."""
+    return os.environ.get('META_DELIVERY_MODE', 'sync') == 'outbox' or bool(os.environ.get('META_OUTBOX_PATH'))
+
+
+def defer_meta_events(events, reason='Meta circuit open'):
+    """Hand events Meta can't take right now to the outbox. Returns True/False per event"""
+    if not events:
+        return []
+    if not meta_outbox_configured():
+        logging.error(f"{reason} and no outbox configured (META_DELIVERY_MODE=outbox or META_OUTBOX_PATH), "
+                      f"not queued: {', '.join(event['event_id'] for event in events)}")
+        summarize_request(meta_rejected=len(events))
+        return [False] * len(events)
+    try:
+        enqueue_meta_events(events)
+    except Exception as e:
+        logging.error(f"{reason} and the outbox is unavailable, not queued: {len(events)} event(s): {e}")
+        return [False] * len(events)
+    summarize_request(meta_deferred=len(events))
+    return [True] * len(events)
+
+
+def send_meta_events_or_raise(events):
+    """send_meta_events for callers that aggregate failures as exceptions"""
+    results = send_meta_events(events)
+    failed = [event['event_id'] for event, ok in zip(events, results) if not ok]
+    if failed:
+        raise RuntimeError(f"Meta did not accept events: {', '.join(failed)}")
+
+
+def enqueue_meta_events(events):
+    """Persist events in the Meta outbox for drain_meta_outbox to deliver"""
+    outbox = get_meta_outbox()
+    for event in events:
+        outbox.enqueue(event)
+        logging.info("Queued '%s' in Meta outbox. Event ID: %s", event['event_name'], event['event_id'])
+
+
+# --- Meta Outbox (durable queue for Conversions API events) ---
+# Events the Meta breaker rejects go to the outbox only when one is configured
+# (META_DELIVERY_MODE=outbox or META_OUTBOX_PATH on a local disk the drain worker sees);
+# otherwise they fail and are logged. Single host only, see the delivery mode notes above.
+
+class SqliteMetaOutbox:
+    """Outbox stored in a SQLite database on a local disk. Rows are leased while a drain delivers them.
+
+    Rollback-journal mode, not WAL: WAL needs shared memory between the processes, which a
+    network filesystem can't provide.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta_outbox (
+                    event_id TEXT PRIMARY KEY,
+                    event TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    dead INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS meta_outbox_due ON meta_outbox (dead, next_attempt_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute("PRAGMA busy_timeout=30000")  # Wait out the other process's write lock
+        return conn
+
+    def enqueue(self, event):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # event_id is deterministic, so a Stripe retry of the same webhook is a no-op here
+            conn.execute(
+                "INSERT OR IGNORE INTO meta_outbox (event_id, event, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (event['event_id'], json.dumps(event), now, now)
+            )
+
+    def claim(self, limit, lease_seconds):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT event_id, event, attempts FROM meta_outbox "
+                "WHERE dead = 0 AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE meta_outbox SET next_attempt_at = ? WHERE event_id = ?",
+                [(now + lease_seconds, row[0]) for row in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return [{'event_id': row[0], 'event': json.loads(row[1]), 'attempts': row[2]} for row in rows]
+
+    def ack(self, event_ids):
+        with closing(self._connect()) as conn:
+            conn.executemany("DELETE FROM meta_outbox WHERE event_id = ?", [(event_id,) for event_id in event_ids])
+
+    def retry(self, event_id, attempts, next_attempt_at, error, dead=False):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE meta_outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, dead = ? WHERE event_id = ?",
+                (attempts, next_attempt_at, error, int(dead), event_id)
+            )
+
+
+class FileMetaOutbox:
+    """Append-only JSONL outbox. State is rebuilt by replaying the log; drains compact it."""
+
+    def __init__(self, path):
+        self.path = path
+        open(self.path, 'a').close()
+
+    def _append(self, records):
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(''.join(json.dumps(record) + '\n' for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self, f):
+        state = {}
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Torn write from a crashed instance
+            event_id = record['event_id']
+            if record['op'] == 'enqueue':
+                state.setdefault(event_id, {
+                    'event_id': event_id, 'event': record['event'], 'attempts': 0,
+                    'next_attempt_at': record['at'], 'dead': False, 'last_error': None
+                })
+            elif event_id in state:
+                if record['op'] == 'ack':
+                    del state[event_id]
+                else:
+                    state[event_id].update({k: v for k, v in record.items() if k not in ('op', 'event_id')})
+        return state
+
+    def enqueue(self, event):
+        self._append([{'op': 'enqueue', 'event_id': event['event_id'], 'event': event, 'at': time.time()}])
+
+    def claim(self, limit, lease_seconds):
+        now = time.time()
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = self._load(f)
+                due = sorted(
+                    (r for r in state.values() if not r['dead'] and r['next_attempt_at'] <= now),
+                    key=lambda r: r['next_attempt_at']
+                )[:limit]
+                for record in due:
+                    record['next_attempt_at'] = now + lease_seconds
+                # Compact: rewrite only live records (acked events disappear here)
+                f.seek(0)
+                f.truncate()
+                for record in state.values():
+                    f.write(json.dumps({'op': 'enqueue', 'event_id': record['event_id'], 'event': record['event'], 'at': record['next_attempt_at']}) + '\n')
+                    f.write(json.dumps({'op': 'retry', 'event_id': record['event_id'], 'attempts': record['attempts'],
+                                        'next_attempt_at': record['next_attempt_at'], 'dead': record['dead'],
+                                        'last_error': record['last_error']}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return [{'event_id': r['event_id'], 'event': r['event'], 'attempts': r['attempts']} for r in due]
+
+    def ack(self, event_ids):
+        self._append([{'op': 'ack', 'event_id': event_id} for event_id in event_ids])
+
+    def retry(self, event_id, attempts, next_attempt_at, error, dead=False):
+        self._append([{'op': 'retry', 'event_id': event_id, 'attempts': attempts,
+                       'next_attempt_at': next_attempt_at, 'dead': dead, 'last_error': error}])
+
+
+META_OUTBOX_BACKENDS = {
+    'sqlite': (SqliteMetaOutbox, '/tmp/meta_outbox.sqlite3'),
+    'file': (FileMetaOutbox, '/tmp/meta_outbox.jsonl'),
+}
+
+_meta_outbox = None
+_meta_outbox_lock = threading.Lock()
+
+
+def get_meta_outbox():
+    """Return the process-wide outbox configured by META_OUTBOX_BACKEND / META_OUTBOX_PATH"""
+    global _meta_outbox
+    if _meta_outbox is None:
+        with _meta_outbox_lock:
+            if _meta_outbox is None:
+                backend = os.environ.get('META_OUTBOX_BACKEND', 'sqlite')
+                outbox_class, default_path = META_OUTBOX_BACKENDS[backend]
+                _meta_outbox = outbox_class(os.environ.get('META_OUTBOX_PATH', default_path))
+    return _meta_outbox
+
+
+def drain_outbox(outbox, max_events=500):
+    """Deliver due outbox events with exponential backoff. Returns delivery stats"""
+    stats = {'claimed': 0, 'delivered': 0, 'retried': 0, 'dead': 0}
+    breaker = get_meta_breaker()
+    if breaker is not None and breaker.rejecting():
+        logging.info("Meta circuit open, leaving the outbox for the next drain")
+        stats['circuit'] = 'open'
+        return stats
+    records = outbox.claim(max_events, META_OUTBOX_LEASE_SECONDS)
+    stats['claimed'] = len(records)
+    
+    deliverable = []
+    for record in records:
+        if time.time() - record['event']['event_time'] > META_MAX_EVENT_AGE_SECONDS:
+            outbox.retry(record['event_id'], record['attempts'] + 1, time.time(), 'event older than 7 days', dead=True)
+            stats['dead'] += 1
+        else:
+            deliverable.append(record)
+    
+    for start in range(0, len(deliverable), META_MAX_EVENTS_PER_REQUEST):
+        chunk = deliverable[start:start + META_MAX_EVENTS_PER_REQUEST]
+        outcomes = run_sync(deliver_meta_events(SYNC_RUNTIME, [record['event'] for record in chunk], STARTUP_CONFIG))
         
-        # Phone
-        if customer_details.get('phone'):
-            phone = ''.join(filter(str.isdigit, customer_details['phone']))
-            if phone:
-                user_data["ph"] = [hashlib.sha256(phone.encode()).hexdigest()]
+        delivered = [record['event_id'] for record, (ok, _) in zip(chunk, outcomes) if ok]
+        if delivered:
+            outbox.ack(delivered)
+            stats['delivered'] += len(delivered)
         
-        # Address (especially State which Meta recommends)
-        if customer_details.get('address'):
-            address = customer_details['address']
-            
-            # State (Meta recommendation)
-            if address.get('state'):
-                state_code = address['state'].upper().strip()
-                if len(state_code) == 2:
-                    user_data["st"] = [hashlib.sha256(state_code.lower().encode()).hexdigest()]
-                    logging.info(f"Meta tracking - State: {state_code}")
-            
-            # City
-            if address.get('city'):
-                user_data["ct"] = [hashlib.sha256(address['city'].lower().strip().encode()).hexdigest()]
-            
-            # Postal code
-            if address.get('postal_code'):
-                user_data["zp"] = [hashlib.sha256(address['postal_code'].strip().encode()).hexdigest()]
-            
-            # Country
-            if address.get('country'):
-                # Map common country names to 2-letter codes
-                country = address['country'].lower()
-                country_map = {
-                    'czechia': 'cz', 'czech republic': 'cz',
-                    'united states': 'us', 'usa': 'us', 'united states of america': 'us',
-                    'united kingdom': 'gb', 'uk': 'gb', 'great britain': 'gb',
-                    'germany': 'de', 'france': 'fr', 'spain': 'es', 'italy': 'it'
-                }
-                country_code = country_map.get(country, address['country'][:2].lower())
-                user_data["country"] = [hashlib.sha256(country_code.encode()).hexdigest()]
-    
-    logging.info(f"Meta user data fields: {', '.join(user_data.keys())}")
-    return user_data
+        for record, (ok, error) in zip(chunk, outcomes):
+            if ok:
+                continue
+            if error == META_CIRCUIT_OPEN:
+                # Never sent, so it doesn't use up an attempt
+                outbox.retry(record['event_id'], record['attempts'], time.time(), error)
+                stats['retried'] += 1
+                continue
+            attempts = record['attempts'] + 1
+            if attempts >= META_OUTBOX_MAX_ATTEMPTS:
+                logging.error(f"Giving up on Meta event {record['event_id']} after {attempts} attempts: {error}")
+                outbox.retry(record['event_id'], attempts, time.time(), error, dead=True)
+                stats['dead'] += 1
+            else:
+                backoff = min(META_OUTBOX_BASE_BACKOFF_SECONDS * 2 ** (attempts - 1), META_OUTBOX_MAX_BACKOFF_SECONDS)
+                outbox.retry(record['event_id'], attempts, time.time() + backoff * random.uniform(0.5, 1.0), error)
+                stats['retried'] += 1
+    
+    logging.info("Meta outbox drain: %s", stats, extra={'fields': stats})
+    return stats
 
 
-def send_meta_event(event_name, event_id, user_data, custom_data):
-    """Send event to Meta Conversions API"""
-    META_PIXEL_ID = os.environ.get('META_PIXEL_ID')
-    META_ACCESS_TOKEN = os.environ.get('META_ACCESS_TOKEN')
+# --- Outbox drain entry point (e.g. Cloud Scheduler every minute) ---
+@functions_framework.http
+@summarized_request(request_log)
+def drain_meta_outbox(request):
+    """Deliver events queued by handle_stripe_webhook in outbox mode"""
+    if not meta_configured():
+        return 'Meta not configured', 503
     
-    payload = {
-        "data": [{
-            "event_name": event_name,
-            "event_time": int(time.time()),
-            "event_id": event_id,
-            "event_source_url": "https://captainenglish.com",
-            "action_source": "website",
-            "user_data": user_data,
-            "custom_data": custom_data
-        }]
-    }
+    max_events = request.args.get('max_events', 500, type=int)
+    stats = drain_outbox(get_meta_outbox(), max_events=max_events)
+    stats['http_pools'] = get_http_pool_stats()
+    breaker = get_meta_breaker()
+    if breaker is not None:
+        stats['meta_breaker'] = breaker.snapshot()
+    return json.dumps(stats), 200, {'Content-Type': 'application/json'}
+
+
+# --- Event Replay (backfill) ---
+# Runs historical Stripe events through the registered handlers, e.g. conversions that
+# were never sent because Meta was misconfigured or down. Events come from the Events API
+# (which keeps the last 30 days) or from a JSONL file with one event per line. There is no
+# signature check: the events come from our own account or export. Batches are processed
+# with bounded concurrency, and after each batch the position is written to the
+# checkpoint file, so an interrupted run resumes where it stopped. The Meta event IDs are
+# derived from the Stripe objects, so Meta deduplicates events it already received.
+# Replayed Meta events carry the Stripe event's `created` time as their event_time; those
+# older than Meta's 7-day window are not sent and the Stripe event is counted as 'expired'.
+# A dry run makes the Stripe lookups the handlers need but sends nothing to Meta and
+# makes no Stripe writes.
+#   python handle-stripe-webhook.py replay --from-stripe --type checkout.session.completed \
+#       --since 2024-06-01 --checkpoint replay.json --concurrency 32
+
+class EventReplay:
+    """Meta events sent (or, in a dry run, only built) while replaying one Stripe event"""
+
+    __slots__ = ('dry_run', 'event_time', 'sent', 'failed', 'expired')
+
+    def __init__(self, dry_run=False, event_time=None):
+        self.dry_run = dry_run
+        self.event_time = event_time or int(time.time())
+        self.sent = 0
+        self.failed = 0
+        self.expired = 0
+
+    def record(self, results):
+        self.sent += sum(1 for ok in results if ok)
+        self.failed += sum(1 for ok in results if not ok)
+
+
+# Set while replay_events runs a handler
+_current_replay = contextvars.ContextVar('current_replay', default=None)
+
+
+def is_dry_run():
+    replay = _current_replay.get()
+    return replay is not None and replay.dry_run
+
+
+class StripeEventSource:
+    """Pages through the Events API, newest first (the page's last event ID is the cursor)"""
+
+    def __init__(self, types=None, created_gte=None, created_lte=None):
+        self.types = types
+        self.created = {key: value for key, value in (('gte', created_gte), ('lte', created_lte)) if value}
+        self.key = json.dumps({'source': 'stripe', 'types': types, 'created': self.created}, sort_keys=True)
+
+    def batches(self, cursor=None, batch_size=100):
+        params = {'limit': min(batch_size, 100)}
+        if self.types:
+            params['types'] = self.types
+        if self.created:
+            params['created'] = self.created
+        while True:
+            page = call_stripe('stripe.Event.list', stripe.Event.list, priority=WEBHOOK_STRIPE_PRIORITY,
+                               **params, **({'starting_after': cursor} if cursor else {}))
+            if not page.data:
+                return
+            cursor = page.data[-1]['id']
+            yield cursor, page.data
+            if not page.has_more:
+                return
+
+
+class JsonlEventSource:
+    """One Stripe event per line (the line number is the cursor)"""
+
+    def __init__(self, path, types=None):
+        self.path = path
+        self.types = set(types or ())
+        self.key = json.dumps({'source': 'jsonl', 'path': os.path.abspath(path), 'types': sorted(self.types)})
+
+    def batches(self, cursor=None, batch_size=500):
+        batch, line_number = [], cursor or 0
+        with open(self.path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if cursor is not None and line_number <= cursor:
+                    continue
+                if line.strip():
+                    event = json.loads(line)
+                    if not self.types or event['type'] in self.types:
+                        batch.append(event)
+                if len(batch) >= batch_size:
+                    yield line_number, batch
+                    batch = []
+        if batch:
+            yield line_number, batch
+
+
+class ReplayCheckpoint:
+    """Cursor and running totals of a replay, rewritten atomically after every batch"""
+
+    def __init__(self, path, source_key):
+        self.path = path
+        self.source_key = source_key
+
+    def load(self):
+        """(cursor, stats) saved by an earlier run over the same source, or (None, None)"""
+        if not self.path or not os.path.exists(self.path):
+            return None, None
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved.get('source') != self.source_key:
+            raise ValueError(f"Checkpoint {self.path} belongs to a different replay source: {saved.get('source')}")
+        return saved['cursor'], saved['stats']
+
+    def save(self, cursor, stats):
+        if not self.path:
+            return
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump({'source': self.source_key, 'cursor': cursor, 'stats': stats}, f)
+        os.replace(temporary_path, self.path)
+
+
+REPLAY_OUTCOMES = ('replayed', 'dry_run', 'failed', 'expired', 'unhandled', 'skipped')
+REPLAY_MAX_REPORTED_FAILURES = 100
+
+
+def replay_event(event, dry_run=False, skip_processed=False):
+    """Run one historical event through its handler. Returns (outcome, Meta events sent)"""
+    if get_webhook_handler(event['type']) is None:
+        return 'unhandled', 0
+    event_store = get_processed_event_store()
+    if skip_processed and event_store.is_processed(event['id']):
+        return 'skipped', 0
     
-    headers = {'Content-Type': 'application/json'}
-    url = f"https://graph.facebook.com/v18.0/{META_PIXEL_ID}/events?access_token={META_ACCESS_TOKEN}"
+    # A summary that is never emitted: it only collects what the handler reports
+    summary = RequestSummary('replay_event', request_log)
+    replay = EventReplay(dry_run, event.get('created'))
+    replay_token = _current_replay.set(replay)
+    try:
+        with use_request_summary(summary):
+            dispatch_event(event)
+    finally:
+        _current_replay.reset(replay_token)
+    
+    side_effect_errors = {name: outcome for name, outcome in summary.fields.get('side_effects', {}).items()
+                          if outcome not in ('ok', 'deferred', 'offloaded')}
+    if summary.fields.get('handler_error') or side_effect_errors or replay.failed:
+        logging.warning("Replay - %s %s failed: %s", event['type'], event['id'],
+                        summary.fields.get('handler_error') or side_effect_errors or f"{replay.failed} Meta event(s) rejected")
+        return 'failed', replay.sent
+    if dry_run:
+        return 'expired' if replay.expired else 'dry_run', replay.sent
+    # Expired events are marked too: Meta would reject them on every later replay
+    event_store.mark_processed(event['id'])
+    return 'expired' if replay.expired else 'replayed', replay.sent
+
+
+def replay_events(source, concurrency=8, batch_size=500, checkpoint_path=None, dry_run=False, skip_processed=False):
+    """Replay every event from an event source through the handlers. Returns replay stats"""
+    checkpoint = ReplayCheckpoint(checkpoint_path, source.key)
+    cursor, saved_stats = checkpoint.load()
+    # Checkpoints written before an outcome existed lack its counter
+    stats = {'events': 0, **{outcome: 0 for outcome in REPLAY_OUTCOMES},
+             'meta_events': 0, 'failed_event_ids': [], 'seconds': 0.0, **(saved_stats or {})}
+    if cursor is not None:
+        logging.info("Replay - resuming after %s (%d events done)", cursor, stats['events'])
+    if not meta_configured():
+        logging.warning("Replay - Meta is not configured, handlers that send Meta events are skipped")
     
+    started = time.perf_counter()
+    previous_seconds = stats['seconds']
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='webhook-replay') as executor:
+        for cursor, events in source.batches(cursor, batch_size):
+            results = list(executor.map(
+                lambda event: contextvars.copy_context().run(replay_event, event, dry_run, skip_processed), events
+            ))
+            for event, (outcome, meta_events) in zip(events, results):
+                stats[outcome] += 1
+                stats['meta_events'] += meta_events
+                if outcome == 'failed' and len(stats['failed_event_ids']) < REPLAY_MAX_REPORTED_FAILURES:
+                    stats['failed_event_ids'].append(event['id'])
+            stats['events'] += len(events)
+            stats['seconds'] = round(previous_seconds + time.perf_counter() - started, 3)
+            checkpoint.save(cursor, stats)
+            logging.info("Replay - %d events (%.1f/s): %s", stats['events'], stats['events'] / max(stats['seconds'], 1e-9),
+                         ', '.join(f"{outcome}={stats[outcome]}" for outcome in REPLAY_OUTCOMES if stats[outcome]))
+    
+    stats['events_per_second'] = round(stats['events'] / max(stats['seconds'], 1e-9), 1)
+    logging.info("Replay finished: %s", stats, extra={'fields': stats})
+    return stats
+
+
+# --- Stripe / Meta Reconciliation ---
+# Checks that every completed checkout session and paid subscription invoice in a date
+# range produced its Meta events, and rebuilds and sends only the missing ones (Meta
+# deduplicates on the event ID). The handlers don't run, so nothing is written to Stripe.
+# The events carry the object's `created` time; objects older than Meta's 7-day window
+# are counted as 'expired' instead. Meta has no API to list received events, so the
+# delivery log is an export of this function's logs: one "Successfully sent '<name>' to
+# Meta. Event ID: <id>" line per accepted event (plain text or JSON lines, optionally .gz;
+# keep INFO records of the root logger unsampled). The delivered IDs are held in a Bloom
+# filter of fixed size, and Stripe objects are streamed from several time slices paged
+# in parallel, so memory stays flat however long the range is. A false positive (rate
+# set by --error-rate) makes a missing event look delivered; it is never the other way round.
+#   python handle-stripe-webhook.py reconcile --since 2024-06-01 --until 2024-07-01 \
+#       --delivery-log meta-deliveries-june.jsonl.gz --dry-run
+
+DELIVERY_LOG_PATTERN = re.compile(r"Successfully sent '[^']*' to Meta\. Event ID: ([A-Za-z0-9_.:@+-]+)")
+
+
+class BloomFilter:
+    """Fixed-size set of strings: no false negatives, false positives at about error_rate"""
+
+    def __init__(self, capacity, error_rate=1e-4):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def load_delivery_log(paths, delivered):
+    """Add the event IDs of every delivery line in the log files to `delivered`. Returns the line count"""
+    import gzip
+    
+    lines = 0
+    for path in paths:
+        with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, encoding='utf-8')) as f:
+            for line in f:
+                lines += 1
+                for event_id in DELIVERY_LOG_PATTERN.findall(line):
+                    delivered.add(event_id)
+    return lines
+
+
+def expected_session_event_ids(session):
+    """Meta event IDs handle_checkout_session_completed sends for a session"""
+    if (session.get('metadata') or {}).get('is_upsell') == 'true':
+        return [f"upsell_purchase_{session['id']}"]
+    return [f"trial_{session['id']}", f"purchase_{session['id']}"]
+
+
+def expected_invoice_event_ids(invoice):
+    """Meta event IDs handle_invoice_payment_succeeded sends for an invoice"""
+    if (invoice.get('amount_paid', 0) > 0 and invoice.get('subscription')
+            and invoice.get('billing_reason') in SUBSCRIBE_BILLING_REASONS
+            and (invoice.get('customer') or invoice.get('customer_email'))):
+        return [f"subscribe_{invoice['id']}"]
+    return []
+
+
+# kind -> (list call, list filters, expected event IDs, Meta event builder taking (object, resolver))
+RECONCILE_SOURCES = {
+    'sessions': (lambda **params: call_stripe('stripe.checkout.Session.list', stripe.checkout.Session.list,
+                                              priority=WEBHOOK_STRIPE_PRIORITY, **params),
+                 {'status': 'complete'}, expected_session_event_ids,
+                 lambda session, resolver: build_session_meta_events(session)),
+    'invoices': (lambda **params: call_stripe('stripe.Invoice.list', stripe.Invoice.list,
+                                              priority=WEBHOOK_STRIPE_PRIORITY, **params),
+                 {'status': 'paid'}, expected_invoice_event_ids, build_invoice_meta_events),
+}
+
+
+def stream_stripe_objects(list_objects, filters, since, until, slices=8):
+    """Yield every object created in [since, until), paging `slices` time slices in parallel.
+
+    A bounded queue between the page fetchers and the caller keeps memory flat.
+    """
+    bounds = [since + (until - since) * i // slices for i in range(slices + 1)]
+    ranges = [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+    results = queue.Queue(maxsize=len(ranges) * 200)
+    finished = object()
+    
+    def fetch(start, end):
+        try:
+            # Paged by hand (not auto_paging_iter) so every page goes through the rate limiter
+            params = {'created': {'gte': start, 'lt': end}, 'limit': 100, **filters}
+            while True:
+                page = list_objects(**params)
+                for obj in page.data:
+                    results.put(obj)
+                if not page.has_more or not page.data:
+                    break
+                params['starting_after'] = page.data[-1]['id']
+            results.put(finished)
+        except Exception as e:
+            results.put(e)
+    
+    for start, end in ranges:
+        threading.Thread(target=contextvars.copy_context().run, args=(fetch, start, end),
+                         name='reconcile-fetch', daemon=True).start()
+    remaining = len(ranges)
+    while remaining:
+        item = results.get()
+        if item is finished:
+            remaining -= 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
+
+
+def reemit_meta_events(build_events, obj, missing, dry_run=False):
+    """Build an object's Meta events and send the missing ones.
+
+    Returns 'reemitted', 'dry_run', 'expired' (older than Meta accepts) or 'failed'.
+    """
+    replay = EventReplay(dry_run, obj.get('created'))
+    replay_token = _current_replay.set(replay)
     try:
-        response = requests.post(url, data=json.dumps(payload), headers=headers, timeout=10)
-        response.raise_for_status()
-        logging.info(f"Successfully sent '{event_name}' to Meta. Event ID: {event_id}")
+        events = [event for event in build_events(obj, StripeObjectResolver()) if event['event_id'] in missing]
+        if events:
+            send_meta_events(events)
+    except Exception as e:
+        logging.warning(f"Reconcile - re-emitting {', '.join(missing)} failed: {e}")
+        return 'failed'
+    finally:
+        _current_replay.reset(replay_token)
+    if replay.failed or not events:
+        logging.warning(f"Reconcile - {', '.join(missing)} not re-emitted "
+                        f"({f'{replay.failed} rejected by Meta' if events else 'no events built'})")
+        return 'failed'
+    if replay.expired:
+        return 'expired'
+    return 'dry_run' if dry_run else 'reemitted'
+
+
+def reconcile_meta_events(since, until, delivery_logs, kinds=tuple(RECONCILE_SOURCES), slices=8, concurrency=8,
+                          dry_run=False, capacity=1_000_000, error_rate=1e-4):
+    """Re-emit the Meta events of sessions and invoices in [since, until) missing from the delivery log"""
+    started = time.perf_counter()
+    delivered = BloomFilter(capacity, error_rate)
+    stats = {'log_lines': load_delivery_log(delivery_logs, delivered), 'delivered_ids': delivered.count,
+             'checked': 0, 'expected_events': 0, 'missing': 0, 'reemitted': 0, 'dry_run': 0, 'failed': 0,
+             'expired': 0, 'missing_event_ids': []}
+    if delivered.count > capacity:
+        logging.warning(f"Reconcile - {delivered.count} delivered IDs exceed the filter capacity of {capacity}; "
+                        "raise --expected-deliveries or missing events may be reported as delivered")
+    if not meta_configured():
+        logging.warning("Reconcile - Meta is not configured, missing events can't be re-emitted")
+    
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='webhook-reconcile') as executor:
+        pending = []
         
-        # Log response for debugging
-        result = response.json()
-        if 'events_received' in result:
-            logging.info(f"Meta confirmed events received: {result['events_received']}")
+        def reemit(items):
+            outcomes = executor.map(
+                lambda item: contextvars.copy_context().run(reemit_meta_events, *item, dry_run=dry_run), items
+            )
+            for outcome in outcomes:
+                stats[outcome] += 1
         
-        return True
-    except requests.exceptions.Timeout:
-        logging.error(f"Timeout sending '{event_name}' to Meta")
-        return False
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to send '{event_name}' to Meta: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logging.error(f"Meta API response: {e.response.text}")
-        return False
\ No newline at end of file
+        for kind in kinds:
+            list_objects, filters, expected_ids, build_events = RECONCILE_SOURCES[kind]
+            for obj in stream_stripe_objects(list_objects, filters, since, until, slices):
+                stats['checked'] += 1
+                event_ids = expected_ids(obj)
+                stats['expected_events'] += len(event_ids)
+                missing = [event_id for event_id in event_ids if event_id not in delivered]
+                if not missing:
+                    continue
+                stats['missing'] += 1
+                if len(stats['missing_event_ids']) < REPLAY_MAX_REPORTED_FAILURES:
+                    stats['missing_event_ids'].extend(missing)
+                pending.append((build_events, obj, missing))
+                if len(pending) >= concurrency * 4:
+                    reemit(pending)
+                    pending = []
+        if pending:
+            reemit(pending)
+    
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    logging.info("Reconcile finished: %s", stats, extra={'fields': stats})
+    return stats
+
+
+# --- Async (ASGI) entry points ---
+# The *_async entry points serve the same request/response contract as the Flask ones from
+# an asyncio event loop, so one instance keeps many requests in flight while they wait on
+# Stripe and Meta instead of parking a worker thread per request. Deploy them with the ASGI
+# runtime, e.g. `functions-framework --asgi --target <name>_async`. They need httpx, which
+# is also what the Stripe SDK's *_async methods use.
+# ASYNC_HTTP_MAX_CONNECTIONS: connection cap per outbound host for the event loop's client
+# WEBHOOK_ASYNC_DISPATCH_WORKERS: threads running the shared event handlers (default 32;
+#   keep HTTP_POOL_SIZE close to it so their Stripe connections are reused)
+# Cache/pool backends are still called inline: the in-process ones take microseconds, a
+# shared sqlite/redis backend adds one local round trip.
+
+
+async def read_json_async(request):
+    """request.get_json(silent=True) for a Starlette request"""
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        return None
+
+
+
+class EventLoopOffload:
+    """Outbound calls started by a handler on a worker thread but awaited on the request's event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.tasks = []
+        self.running = []  # (name, future) of calls without Meta events still running at the timeout
+        self.running_meta = []  # (name, future) of Meta posts still running at the timeout
+
+    def submit(self, name, coroutine, events=()):
+        # Runs on the worker thread; the call starts on the loop right away, concurrently
+        # with whatever the handler does next
+        if any(existing == name for existing, _, _ in self.tasks):
+            name = f"{name}.{len(self.tasks) + 1}"
+        self.tasks.append((name, list(events), asyncio.run_coroutine_threadsafe(coroutine, self.loop)))
+
+    def submit_meta_events(self, events):
+        self.submit('meta', deliver_meta_events(ASYNC_RUNTIME, events, STARTUP_CONFIG), events)
+
+    async def wait(self, timeout=None):
+        """Wait for the offloaded calls.
+
+        Returns ({name: 'ok' | 'failed' | 'deferred' | 'running' | error}, Meta events not
+        accepted, Meta events still in flight at the timeout, Meta events turned away by the
+        Meta breaker). Calls still in flight are left on self.running and self.running_meta.
+        """
+        outcomes, failed_events, unfinished_events, rejected_events = {}, [], [], []
+        if not self.tasks:
+            return outcomes, failed_events, unfinished_events, rejected_events
+        futures = {asyncio.wrap_future(future): (name, events, future) for name, events, future in self.tasks}
+        done, pending = await asyncio.wait(futures, timeout=timeout)
+        for future in done:
+            name, events, _ = futures[future]
+            error = future.exception()
+            if events:
+                results = future.result() if error is None else [(False, str(error))] * len(events)
+                rejected = [event for event, (ok, error) in zip(events, results) if not ok and error != META_CIRCUIT_OPEN]
+                deferred = [event for event, (_, error) in zip(events, results) if error == META_CIRCUIT_OPEN]
+                failed_events.extend(rejected)
+                rejected_events.extend(deferred)
+                outcomes[name] = 'failed' if rejected else 'deferred' if deferred else 'ok'
+            else:
+                outcomes[name] = 'ok' if error is None else f"{type(error).__name__}: {error}"
+        for future in pending:
+            name, events, task = futures[future]
+            if events:
+                unfinished_events.extend(events)
+                self.running_meta.append((name, task))
+                outcomes[name] = 'deferred'
+            else:
+                self.running.append((name, task))
+                outcomes[name] = 'running'
+        return outcomes, failed_events, unfinished_events, rejected_events
+
+
+_dispatch_executor = None
+_dispatch_executor_lock = threading.Lock()
+
+
+def get_dispatch_executor():
+    """Worker threads for the shared handlers under handle_stripe_webhook_async. Their Meta
+    posts and side effects with an async form run on the loop, so a thread is only held for
+    the handler's own Stripe lookups (e.g. the customer behind an invoice)"""
+    global _dispatch_executor
+    if _dispatch_executor is None:
+        with _dispatch_executor_lock:
+            if _dispatch_executor is None:
+                _dispatch_executor = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get('WEBHOOK_ASYNC_DISPATCH_WORKERS', '32')),
+                    thread_name_prefix='webhook-dispatch'
+                )
+    return _dispatch_executor
+
+
+# Set while handle_stripe_webhook_async runs a handler: send_meta_events and side effects
+# with an async form hand their calls to the event loop
+_event_loop_offload = contextvars.ContextVar('event_loop_offload', default=None)
+
+
+@summarized_request_async(request_log)
+async def handle_stripe_webhook_async(request):
+    """handle_stripe_webhook on an event loop (same request and response contract).
+
+    Verification and deduplication run on the loop. The registered handlers are shared with
+    the Flask entry point and run on a worker thread, but the Meta events they send are
+    posted from the loop, so no thread waits on the Conversions API.
+    """
+    if request.method != 'POST':
+        return 'Method Not Allowed', 405
+
+    configure_stripe(STARTUP_CONFIG['stripe_secret_key'], async_client=True)
+
+    delivery, response = screen_delivery(await request.body(), request.headers.get('stripe-signature'))
+    if response is not None:
+        return response
+    try:
+        event = delivery.event
+    except ValueError as e:
+        logging.error(f"Webhook - Invalid payload: {e}")
+        return 'Invalid payload', 400
+
+    loop = asyncio.get_running_loop()
+    offload = EventLoopOffload(loop)
+    unfinished = []
+    offload_token = _event_loop_offload.set(offload)
+    unfinished_token = _unfinished_side_effects.set(unfinished)
+    try:
+        context = contextvars.copy_context()
+    finally:
+        _unfinished_side_effects.reset(unfinished_token)
+        _event_loop_offload.reset(offload_token)
+    
+    start = time.perf_counter()
+    await loop.run_in_executor(get_dispatch_executor(), context.run, dispatch_event, event)
+    
+    # Same deadline budget as run_side_effects: in guaranteed-response mode, Meta events
+    # still in flight at the deadline are handed to the outbox
+    deadline = float(os.environ.get('WEBHOOK_DEADLINE_SECONDS', '8'))
+    guaranteed = os.environ.get('WEBHOOK_GUARANTEED_RESPONSE', 'false').lower() == 'true'
+    remaining = max(deadline - (time.perf_counter() - start), 0) if guaranteed else None
+    outcomes, failed, unfinished_events, rejected = await offload.wait(timeout=remaining)
+    unfinished.extend(offload.running)
+    if failed:
+        logging.error(f"Webhook - {event['type']} {event['id']}: Meta did not accept events: "
+                      f"{', '.join(e['event_id'] for e in failed)}")
+    if unfinished_events:
+        logging.warning(f"Webhook - {event['type']} {event['id']}: deadline of {deadline}s reached, "
+                        f"deferring {len(unfinished_events)} Meta event(s)")
+        # Drained later by drain_meta_outbox; without an outbox the posts keep running
+        if not all(defer_meta_events(unfinished_events, reason='Webhook deadline reached')):
+            unfinished.extend(offload.running_meta)
+    defer_meta_events(rejected)
+    errors = {name: outcome for name, outcome in outcomes.items() if outcome not in ('ok', 'failed', 'deferred', 'running')}
+    if errors:
+        logging.error(f"Webhook - {event['type']} {event['id']} offloaded calls failed: {errors}")
+    if outcomes:
+        summarize_request(offloaded=outcomes)
+    
+    finish_delivery(event, unfinished)
+    return 'OK', 200
+
+
+# Import-time budget and Stripe preload (see finish_module_load in common.py)
+MODULE_IMPORT_SECONDS = finish_module_load('handle-stripe-webhook', MODULE_LOAD_STARTED)
+
+
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Stripe webhook maintenance commands")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    drain_parser = subparsers.add_parser('drain', help="Deliver queued Meta events")
+    drain_parser.add_argument('--max-events', type=int, default=500)
+    drain_parser.add_argument('--loop', action='store_true', help="Keep draining until interrupted")
+    drain_parser.add_argument('--interval', type=float, default=5.0, help="Seconds between drains with --loop")
+    
+    replay_parser = subparsers.add_parser('replay', help="Run historical Stripe events through the handlers")
+    replay_source = replay_parser.add_mutually_exclusive_group(required=True)
+    replay_source.add_argument('--from-stripe', action='store_true', help="Page through the Events API (last 30 days)")
+    replay_source.add_argument('--from-jsonl', metavar='PATH', help="File with one Stripe event per line")
+    replay_parser.add_argument('--type', action='append', dest='types', help="Event type to replay (repeatable, default: all)")
+    replay_parser.add_argument('--since', help="Only events created at or after this date (YYYY-MM-DD) or Unix time (--from-stripe)")
+    replay_parser.add_argument('--until', help="Only events created at or before this date or Unix time (--from-stripe)")
+    replay_parser.add_argument('--concurrency', type=int, default=16, help="Events handled at the same time")
+    replay_parser.add_argument('--batch-size', type=int, default=500, help="Events per checkpointed batch (Stripe pages hold 100)")
+    replay_parser.add_argument('--checkpoint', help="File recording progress; an interrupted replay resumes from it")
+    replay_parser.add_argument('--dry-run', action='store_true', help="Build the Meta events without sending them or writing to Stripe")
+    replay_parser.add_argument('--skip-processed', action='store_true', help="Skip events the webhook already marked as processed")
+    replay_parser.add_argument('--meta-batch-ms', type=int, default=50,
+                               help="Coalesce Meta events from concurrent replays for this long (META_BATCH_MAX_WAIT_MS)")
+    
+    reconcile_parser = subparsers.add_parser('reconcile', help="Re-emit Meta events missing from a delivery log")
+    reconcile_parser.add_argument('--since', required=True, help="Start of the range (YYYY-MM-DD or Unix time)")
+    reconcile_parser.add_argument('--until', help="End of the range, exclusive (default: now)")
+    reconcile_parser.add_argument('--delivery-log', action='append', required=True,
+                                  help="Log export with the function's Meta delivery lines (repeatable, .gz ok)")
+    reconcile_parser.add_argument('--kind', action='append', choices=sorted(RECONCILE_SOURCES),
+                                  help="Stripe objects to check (repeatable, default: all)")
+    reconcile_parser.add_argument('--slices', type=int, default=8, help="Time slices paged in parallel")
+    reconcile_parser.add_argument('--concurrency', type=int, default=8, help="Missing events re-emitted at the same time")
+    reconcile_parser.add_argument('--expected-deliveries', type=int, default=1_000_000,
+                                  help="Capacity of the delivered-ID filter")
+    reconcile_parser.add_argument('--error-rate', type=float, default=1e-4,
+                                  help="Filter false-positive rate (missing events taken for delivered)")
+    reconcile_parser.add_argument('--dry-run', action='store_true', help="Report missing events without re-emitting them")
+    
+    args = parser.parse_args()
+    
+    def parse_time(value):
+        if not value:
+            return None
+        if value.isdigit():
+            return int(value)
+        from datetime import datetime, timezone
+        return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+    
+    if args.command == 'replay':
+        # Sized for the replay rather than for one webhook request at a time
+        os.environ.setdefault('META_BATCH_MAX_WAIT_MS', str(args.meta_batch_ms))
+        os.environ.setdefault('WEBHOOK_SIDE_EFFECT_WORKERS', str(args.concurrency * 2))
+        os.environ.setdefault('HTTP_POOL_SIZE', str(args.concurrency * 2))
+        configure_stripe(STARTUP_CONFIG['stripe_secret_key'])
+        if args.from_jsonl:
+            source = JsonlEventSource(args.from_jsonl, args.types)
+        else:
+            source = StripeEventSource(args.types, parse_time(args.since), parse_time(args.until))
+        stats = replay_events(source, concurrency=args.concurrency, batch_size=args.batch_size,
+                              checkpoint_path=args.checkpoint, dry_run=args.dry_run,
+                              skip_processed=args.skip_processed)
+        print(json.dumps(stats, indent=2))
+    
+    if args.command == 'reconcile':
+        configure_stripe(STARTUP_CONFIG['stripe_secret_key'])
+        stats = reconcile_meta_events(
+            parse_time(args.since), parse_time(args.until) or int(time.time()), args.delivery_log,
+            kinds=args.kind or tuple(RECONCILE_SOURCES), slices=args.slices, concurrency=args.concurrency,
+            dry_run=args.dry_run, capacity=args.expected_deliveries, error_rate=args.error_rate
+        )
+        print(json.dumps(stats, indent=2))
+    
+    if args.command == 'drain':
+        while True:
+            drain_outbox(get_meta_outbox(), max_events=args.max_events)
+            if not args.loop:
+                break
+            time.sleep(args.interval)
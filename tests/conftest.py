@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The functions import common.py as a sibling module, as functions_framework does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
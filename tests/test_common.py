@@ -0,0 +1,190 @@
+import json
+
+import pytest
+
+import common
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# --- Meta circuit breaker ---
+
+@pytest.fixture
+def breaker():
+    clock = FakeClock()
+    breaker = common.CircuitBreaker('test', failure_threshold=3, open_seconds=30, slow_call_seconds=5,
+                                    max_timeout=10, min_timeout=1, min_samples=5, clock=clock)
+    breaker.clock_value = clock
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures(breaker):
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record(False, 0.1)
+    assert breaker.state == 'closed'
+    breaker.record(True, 0.1)  # A success resets the count
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    assert breaker.state == 'open'
+    assert breaker.rejecting()
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_lets_one_probe_through(breaker):
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    breaker.clock_value.now += 30
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()  # The probe is still in flight
+    breaker.record(True, 0.1)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_breaker_failed_probe_reopens(breaker):
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    breaker.clock_value.now += 30
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_breaker_counts_slow_calls_as_failures(breaker):
+    for _ in range(3):
+        breaker.record(True, 6.0)
+    assert breaker.state == 'open'
+
+
+def test_breaker_timeout_follows_recent_latency(breaker):
+    assert breaker.timeout() == 10  # Not enough samples yet
+    for _ in range(5):
+        breaker.record(True, 0.5)
+    assert breaker.timeout() == pytest.approx(1.5)  # p99 * 3
+
+
+# --- Stripe idempotency keys ---
+
+def test_idempotency_key_is_deterministic_within_a_window(monkeypatch):
+    monkeypatch.setattr(common.time, 'time', lambda: 6000.0)
+    key = common.idempotency_key('op', {'b': 1, 'a': 2}, window=60)
+    assert key == common.idempotency_key('op', {'a': 2, 'b': 1}, window=60)
+    assert key != common.idempotency_key('op', {'a': 2, 'b': 3}, window=60)
+    assert key != common.idempotency_key('other', {'a': 2, 'b': 1}, window=60)
+    monkeypatch.setattr(common.time, 'time', lambda: 6060.0)
+    assert key != common.idempotency_key('op', {'a': 2, 'b': 1}, window=60)
+
+
+def test_checkout_session_key_needs_something_that_identifies_the_visitor():
+    assert common.checkout_session_idempotency_key({'mode': 'subscription'}) is None
+    assert common.checkout_session_idempotency_key({'customer_email': 'a@example.com'}) is not None
+    first = common.checkout_session_idempotency_key({'mode': 'subscription'}, 'attempt-1')
+    assert first is not None
+    assert first != common.checkout_session_idempotency_key({'mode': 'subscription'}, 'attempt-2')
+
+
+def test_request_idempotency_key_is_scoped_to_the_request():
+    assert common.request_idempotency_key('customer-modify', ['cus_1']) is None
+    with common.trace_span('request_1', kind='server'):
+        first = common.request_idempotency_key('customer-modify', ['cus_1'])
+        assert first == common.request_idempotency_key('customer-modify', ['cus_1'])
+    with common.trace_span('request_2', kind='server'):
+        assert common.request_idempotency_key('customer-modify', ['cus_1']) != first
+
+
+# --- Signed funnel token ---
+
+@pytest.fixture
+def token_secret(monkeypatch):
+    monkeypatch.setenv('CUSTOMER_TOKEN_SECRET', 'secret')
+
+
+def signed(claims, secret='secret'):
+    payload = common.b64url_encode(json.dumps(claims).encode())
+    return f"{payload}.{common.sign_token_payload(payload, secret)}"
+
+
+def test_funnel_token_round_trip(token_secret):
+    token = common.issue_funnel_token('cus_1', 'a@example.com', 'de', 'option_b', {'fbc': 'fb.1', 'user_agent': 'x'})
+    assert common.verify_funnel_token(token) == {
+        'customer_id': 'cus_1', 'email': 'a@example.com', 'locale': 'de', 'funnel': 'option_b',
+        'tracking': {'fbc': 'fb.1'},
+    }
+
+
+def test_funnel_token_without_secret(monkeypatch):
+    monkeypatch.delenv('CUSTOMER_TOKEN_SECRET', raising=False)
+    assert common.issue_funnel_token('cus_1', 'a@example.com') is None
+    assert common.verify_funnel_token('payload.signature') is None
+
+
+def test_funnel_token_rejects_tampering_and_expiry(token_secret, monkeypatch):
+    token = common.issue_funnel_token('cus_1', 'a@example.com')
+    payload, signature = token.rsplit('.', 1)
+    forged = common.b64url_encode(json.dumps({'c': 'cus_2', 'e': '', 'x': 2 ** 40}).encode())
+    assert common.verify_funnel_token(f"{forged}.{signature}") is None
+    assert common.verify_funnel_token(signed({'c': 'cus_1', 'x': 2 ** 40}, secret='other')) is None
+    monkeypatch.setattr(common.time, 'time', lambda: 2 ** 40)
+    assert common.verify_funnel_token(token) is None
+
+
+@pytest.mark.parametrize('token', [
+    None, 42, ['a.b'], '', 'no-dot', 'é.ü', '\ud800.x',
+    signed([1, 2]),
+    signed({'c': 'cus_1', 'x': 'tomorrow'}),
+    signed({'c': 'cus_1', 'x': 2 ** 40, 't': ['fbc']}),
+])
+def test_funnel_token_malformed_is_invalid(token_secret, token):
+    assert common.verify_funnel_token(token) is None
+
+
+def test_read_funnel_token_ignores_a_token_for_another_email(token_secret):
+    token = common.issue_funnel_token('cus_1', 'a@example.com')
+    assert common.read_funnel_token({'funnel_token': token}, ' A@Example.com ')['customer_id'] == 'cus_1'
+    assert common.read_funnel_token({'funnel_token': token}, 'b@example.com') is None
+
+
+# --- Stripe rate limiter ---
+
+def test_token_bucket_keeps_a_reserve_for_higher_priorities(monkeypatch):
+    monkeypatch.setattr(common.time, 'monotonic', lambda: 50.0)
+    bucket = common.TokenBucket(rate=10, burst=4)
+    assert bucket.take(reserve=2) == 0.0
+    assert bucket.take(reserve=2) == 0.0
+    assert bucket.take(reserve=2) == pytest.approx(0.1)  # Only the reserve is left
+    assert bucket.take(reserve=0) == 0.0
+    assert bucket.take(reserve=0) == 0.0
+    assert bucket.take(reserve=0) == pytest.approx(0.1)
+
+
+def test_sqlite_token_bucket_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'bucket.sqlite3')
+    first = common.SqliteTokenBucket(path, rate=0.001, burst=2)
+    second = common.SqliteTokenBucket(path, rate=0.001, burst=2)
+    assert first.take(0) == 0.0
+    assert second.take(0) == 0.0
+    assert first.take(0) > 0
+
+
+def test_rate_limiter_rejects_calls_that_would_wait_too_long():
+    limiter = common.StripeRateLimiter(common.TokenBucket(rate=1, burst=1), burst=1, max_wait=0.5)
+    limiter.acquire('critical')
+    with pytest.raises(common.StripeThrottledError) as error:
+        limiter.acquire('critical')
+    assert error.value.retry_after == pytest.approx(1.0, abs=0.05)
+
+
+def test_rate_limited_response_is_429_with_retry_after():
+    body, status, headers = common.stripe_rate_limited(common.StripeThrottledError(1.7), {'X': '1'})
+    assert status == 429
+    assert headers == {'X': '1', 'Retry-After': '2'}
+    assert 'error' in body
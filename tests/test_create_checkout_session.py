@@ -0,0 +1,101 @@
+import asyncio
+import importlib.util
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+CHECKOUT_PATH = Path(__file__).resolve().parent.parent / 'create_checkout_session.py'
+
+
+@pytest.fixture
+def checkout(monkeypatch):
+    """A fresh copy of create_checkout_session.py with Stripe and Meta configured"""
+    monkeypatch.setenv('STRIPE_SECRET_KEY', 'sk_test_123')
+    monkeypatch.setenv('META_PIXEL_ID', '123')
+    monkeypatch.setenv('META_ACCESS_TOKEN', 'token')
+    spec = importlib.util.spec_from_file_location('create_checkout_session', CHECKOUT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_single_flight_shares_one_call_between_threads(checkout):
+    single_flight = checkout.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    async def lookup():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'cus_1'
+
+    def caller():
+        results.append(checkout.run_sync(single_flight.do('a@example.com', lookup, checkout.SYNC_RUNTIME)))
+
+    leader = threading.Thread(target=caller)
+    leader.start()
+    assert started.wait(5)
+    followers = [threading.Thread(target=caller) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.1)  # Let the followers reach the in-flight call
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [('cus_1', False)] + [('cus_1', True)] * 3
+    assert single_flight._calls == {}
+
+
+def test_single_flight_shares_one_call_between_tasks(checkout):
+    single_flight = checkout.SingleFlight()
+    calls = []
+
+    async def lookup():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'cus_1'
+
+    async def main():
+        return await asyncio.gather(*(single_flight.do('a@example.com', lookup, checkout.ASYNC_RUNTIME) for _ in range(4)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(results) == [('cus_1', False)] + [('cus_1', True)] * 3
+
+
+def test_single_flight_passes_errors_to_followers_and_forgets_the_key(checkout):
+    single_flight = checkout.SingleFlight()
+
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise RuntimeError('Stripe unavailable')
+
+    async def succeeding():
+        return 'cus_2'
+
+    async def main():
+        return await asyncio.gather(*(single_flight.do('a@example.com', failing, checkout.ASYNC_RUNTIME) for _ in range(2)),
+                                    return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(main())] == [RuntimeError, RuntimeError]
+    assert checkout.run_sync(single_flight.do('a@example.com', succeeding, checkout.SYNC_RUNTIME)) == ('cus_2', False)
+
+
+def test_single_flight_keys_are_independent(checkout):
+    single_flight = checkout.SingleFlight()
+
+    async def main():
+        async def lookup(value):
+            await asyncio.sleep(0.01)
+            return value
+        return await asyncio.gather(
+            single_flight.do('a@example.com', lambda: lookup('cus_a'), checkout.ASYNC_RUNTIME),
+            single_flight.do('b@example.com', lambda: lookup('cus_b'), checkout.ASYNC_RUNTIME),
+        )
+
+    assert asyncio.run(main()) == [('cus_a', False), ('cus_b', False)]
@@ -0,0 +1,305 @@
+import hashlib
+import hmac
+import importlib.util
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+import pytest
+import stripe
+
+WEBHOOK_PATH = Path(__file__).resolve().parent.parent / 'handle-stripe-webhook.py'
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    """A fresh copy of handle-stripe-webhook.py (the file name is not importable) with Meta configured"""
+    monkeypatch.setenv('STRIPE_SECRET_KEY', 'sk_test_123')
+    monkeypatch.setenv('STRIPE_WEBHOOK_SECRET', 'whsec_test')
+    monkeypatch.setenv('META_PIXEL_ID', '123')
+    monkeypatch.setenv('META_ACCESS_TOKEN', 'token')
+    spec = importlib.util.spec_from_file_location('handle_stripe_webhook', WEBHOOK_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_invoice_without_email_fetches_customer_once(webhook, monkeypatch):
+    sent = []
+    monkeypatch.setattr(webhook, 'send_meta_events', lambda events: sent.extend(events) or [True] * len(events))
+    event = {
+        'id': 'evt_invoice',
+        'type': 'invoice.payment_succeeded',
+        'data': {'object': {
+            'id': 'in_123',
+            'object': 'invoice',
+            'customer': 'cus_123',
+            'customer_email': None,
+            'subscription': 'sub_123',
+            'billing_reason': 'subscription_create',
+            'amount_paid': 999,
+            'currency': 'usd',
+        }},
+    }
+    customer = {'id': 'cus_123', 'object': 'customer', 'email': 'buyer@example.com', 'metadata': {'fbp': 'fb.1.1.1'}}
+
+    with mock.patch.object(stripe.Customer, 'retrieve', return_value=customer) as retrieve:
+        assert webhook.dispatch_event(event)
+
+    assert retrieve.call_count == 1
+    assert [e['event_id'] for e in sent] == ['subscribe_in_123']
+    assert sent[0]['user_data']['em'] == [webhook.hash_pii('buyer@example.com')]
+
+
+# --- Raw-body signature verification and replay cache ---
+
+def sign(payload, secret='whsec_test', timestamp=None):
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), b'%d.%s' % (timestamp, payload), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+EVENT_PAYLOAD = b'{\n  "id": "evt_1",\n  "object": "event",\n  "data": {"object": {}},\n  "type": "customer.created"\n}'
+
+
+def test_signature_is_checked_against_the_raw_body(webhook):
+    delivery = webhook.verify_webhook_delivery(EVENT_PAYLOAD, sign(EVENT_PAYLOAD), 'whsec_test')
+    assert (delivery.event_id, delivery.event_type) == ('evt_1', 'customer.created')
+    assert delivery.event['data'] == {'object': {}}
+
+    # The same event re-serialized is a different body and must not verify
+    reserialized = json.dumps(json.loads(EVENT_PAYLOAD)).encode()
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook.verify_webhook_delivery(reserialized, sign(EVENT_PAYLOAD), 'whsec_test')
+
+
+def test_signature_accepts_any_matching_v1(webhook):
+    header = sign(EVENT_PAYLOAD) + ',v1=' + '0' * 64
+    header = header.replace('t=', 'v0=abc,t=')
+    assert webhook.verify_webhook_delivery(EVENT_PAYLOAD, header, 'whsec_test').event_id == 'evt_1'
+
+
+@pytest.mark.parametrize('header', [
+    None, '', 'garbage', 't=abc,v1=00', 't=1700000000',
+    sign(EVENT_PAYLOAD, secret='whsec_other'),
+    sign(EVENT_PAYLOAD, timestamp=int(time.time()) - 301),
+])
+def test_signature_rejects_bad_headers(webhook, header):
+    with pytest.raises(stripe.error.SignatureVerificationError):
+        webhook.verify_webhook_delivery(EVENT_PAYLOAD, header, 'whsec_test', tolerance=300)
+
+
+def test_replay_cache_rejects_a_signature_until_it_expires(webhook, monkeypatch):
+    cache = webhook.ReplayCache(max_entries=2)
+    monkeypatch.setattr(webhook.time, 'time', lambda: 1000.0)
+    assert cache.first_use('sig_a', 1300.0)
+    assert not cache.first_use('sig_a', 1300.0)
+    monkeypatch.setattr(webhook.time, 'time', lambda: 1300.0)
+    assert cache.first_use('sig_a', 1600.0)
+
+
+def test_replay_cache_is_bounded(webhook):
+    cache = webhook.ReplayCache(max_entries=2)
+    expires_at = time.time() + 300
+    for signature in ('sig_a', 'sig_b', 'sig_c'):
+        assert cache.first_use(signature, expires_at)
+    assert cache.first_use('sig_a', expires_at)  # Evicted as the oldest
+    assert not cache.first_use('sig_c', expires_at)
+
+
+def test_screen_delivery_rejects_replays(webhook):
+    header = sign(EVENT_PAYLOAD)
+    delivery, response = webhook.screen_delivery(EVENT_PAYLOAD, header)
+    assert delivery is not None and response is None
+    assert webhook.screen_delivery(EVENT_PAYLOAD, header) == (None, ('Replayed delivery', 400))
+    assert webhook.screen_delivery(EVENT_PAYLOAD, sign(EVENT_PAYLOAD, secret='x')) == (None, ('Invalid signature', 400))
+
+
+# --- Processed event stores ---
+
+@pytest.fixture(params=['memory', 'sqlite', 'file'])
+def event_store(request, webhook, tmp_path):
+    if request.param == 'memory':
+        return webhook.MemoryEventStore(ttl=60)
+    if request.param == 'sqlite':
+        return webhook.SqliteEventStore(str(tmp_path / 'events.sqlite3'), ttl=60)
+    return webhook.FileEventStore(str(tmp_path / 'events.log'), ttl=60)
+
+
+def test_event_store_remembers_until_ttl(webhook, event_store, monkeypatch):
+    monkeypatch.setattr(webhook.time, 'time', lambda: 1000.0)
+    assert not event_store.contains('evt_1')
+    event_store.add('evt_1')
+    assert event_store.contains('evt_1')
+    assert not event_store.contains('evt_2')
+    monkeypatch.setattr(webhook.time, 'time', lambda: 1061.0)
+    assert not event_store.contains('evt_1')
+
+
+@pytest.mark.parametrize('store_class, name', [('SqliteEventStore', 'events.sqlite3'), ('FileEventStore', 'events.log')])
+def test_durable_event_store_survives_a_restart(webhook, tmp_path, store_class, name):
+    path = str(tmp_path / name)
+    getattr(webhook, store_class)(path, ttl=60).add('evt_1')
+    assert getattr(webhook, store_class)(path, ttl=60).contains('evt_1')
+
+
+def test_memory_event_store_evicts_least_recently_added(webhook):
+    store = webhook.MemoryEventStore(ttl=60, max_entries=2)
+    for event_id in ('evt_1', 'evt_2', 'evt_3'):
+        store.add(event_id)
+    assert not store.contains('evt_1')
+    assert store.contains('evt_2') and store.contains('evt_3')
+
+
+def test_processed_event_store_caches_durable_hits(webhook, tmp_path):
+    durable = webhook.SqliteEventStore(str(tmp_path / 'events.sqlite3'), ttl=60)
+    durable.add('evt_1')
+    store = webhook.ProcessedEventStore(webhook.MemoryEventStore(ttl=60), durable)
+    assert store.is_processed('evt_1')
+    assert store.memory.contains('evt_1')
+    store.mark_processed('evt_2')
+    assert durable.contains('evt_2')
+
+
+def test_processed_event_store_survives_durable_failures(webhook):
+    durable = mock.Mock()
+    durable.contains.side_effect = sqlite3.OperationalError('disk I/O error')
+    durable.add.side_effect = sqlite3.OperationalError('disk I/O error')
+    store = webhook.ProcessedEventStore(webhook.MemoryEventStore(ttl=60), durable)
+    assert not store.is_processed('evt_1')
+    store.mark_processed('evt_1')
+    assert store.is_processed('evt_1')
+
+
+# --- Meta outbox ---
+
+@pytest.fixture(params=['sqlite', 'file'])
+def outbox(request, webhook, tmp_path):
+    if request.param == 'sqlite':
+        return webhook.SqliteMetaOutbox(str(tmp_path / 'outbox.sqlite3'))
+    return webhook.FileMetaOutbox(str(tmp_path / 'outbox.jsonl'))
+
+
+def meta_event(event_id, age=0):
+    return {'event_name': 'Purchase', 'event_id': event_id, 'event_time': int(time.time()) - age, 'user_data': {}}
+
+
+def test_outbox_enqueue_is_idempotent(outbox):
+    outbox.enqueue(meta_event('purchase_1'))
+    outbox.enqueue(meta_event('purchase_1'))
+    assert [record['event_id'] for record in outbox.claim(10, 60)] == ['purchase_1']
+
+
+def test_outbox_claim_leases_events(outbox):
+    for event_id in ('purchase_1', 'purchase_2'):
+        outbox.enqueue(meta_event(event_id))
+    first = outbox.claim(1, 60)
+    second = outbox.claim(10, 60)
+    assert len(first) == 1 and len(second) == 1
+    assert first[0]['event_id'] != second[0]['event_id']
+    assert first[0]['event']['event_name'] == 'Purchase' and first[0]['attempts'] == 0
+    assert outbox.claim(10, 60) == []
+
+
+def test_outbox_ack_retry_and_dead(outbox):
+    for event_id in ('purchase_1', 'purchase_2', 'purchase_3'):
+        outbox.enqueue(meta_event(event_id))
+    outbox.claim(10, 0)
+    outbox.ack(['purchase_1'])
+    outbox.retry('purchase_2', 1, time.time() - 1, 'HTTP 500')
+    outbox.retry('purchase_3', 1, time.time() - 1, 'HTTP 400', dead=True)
+    assert [(record['event_id'], record['attempts']) for record in outbox.claim(10, 60)] == [('purchase_2', 1)]
+
+
+def test_drain_outbox_acks_retries_and_expires(webhook, outbox, monkeypatch):
+    monkeypatch.setattr(webhook, 'get_meta_breaker', lambda: None)
+    outbox.enqueue(meta_event('purchase_ok'))
+    outbox.enqueue(meta_event('purchase_fail'))
+    outbox.enqueue(meta_event('purchase_old', age=webhook.META_MAX_EVENT_AGE_SECONDS + 60))
+    sent = []
+
+    async def deliver(runtime, events, config):
+        sent.extend(event['event_id'] for event in events)
+        return [(event['event_id'] == 'purchase_ok', None if event['event_id'] == 'purchase_ok' else 'HTTP 500')
+                for event in events]
+
+    monkeypatch.setattr(webhook, 'deliver_meta_events', deliver)
+    stats = webhook.drain_outbox(outbox)
+
+    assert stats == {'claimed': 3, 'delivered': 1, 'retried': 1, 'dead': 1}
+    assert sorted(sent) == ['purchase_fail', 'purchase_ok']
+    assert outbox.claim(10, 60) == []  # The failed event waits out its backoff
+
+
+def test_drain_outbox_waits_while_the_circuit_is_open(webhook, outbox, monkeypatch):
+    monkeypatch.setattr(webhook, 'get_meta_breaker', lambda: mock.Mock(rejecting=lambda: True))
+    outbox.enqueue(meta_event('purchase_1'))
+    assert webhook.drain_outbox(outbox)['circuit'] == 'open'
+    assert len(outbox.claim(10, 60)) == 1
+
+
+# --- Reconciliation ---
+
+def test_reconcile_reemits_only_missing_meta_events(webhook, monkeypatch, tmp_path):
+    session = {'id': 'cs_1', 'object': 'checkout.session', 'customer': 'cus_1', 'amount_total': 999, 'currency': 'usd',
+               'metadata': {}, 'customer_details': {'email': 'buyer@example.com', 'name': 'Buyer'}}
+    delivery_log = tmp_path / 'deliveries.log'
+    delivery_log.write_text("Successfully sent 'StartTrial' to Meta. Event ID: trial_cs_1\n")
+    sent = []
+    monkeypatch.setattr(webhook, 'send_meta_events', lambda events: sent.extend(events) or [True] * len(events))
+    page = mock.Mock(data=[session], has_more=False)
+
+    with mock.patch.object(stripe.checkout.Session, 'list', return_value=page), \
+            mock.patch.object(stripe.Customer, 'modify') as modify:
+        stats = webhook.reconcile_meta_events(0, 100, [str(delivery_log)], kinds=('sessions',), slices=1)
+
+    modify.assert_not_called()
+    assert [event['event_id'] for event in sent] == ['purchase_cs_1']
+    assert (stats['missing'], stats['reemitted'], stats['failed']) == (1, 1, 0)
+
+
+def test_handler_stats_count_every_concurrent_call(webhook, monkeypatch):
+    def handler(event, resolver):
+        if event['id'].endswith('0'):
+            raise RuntimeError('boom')
+
+    monkeypatch.setitem(webhook.WEBHOOK_HANDLERS, 'test.event', {'func': handler, 'requires_meta': False})
+    events = [{'id': f"evt_{i}", 'type': 'test.event'} for i in range(400)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda event: webhook.dispatch_event(event, resolver=mock.Mock(fetches=0)), events))
+
+    stats = webhook.WEBHOOK_HANDLER_STATS['test.event']
+    assert (stats['calls'], stats['errors']) == (400, 40)
+
+
+# --- Replay ---
+
+def replayable_invoice(created):
+    return {
+        'id': f"evt_invoice_{created}", 'type': 'invoice.payment_succeeded', 'created': created,
+        'data': {'object': {'id': f"in_{created}", 'object': 'invoice', 'customer': None,
+                            'customer_email': 'buyer@example.com', 'subscription': 'sub_123',
+                            'billing_reason': 'subscription_cycle', 'amount_paid': 999, 'currency': 'usd'}},
+    }
+
+
+def test_replay_sends_meta_events_with_the_original_event_time(webhook, monkeypatch):
+    sent = []
+    monkeypatch.setattr(webhook, 'route_meta_events', lambda events: sent.extend(events) or [True] * len(events))
+    created = int(time.time()) - 3 * 24 * 3600
+
+    assert webhook.replay_event(replayable_invoice(created)) == ('replayed', 1)
+    assert [event['event_time'] for event in sent] == [created]
+
+
+def test_replay_skips_meta_events_outside_the_7_day_window(webhook, monkeypatch):
+    sent = []
+    monkeypatch.setattr(webhook, 'route_meta_events', lambda events: sent.extend(events) or [True] * len(events))
+    created = int(time.time()) - webhook.META_MAX_EVENT_AGE_SECONDS - 60
+
+    assert webhook.replay_event(replayable_invoice(created)) == ('expired', 0)
+    assert webhook.replay_event(replayable_invoice(created), dry_run=True) == ('expired', 0)
+    assert sent == []